@@ -27,14 +27,18 @@ from logging import info, debug, error
 from sys import stdout, exit
 from kmod import Kmod
 
-from relay_device import *
 from config import DaemonConfig
+from daemon import Daemon
+from startup import StartupProfile
+from supervisor import Supervisor
 
 parser = argparse.ArgumentParser(
     description="Relay daemon for remotely controllable USB HID devices"
 )
 parser.add_argument('-v', '--verbose', help='Show debugging messages',
                     action="store_true")
+parser.add_argument('-p', '--profile-startup', action="store_true",
+                    help='Show how long each phase of startup took')
 parser.add_argument('-c', '--config', help='Load a specific configuration file',
                     default='/etc/hidrelayd.conf')
 args = parser.parse_args()
@@ -46,24 +50,25 @@ except OSError as e:
     error("Failed to read config file '%s': %s" % (args.config, e.strerror))
     exit(1)
 
-if config.getboolean('hidrelayd', 'debug') or args.verbose:
+verbose = config.getboolean('hidrelayd', 'debug') or args.verbose
+if verbose:
     logging.basicConfig(level=logging.DEBUG)
+elif args.profile_startup:
+    # The profile is logged at the info level
+    logging.basicConfig(level=logging.INFO)
 
-km = Kmod()
-libcomposite = km.module_from_name('libcomposite')
-if libcomposite.refcnt > 0:
-    debug('libcomposite already loaded, skipping')
-else:
-    debug('Loading libcomposite...')
-    km.modprobe('libcomposite')
-
-debug('Initializing relay devices...')
-devices = []
-for section in config.sections():
-    if not section.startswith("gadget:"):
-        continue
+profile = StartupProfile()
+with profile.phase('module load'):
+    km = Kmod()
+    libcomposite = km.module_from_name('libcomposite')
+    if libcomposite.refcnt > 0:
+        debug('libcomposite already loaded, skipping')
+    else:
+        debug('Loading libcomposite...')
+        km.modprobe('libcomposite')
 
-    devices.append(RelayDevice(section, config))
-
-print("Can't do much past this point just yet, but all of the devices should be ready!")
-input()
+if config.getboolean('hidrelayd', 'workers'):
+    Supervisor(config, args.config, verbose=verbose,
+               profile_startup=args.profile_startup).run()
+else:
+    Daemon(config, config_path=args.config, profile=profile).run()
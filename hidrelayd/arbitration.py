@@ -0,0 +1,826 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Arbitration between several clients sending input to the same gadget. Each
+client gets its own InputSession, with its own idea of which keys and buttons
+it's holding down and a bounded queue of input that hasn't been sent yet, and
+the InputArbiter for the gadget merges the sessions into the reports that
+actually get sent. That way an operator and a script driving the same gadget
+can't release each other's keys.
+
+Input to a broadcast group goes through a GroupSession, which holds an
+InputSession with each member's arbiter. So someone driving a group and
+someone driving one of its members directly get merged just the same.
+
+Sessions have a priority. While a session is engaged, meaning it has input
+waiting, is holding something down or sent input within the last IDLE_TIMEOUT
+seconds, sessions with a lower priority are held back: their input waits in
+their queues, and whatever they're holding down is hidden from the host until
+the higher priority session goes idle. A session can also lock the target so
+that nobody else gets through until it unlocks, short of a session with a
+higher priority becoming engaged.
+
+Input from interactive sessions is sent the moment it arrives. Everyone
+else's is only fed to the gadget while it has fewer than FEED_DEPTH reports
+queued, so however much batch input is waiting, interactive input never has
+more than a couple of reports in front of it.
+"""
+
+import asyncio
+from collections import deque
+from logging import debug
+
+import keymap
+import timers
+from ghid import Device, Keyboard, Mouse
+
+PRIORITY_BATCH = 0
+PRIORITY_INTERACTIVE = 1
+
+""" The functions of a relay device that sessions can send input to """
+FUNCTIONS = ('keyboard', 'mouse', 'consumer')
+""" What a boot keyboard reports in every slot when too many keys are down """
+ERROR_ROLL_OVER = 0x01
+
+class InputSession():
+    """
+    One client's input to a gadget. Each change is queued and sent once the
+    InputArbiter gets to it, so these all return right away.
+    They raise an InputArbiter.Exception if the queue is full, or the target
+    doesn't have the function needed, and a ValueError if the input doesn't
+    make sense for the device. Input to a closed session is ignored.
+
+    Keyword arguments:
+    arbiter -- The InputArbiter of the gadget
+    name -- The name of the session, for logging and error messages
+    priority -- PRIORITY_BATCH, PRIORITY_INTERACTIVE, or anything higher
+    queue_limit -- The most changes that can be waiting to be sent at once
+    """
+    def __init__(self, arbiter, name, priority, queue_limit):
+        self.arbiter = arbiter
+        self.name = name
+        self.priority = priority
+        self.queue_limit = queue_limit
+        self.queue = deque()
+        self.keys = dict()
+        self.modifier_mask = 0
+        self.btn_mask = 0
+        self.consumer_usage = 0
+        """ When the arbiter last sent input from us, in loop time """
+        self.last_input = None
+        self.closed = False
+        self._timers = set()
+
+    @property
+    def relay(self):
+        """ The RelayDevice we send input to, if there is one right now """
+        return self.arbiter.relay
+
+    @property
+    def holding(self):
+        """ Whether we're holding anything down """
+        return bool(self.keys or self.modifier_mask or self.btn_mask or
+                    self.consumer_usage)
+
+    def _device(self, function):
+        device = self.arbiter.device(function)
+        if device is None:
+            raise InputArbiter.Exception("'%s' doesn't have a %s" % (
+                self.arbiter.name, function))
+
+        return device
+
+    def _check_buttons(self, btn_mask):
+        if btn_mask & ~self._device('mouse').BUTTON_MASK:
+            raise ValueError('Unknown mouse buttons in 0x%x' % btn_mask)
+
+    def _queue(self, function, apply, args):
+        """
+        Queue a call to apply(*args), followed by a report for function if it
+        changed our state. Without an apply function, args is a buffer of
+        reports to feed to the function as they fit, and the size of each
+        report.
+        """
+        if self.closed:
+            return
+        if len(self.queue) >= self.queue_limit:
+            raise InputArbiter.Exception('%s: Input queue is full' %
+                                         self.name)
+
+        self.queue.append((function, apply, args))
+        self.arbiter.pump()
+
+    def _track(self, future):
+        self._timers.add(future)
+        future.add_done_callback(self._timers.discard)
+        return future
+
+    def set_keys(self, modifier_mask=0, keys=[]):
+        """ Replace the keys we're holding down """
+        self._device('keyboard')
+        if modifier_mask & ~Keyboard.MODIFIER_MASK:
+            raise ValueError('Unknown modifiers in 0x%x' % modifier_mask)
+
+        self._queue('keyboard', self._set_keys, (modifier_mask, list(keys)))
+
+    def _set_keys(self, modifier_mask, keys):
+        self.modifier_mask = modifier_mask
+        self.keys = dict.fromkeys(keys)
+
+    def press_keys(self, *keys):
+        """
+        Press the given keys on top of the ones we're already holding down,
+        modifiers included
+        """
+        self._device('keyboard')
+        self._queue('keyboard', self._press_keys, (keys,))
+
+    def _press_keys(self, keys):
+        modifiers = Keyboard.MODIFIER_USAGES
+        for key in keys:
+            if key in modifiers:
+                self.modifier_mask |= 1 << (key - modifiers.start)
+            else:
+                self.keys[key] = None
+
+    def release_keys(self, *keys):
+        """ Release the given keys, leaving any others held down """
+        self._device('keyboard')
+        self._queue('keyboard', self._release_keys, (keys,))
+
+    def _release_keys(self, keys):
+        modifiers = Keyboard.MODIFIER_USAGES
+        for key in keys:
+            if key in modifiers:
+                self.modifier_mask &= ~(1 << (key - modifiers.start))
+            else:
+                self.keys.pop(key, None)
+
+    def hold_key(self, key, duration):
+        """
+        Press a key, and release it again after duration seconds. Returns a
+        future like timers.hold() does.
+        """
+        return self._track(timers.hold(
+            self.arbiter.loop, lambda: self.press_keys(key),
+            lambda: self._queue('keyboard', self._release_keys, ((key,),)),
+            duration))
+
+    def repeat_key(self, key, interval, until=None):
+        """
+        Tap a key every interval seconds. Returns a future like
+        timers.repeat() does.
+        """
+        def tap():
+            self.press_keys(key)
+            self.release_keys(key)
+
+        return self._track(timers.repeat(self.arbiter.loop, tap, interval,
+                                         until))
+
+    def type_text(self, text, layout='us'):
+        """
+        Release any keys we're holding down, and then type out a string like
+        Keyboard.type_text() does. Raises a ValueError if the text can't be
+        typed with the layout.
+        """
+        keyboard = self._device('keyboard')
+        caps_lock = bool(keyboard.leds & Keyboard.Led.CAPS_LOCK.value)
+        reports = keymap.compile_text(text, layout, type(keyboard), caps_lock)
+
+        self._queue('keyboard', self._set_keys, (0, []))
+        self._queue('keyboard', None,
+                    (memoryview(reports), keyboard.packet.size))
+
+    def set_buttons(self, btn_mask=0):
+        """ Replace the mouse buttons we're holding down """
+        self._check_buttons(btn_mask)
+
+        self._queue('mouse', self._set_buttons, (btn_mask,))
+
+    def _set_buttons(self, btn_mask):
+        self.btn_mask = btn_mask
+
+    def press_buttons(self, btn_mask):
+        self._check_buttons(btn_mask)
+
+        self._queue('mouse', self._press_buttons, (btn_mask,))
+
+    def _press_buttons(self, btn_mask):
+        self.btn_mask |= btn_mask
+
+    def release_buttons(self, btn_mask):
+        self._device('mouse')
+        self._queue('mouse', self._release_buttons, (btn_mask,))
+
+    def _release_buttons(self, btn_mask):
+        self.btn_mask &= ~btn_mask
+
+    def hold_buttons(self, btn_mask, duration):
+        """
+        Press the mouse buttons in btn_mask, and release them again after
+        duration seconds. Returns a future like timers.hold() does.
+        """
+        return self._track(timers.hold(
+            self.arbiter.loop, lambda: self.press_buttons(btn_mask),
+            lambda: self._queue('mouse', self._release_buttons, (btn_mask,)),
+            duration))
+
+    def move(self, dx, dy, btn_mask=None, duration=None):
+        """
+        Move a relative mouse by (dx, dy), spread out over duration seconds if
+        it's given. If btn_mask is given, it replaces the buttons we're
+        holding down in the same report.
+        """
+        mouse = self._device('mouse')
+        if not isinstance(mouse, Mouse):
+            raise InputArbiter.Exception("'%s' doesn't have a relative mouse" %
+                                         self.arbiter.name)
+        if btn_mask is not None:
+            self._check_buttons(btn_mask)
+
+        self._queue('mouse', self._move, (dx, dy, btn_mask, duration))
+
+    def _move(self, dx, dy, btn_mask, duration):
+        if btn_mask is not None:
+            self.btn_mask = btn_mask
+        self.arbiter.move(dx, dy, duration)
+
+    def move_to(self, x, y):
+        """ Move an absolute mouse to (x, y) """
+        mouse = self._device('mouse')
+        if isinstance(mouse, Mouse):
+            raise InputArbiter.Exception(
+                "'%s' doesn't have an absolute mouse" % self.arbiter.name)
+        if not (0 <= x <= mouse.MAX_COORD and 0 <= y <= mouse.MAX_COORD):
+            raise ValueError('(%d, %d) is off the screen' % (x, y))
+
+        self._queue('mouse', self.arbiter.move_to, (x, y))
+
+    def set_consumer(self, usage=0):
+        """ Press a consumer control usage, or release it with 0 """
+        if not 0 <= usage <= self._device('consumer').MAX_USAGE:
+            raise ValueError('Unknown consumer control usage 0x%x' % usage)
+
+        self._queue('consumer', self._set_consumer, (usage,))
+
+    def _set_consumer(self, usage):
+        self.consumer_usage = usage
+
+    def write_reports(self, function, reports):
+        """
+        Queue pre-encoded reports for a function, back to back. Raises a
+        ValueError if they aren't a whole number of reports.
+        """
+        size = self._device(function).packet.size
+        if not reports or len(reports) % size:
+            raise ValueError('Raw reports must be %d bytes long' % size)
+
+        # The reports might not be sent until long after the caller's buffer
+        # is gone
+        self._queue(function, None, (memoryview(bytes(reports)), size))
+
+    def set_priority(self, priority):
+        self.arbiter.set_priority(self, priority)
+
+    def lock(self):
+        """ See InputArbiter.lock() """
+        self.arbiter.lock(self)
+
+    def unlock(self):
+        self.arbiter.unlock(self)
+
+    def close(self):
+        """ Drop any queued input, and release everything we held down """
+        if self.closed:
+            return
+
+        self.closed = True
+        for future in list(self._timers):
+            future.cancel()
+        self.arbiter._remove(self)
+
+class InputArbiter():
+    """
+    Merges the input from every session sending input to a gadget. The
+    gadget is looked up by name whenever there's input to send, so sessions
+    keep working when it gets recreated.
+
+    Keyword arguments:
+    loop -- The event loop to send input from
+    name -- The name of the gadget
+    arbiters -- The InputArbiters this is kept in
+    """
+    """ The most changes each session can have waiting to be sent """
+    QUEUE_LIMIT = 1024
+    """ How many reports can be queued before we hold back batch input """
+    FEED_DEPTH = 2
+    """ How long a session stays engaged after its last input, in seconds """
+    IDLE_TIMEOUT = 0.5
+
+    class Exception(Exception):
+        pass
+
+    def __init__(self, loop, name, arbiters):
+        self.loop = loop
+        self.name = name
+        self.arbiters = arbiters
+        self.sessions = list()
+        self.lock_holder = None
+        self._active = ()
+        self._pump_handle = None
+
+    @property
+    def relay(self):
+        """ The RelayDevice we send input to, if any """
+        return self.arbiters.devices.get(self.name)
+
+    def device(self, function):
+        """ Get the device for one of FUNCTIONS, or None if there isn't one """
+        relay = self.relay
+        if relay is None:
+            return None
+
+        return getattr(relay, function)
+
+    def session(self, name, priority=PRIORITY_BATCH, queue_limit=None):
+        """ Start a new InputSession """
+        session = InputSession(self, name, priority,
+                               queue_limit or self.QUEUE_LIMIT)
+        self.sessions.append(session)
+        self._sort()
+        return session
+
+    def _sort(self):
+        # Stable, so sessions with the same priority stay in the order they
+        # were started
+        self.sessions.sort(key=lambda session: -session.priority)
+
+    def set_priority(self, session, priority):
+        session.priority = priority
+        self._sort()
+        self.pump()
+
+    def lock(self, session):
+        """
+        Only let input from session through until it unlocks. Sessions can
+        take the lock from sessions with a lower priority.
+        """
+        holder = self.lock_holder
+        if holder is not None and holder is not session and \
+           holder.priority >= session.priority:
+            raise self.Exception("'%s' is locked by %s" % (self.name,
+                                                           holder.name))
+
+        self.lock_holder = session
+        self.pump()
+
+    def unlock(self, session):
+        if self.lock_holder is session:
+            self.lock_holder = None
+            self.pump()
+
+    def _remove(self, session):
+        self.sessions.remove(session)
+        if self.lock_holder is session:
+            self.lock_holder = None
+        session.queue.clear()
+
+        self.pump()
+        if not self.sessions:
+            self.arbiters._remove(self)
+
+    def _engaged(self, session, now):
+        return bool(session.queue) or session.holding or \
+            (session.last_input is not None and
+             now - session.last_input < self.IDLE_TIMEOUT)
+
+    def _find_active(self, now):
+        """ Figure out which sessions get to send input right now """
+        top = None
+        for session in self.sessions:
+            if self._engaged(session, now):
+                top = session.priority
+                break
+
+        holder = self.lock_holder
+        if holder is not None and (top is None or holder.priority >= top):
+            return (holder,)
+        if top is None:
+            return tuple(self.sessions)
+
+        return tuple(session for session in self.sessions
+                     if session.priority >= top)
+
+    @staticmethod
+    def _turn(session):
+        return (-session.priority, session.last_input or 0)
+
+    def pump(self):
+        """
+        Send as much of the sessions' queued input as we can. This gets
+        called whenever something changes, and reschedules itself for when
+        whatever is holding input back should be done.
+        """
+        if self._pump_handle is not None:
+            self._pump_handle.cancel()
+            self._pump_handle = None
+
+        now = self.loop.time()
+        active = self._find_active(now)
+        if active != self._active:
+            self._active = active
+            self._sync_all()
+
+        # Sessions with the same priority take turns, whoever sent input
+        # longest ago going first
+        wakeup = None
+        for session in sorted(active, key=self._turn):
+            queue = session.queue
+            while queue:
+                function = queue[0][0]
+                device = self.device(function)
+                if device is None:
+                    # The function went away when the gadget was reconfigured
+                    queue.popleft()
+                    continue
+
+                if session.priority >= PRIORITY_INTERACTIVE:
+                    budget = None
+                else:
+                    budget = self.FEED_DEPTH - device.function.queue_depth
+                    if budget <= 0:
+                        retry = now + device.function.poll_interval
+                        wakeup = retry if wakeup is None else min(wakeup,
+                                                                  retry)
+                        break
+
+                function, apply, args = queue.popleft()
+                session.last_input = now
+                try:
+                    if apply is not None:
+                        apply(*args)
+                        self._sync(function, device)
+                        continue
+
+                    reports, size = args
+                    if size != device.packet.size:
+                        # The device changed modes since they were encoded
+                        continue
+
+                    rest = self._write_reports(device, reports, budget)
+                    if rest:
+                        queue.appendleft((function, None, (rest, size)))
+                    else:
+                        self._track_raw(session, function, device,
+                                        reports[-size:])
+                except (Device.GadgetUnboundError, OSError) as e:
+                    # Most likely the gadget was reconfigured under us
+                    debug('%s: Dropping input from %s: %s' % (
+                        self.name, session.name, e))
+
+        # Held back sessions get their turn once the active ones go idle
+        if len(active) < len(self.sessions) and \
+           active != (self.lock_holder,):
+            for session in active:
+                if session.queue or session.holding or \
+                   session.last_input is None:
+                    continue
+
+                idle = session.last_input + self.IDLE_TIMEOUT
+                wakeup = idle if wakeup is None else min(wakeup, idle)
+
+        if wakeup is not None:
+            self._pump_handle = self.loop.call_at(wakeup, self.pump)
+
+    def _write_reports(self, device, reports, budget):
+        """
+        Write as many of reports as budget allows, or all of them if it's
+        None. Returns the ones that didn't fit.
+        """
+        size = device.packet.size
+        if budget is not None and len(reports) > budget * size:
+            device.function.write_many(reports[:budget * size], size)
+            return reports[budget * size:]
+
+        device.function.write_many(reports, size)
+        return None
+
+    def _track_raw(self, session, function, device, report):
+        """
+        Whatever the last of a session's raw reports left pressed is what the
+        session holds down now. Anything the other sessions hold down that the
+        report left out gets sent again.
+        """
+        device.track_report(report)
+        if function == 'keyboard':
+            session.modifier_mask = device.modifier_mask
+            session.keys = dict.fromkeys(device.pressed_keys)
+        elif function == 'mouse':
+            session.btn_mask = device.btn_mask
+        else:
+            session.consumer_usage = device.usage
+
+        self._sync(function, device)
+
+    def _sync_all(self):
+        for function in FUNCTIONS:
+            device = self.device(function)
+            if device is None:
+                continue
+
+            try:
+                self._sync(function, device)
+            except (Device.GadgetUnboundError, OSError) as e:
+                debug('%s: Failed to sync the %s: %s' % (self.name, function,
+                                                         e))
+
+    def _sync(self, function, device):
+        """
+        Send a report for function if the merged state of the active
+        sessions doesn't match what the device last sent
+        """
+        if function == 'keyboard':
+            self._sync_keyboard(device)
+        elif function == 'mouse':
+            btn_mask = self._btn_mask()
+            if btn_mask != device.btn_mask:
+                device.set_pressed(btn_mask)
+        else:
+            usage = 0
+            for session in self._active:
+                if session.consumer_usage:
+                    usage = session.consumer_usage
+                    break
+            if usage != device.usage:
+                device.set_pressed(usage)
+
+    def _sync_keyboard(self, keyboard):
+        keys = dict()
+        modifier_mask = 0
+        for session in self._active:
+            keys.update(session.keys)
+            modifier_mask |= session.modifier_mask
+
+        keys = [usage for usage in keys if usage <= keyboard.MAX_USAGE]
+        if keyboard.MAX_KEYS is not None and len(keys) > keyboard.MAX_KEYS:
+            keys = [ERROR_ROLL_OVER] * keyboard.MAX_KEYS
+        if modifier_mask != keyboard.modifier_mask or \
+           keys != keyboard.pressed_keys:
+            keyboard.set_pressed(modifier_mask, keys)
+
+    def _btn_mask(self):
+        btn_mask = 0
+        for session in self._active:
+            btn_mask |= session.btn_mask
+        return btn_mask
+
+    def move(self, dx, dy, duration=None):
+        """
+        Move the relative mouse with the merged buttons, in a single report
+        when it fits
+        """
+        mouse = self.device('mouse')
+        if not isinstance(mouse, Mouse):
+            # It became an absolute mouse since the move was queued
+            return
+
+        btn_mask = self._btn_mask()
+        if duration is None and abs(dx) <= mouse.MAX_DELTA and \
+           abs(dy) <= mouse.MAX_DELTA and (dx or dy):
+            mouse.move(dx, dy, btn_mask)
+            return
+
+        if btn_mask != mouse.btn_mask:
+            mouse.set_pressed(btn_mask)
+        mouse.move_by(dx, dy, duration)
+
+    def move_to(self, x, y):
+        mouse = self.device('mouse')
+        if not isinstance(mouse, Mouse):
+            mouse.move_to(x, y)
+
+    def close(self):
+        if self._pump_handle is not None:
+            self._pump_handle.cancel()
+            self._pump_handle = None
+
+class GroupSession():
+    """
+    One client's input to a broadcast group. This starts an InputSession with
+    the arbiter of each member, and passes everything on to the ones with the
+    function it's for, so that each member's arbiter merges it with whatever
+    else that member is being sent. Members are looked up whenever there's
+    input to send, so this keeps up with the group getting reconfigured.
+
+    It has the same methods as InputSession, and they raise the same errors.
+    Timed input returns a future that finishes once every member's has.
+
+    Keyword arguments:
+    arbiters -- The InputArbiters to start the members' sessions from
+    target -- The name of the broadcast group
+    name -- The name of the session, for logging and error messages
+    priority -- PRIORITY_BATCH, PRIORITY_INTERACTIVE, or anything higher
+    """
+    def __init__(self, arbiters, target, name, priority):
+        self.arbiters = arbiters
+        self.target = target
+        self.name = name
+        self.priority = priority
+        self.sessions = dict()
+        self.closed = False
+
+    @property
+    def relay(self):
+        """ The BroadcastGroup we send input to, if there is one right now """
+        return self.arbiters.groups.get(self.target)
+
+    def _members(self, function=None):
+        """
+        Get the sessions of the members with function, or of every member if
+        it's None. Members that joined or left the group since we last looked
+        get their sessions started or closed.
+        """
+        group = self.relay
+        members = group.members if group is not None else dict()
+        for member in list(self.sessions):
+            if member not in members:
+                self.sessions.pop(member).close()
+        for member in members:
+            if member not in self.sessions:
+                self.sessions[member] = self.arbiters.device_session(
+                    member, self.name, self.priority)
+
+        if function is None:
+            return list(self.sessions.values())
+
+        sessions = [session for session in self.sessions.values()
+                    if session.arbiter.device(function) is not None]
+        if not sessions:
+            raise InputArbiter.Exception("'%s' doesn't have a %s" % (
+                self.target, function))
+        return sessions
+
+    def _fan_out(self, function, method, *args):
+        """
+        Call method on the session of every member with function, and return
+        what they returned. A member that can't take the input doesn't stop
+        the others from getting it, the first error is raised afterwards.
+        """
+        if self.closed:
+            return []
+
+        results = list()
+        failure = None
+        for session in self._members(function):
+            try:
+                results.append(getattr(session, method)(*args))
+            except (InputArbiter.Exception, ValueError) as e:
+                failure = failure or e
+
+        if failure is not None:
+            raise failure
+        return results
+
+    def _gather(self, futures):
+        if not futures:
+            future = self.arbiters.loop.create_future()
+            future.cancel()
+            return future
+
+        return asyncio.gather(*futures)
+
+    def set_keys(self, modifier_mask=0, keys=[]):
+        self._fan_out('keyboard', 'set_keys', modifier_mask, keys)
+
+    def press_keys(self, *keys):
+        self._fan_out('keyboard', 'press_keys', *keys)
+
+    def release_keys(self, *keys):
+        self._fan_out('keyboard', 'release_keys', *keys)
+
+    def hold_key(self, key, duration):
+        return self._gather(self._fan_out('keyboard', 'hold_key', key,
+                                          duration))
+
+    def repeat_key(self, key, interval, until=None):
+        return self._gather(self._fan_out('keyboard', 'repeat_key', key,
+                                          interval, until))
+
+    def type_text(self, text, layout='us'):
+        # Each member compiles the text for itself, since they might not all
+        # have caps lock on
+        self._fan_out('keyboard', 'type_text', text, layout)
+
+    def set_buttons(self, btn_mask=0):
+        self._fan_out('mouse', 'set_buttons', btn_mask)
+
+    def press_buttons(self, btn_mask):
+        self._fan_out('mouse', 'press_buttons', btn_mask)
+
+    def release_buttons(self, btn_mask):
+        self._fan_out('mouse', 'release_buttons', btn_mask)
+
+    def hold_buttons(self, btn_mask, duration):
+        return self._gather(self._fan_out('mouse', 'hold_buttons', btn_mask,
+                                          duration))
+
+    def move(self, dx, dy, btn_mask=None, duration=None):
+        self._fan_out('mouse', 'move', dx, dy, btn_mask, duration)
+
+    def move_to(self, x, y):
+        self._fan_out('mouse', 'move_to', x, y)
+
+    def set_consumer(self, usage=0):
+        self._fan_out('consumer', 'set_consumer', usage)
+
+    def write_reports(self, function, reports):
+        self._fan_out(function, 'write_reports', function, reports)
+
+    def set_priority(self, priority):
+        self.priority = priority
+        for session in self._members():
+            session.set_priority(priority)
+
+    def lock(self):
+        """ Lock every member, or none of them if any are locked already """
+        locked = list()
+        try:
+            for session in self._members():
+                session.lock()
+                locked.append(session)
+        except InputArbiter.Exception:
+            for session in locked:
+                session.unlock()
+            raise
+
+    def unlock(self):
+        for session in self.sessions.values():
+            session.unlock()
+
+    def close(self):
+        self.closed = True
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+class InputArbiters():
+    """
+    Keeps an InputArbiter for each gadget that has input sessions, for the
+    control server and passthroughs to share
+
+    Keyword arguments:
+    loop -- The event loop to send input from
+    devices -- The dict of RelayDevices that can be sent input
+    groups -- The dict of BroadcastGroups that can be sent input
+    """
+    def __init__(self, loop, devices, groups):
+        self.loop = loop
+        self.devices = devices
+        self.groups = groups
+        self.arbiters = dict()
+
+    def session(self, target, name, priority=PRIORITY_BATCH):
+        """
+        Start a new session sending input to target: a GroupSession if it's a
+        broadcast group, otherwise an InputSession
+        """
+        if target in self.groups:
+            return GroupSession(self, target, name, priority)
+
+        return self.device_session(target, name, priority)
+
+    def device_session(self, target, name, priority=PRIORITY_BATCH):
+        """ Start a new InputSession sending input to the gadget target """
+        arbiter = self.arbiters.get(target)
+        if arbiter is None:
+            arbiter = InputArbiter(self.loop, target, self)
+            self.arbiters[target] = arbiter
+
+        return arbiter.session(name, priority)
+
+    def _remove(self, arbiter):
+        if self.arbiters.get(arbiter.name) is arbiter:
+            del self.arbiters[arbiter.name]
+        arbiter.close()
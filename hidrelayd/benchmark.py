@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Benchmarks for the gadget setup and report paths, run against a fake configfs
+tree in a temporary directory and named pipes standing in for the hidg nodes,
+so they can be run on any machine without touching real USB hardware.
+
+Usage: python3 hidrelayd/benchmark.py [-g GADGETS] [-n REPORTS] [-s]
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from time import perf_counter, perf_counter_ns
+
+import usb_gadget
+from usb_gadget import UsbGadget, hidg_monitor
+from ghid import Keyboard, Mouse
+from metrics import FunctionStats
+
+class FakeConfigfs():
+    """
+    Just enough of the os module for usb_gadget to treat a normal directory as
+    if it were configfs: directories get created along with their default
+    groups, removing a directory removes its attributes along with it, and
+    each new HID function gets a named pipe standing in for its hidg node.
+    Gadgets can be created from several threads at once, like the daemon
+    does at startup.
+    """
+    HIDG_MAJOR = 240
+
+    def __init__(self, root):
+        self.root = root
+        self.hidg_nodes = list()
+        self._minor = 0
+        self._minor_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def mkdir(self, path):
+        os.makedirs(path)
+        if os.path.dirname(path) == self.root:
+            # New gadgets start out unbound
+            open(path + '/UDC', 'w').close()
+            return
+        if os.path.basename(os.path.dirname(path)) != 'functions':
+            return
+
+        # Emulate the char dev the kernel would create for the function
+        with self._minor_lock:
+            minor = self._minor
+            self._minor += 1
+        node = '%s/hidg%d' % (self.root, minor)
+        os.mkfifo(node)
+        with open(path + '/dev', 'w') as dev:
+            dev.write('%d:%d\n' % (self.HIDG_MAJOR, minor))
+        hidg_monitor.nodes[os.makedev(self.HIDG_MAJOR, minor)] = node
+
+        # Keep the pipe open for reading so the writer never sees EPIPE
+        self.hidg_nodes.append(os.open(node, os.O_RDONLY | os.O_NONBLOCK))
+
+    def rmdir(self, path):
+        for parent, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                os.remove(parent + '/' + name)
+            if parent != path:
+                os.rmdir(parent)
+
+        os.rmdir(path)
+
+def percentile(samples, pct):
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+def report_times(name, samples, unit='ms', scale=1e3):
+    samples = sorted(samples)
+    print('%-28s p50 %8.3f%s  p99 %8.3f%s  max %8.3f%s' % (
+        name, percentile(samples, 50) * scale, unit,
+        percentile(samples, 99) * scale, unit, samples[-1] * scale, unit))
+
+def drain(fds):
+    for fd in fds:
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+def bench_setup(root, loop, count, stats):
+    gadgets = list()
+    devices = list()
+    times = list()
+    for i in range(count):
+        start = perf_counter()
+        gadget = UsbGadget('bench%d' % i, configfs_root=root)
+        keyboard = Keyboard(gadget, loop)
+        mouse = Mouse(gadget, loop)
+        gadget.bind('dummy_udc.%d' % i)
+        times.append(perf_counter() - start)
+
+        if stats:
+            keyboard.function.stats = FunctionStats()
+            mouse.function.stats = FunctionStats()
+
+        gadgets.append(gadget)
+        devices.append((keyboard, mouse))
+
+    report_times('gadget setup', times)
+    return gadgets, devices
+
+def bench_reports(loop, devices, nodes, count):
+    keyboard, mouse = devices[0]
+    latencies = list()
+
+    def send(i):
+        if i & 1:
+            keyboard.set_pressed(0, [0x04 + (i & 0xf)])
+        else:
+            mouse.move(1, -1)
+
+    # Warm up, so we're not measuring the first connection to the nodes
+    for i in range(64):
+        send(i)
+    loop.run_until_complete(asyncio.sleep(0))
+    drain(nodes)
+
+    start = perf_counter()
+    for i in range(count):
+        t = perf_counter_ns()
+        send(i)
+        latencies.append((perf_counter_ns() - t) / 1e9)
+        if i % 256 == 255:
+            drain(nodes)
+            loop.run_until_complete(asyncio.sleep(0))
+    elapsed = perf_counter() - start
+
+    print('%-28s %8.0f reports/s' % ('report throughput', count / elapsed))
+    report_times('per-report write latency', latencies, 'us', 1e6)
+
+    text = 'The quick brown fox jumps over the lazy dog\n' * 16
+    keyboard.type_text(text)
+    start = perf_counter()
+    for i in range(16):
+        keyboard.type_text(text)
+        drain(nodes)
+        loop.run_until_complete(asyncio.sleep(0))
+    elapsed = perf_counter() - start
+    print('%-28s %8.0f chars/s' % ('type_text throughput',
+                                    len(text) * 16 / elapsed))
+
+    latencies.clear()
+    for i in range(count // 64):
+        t = perf_counter_ns()
+        mouse.move_by(3840, -2160)
+        latencies.append((perf_counter_ns() - t) / 1e9)
+        drain(nodes)
+        loop.run_until_complete(asyncio.sleep(0))
+    report_times('move_by(3840, -2160)', latencies, 'us', 1e6)
+
+def bench_allocations(loop, devices, nodes, count):
+    keyboard, mouse = devices[0]
+    getallocatedblocks = sys.getallocatedblocks
+
+    def measure(send):
+        """
+        Count the blocks each call to send() leaves allocated, with the GC off
+        so it can't free anything in the middle of a call
+        """
+        blocks = 0
+        gc.disable()
+        try:
+            for i in range(count):
+                before = getallocatedblocks()
+                send()
+                blocks += getallocatedblocks() - before
+                if i % 256 == 255:
+                    drain(nodes)
+                    loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            gc.enable()
+        drain(nodes)
+        loop.run_until_complete(asyncio.sleep(0))
+        return blocks
+
+    # Reading the block count allocates an int of its own, which the noop
+    # round tells us to take off
+    baseline = measure(lambda: None)
+    for name, send in [('keyboard', lambda: keyboard.set_pressed(0, [0x04])),
+                       ('mouse', lambda: mouse.move(1, 1))]:
+        print('%-28s %8.3f blocks' % (
+            'allocs/report (%s)' % name,
+            (measure(send) - baseline) / count))
+
+def bench_teardown(gadgets, devices):
+    times = list()
+    for gadget, (keyboard, mouse) in zip(gadgets, devices):
+        start = perf_counter()
+        keyboard.close()
+        mouse.close()
+        gadget._cleanup_handler()
+        times.append(perf_counter() - start)
+
+    report_times('gadget teardown', times)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark hidrelayd against a fake configfs tree"
+    )
+    parser.add_argument('-g', '--gadgets', type=int, default=8,
+                        help='Number of gadgets to create')
+    parser.add_argument('-n', '--reports', type=int, default=100000,
+                        help='Number of reports to send')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='Collect stats while benchmarking')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='hidrelayd-bench-')
+    fake_configfs = FakeConfigfs(root)
+    usb_gadget.os = fake_configfs
+    loop = asyncio.new_event_loop()
+    try:
+        gadgets, devices = bench_setup(root, loop, args.gadgets,
+                                       args.stats)
+        nodes = fake_configfs.hidg_nodes
+        bench_reports(loop, devices, nodes, args.reports)
+        bench_allocations(loop, devices, nodes, args.reports // 10)
+        bench_teardown(gadgets, devices)
+    finally:
+        usb_gadget.os = os
+        loop.close()
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+from logging import debug, error
+
+from ghid import Device
+
+class BroadcastFunction():
+    """
+    Stands in for the HidFunction of a Keyboard or Mouse, writing each report
+    it's given to the HID functions of every member of a broadcast group. The
+    report is only encoded once, and the same buffer is queued on each member,
+    so a member whose host is lagging behind just builds up its own queue
+    without holding up the rest of the group.
+
+    Keyword arguments:
+    loop -- The event loop the members are driven from
+    members -- A dict of member names to the HidFunction to write to
+    """
+    """ How many queued reports before a member is considered lagging """
+    LAG_THRESHOLD = 16
+
+    def __init__(self, loop, members):
+        self.loop = loop
+        self.members = members
+        self.on_output_report = None
+        self.stats = None
+        self._errors = dict.fromkeys(members, None)
+
+    @property
+    def poll_interval(self):
+        """ The poll interval of the slowest member """
+        return max(function.poll_interval
+                   for function in self.members.values())
+
+    @property
+    def queue_depth(self):
+        return max(function.queue_depth for function in self.members.values())
+
+    def _send(self, name, send, *args):
+        # One member failing mustn't keep the report from the rest of them
+        try:
+            send(*args)
+            self._errors[name] = None
+        except (Device.GadgetUnboundError, OSError) as e:
+            if self._errors[name] is None:
+                error('Broadcast member %s: %s' % (name, e))
+            self._errors[name] = str(e)
+
+    def write(self, report, merge=None):
+        report = bytes(report)
+        for name, function in self.members.items():
+            self._send(name, function.write, report, merge)
+
+    def write_many(self, reports, report_length):
+        reports = bytes(reports)
+        for name, function in self.members.items():
+            self._send(name, function.write_many, reports, report_length)
+
+    def connect(self):
+        pass
+
+    def close(self):
+        # The members belong to their relay devices, so leave them be
+        pass
+
+    def status(self):
+        """
+        Return a dict with the status of each member: whether the last write
+        to it failed and why, how many reports it has queued, and whether it's
+        lagging behind the rest of the group
+        """
+        return {
+            name: {
+                'error': self._errors[name],
+                'queue_depth': function.queue_depth,
+                'lagging': function.queue_depth > self.LAG_THRESHOLD,
+            } for name, function in self.members.items()
+        }
+
+class BroadcastGroup():
+    """
+    A named group of relay devices that all get sent the same input. The
+    keyboard, mouse and consumer attributes act just like the devices on a
+    single relay device, but write to every member that has one.
+
+    Keyword arguments:
+    name -- The name of the group
+    members -- A dict of member names to RelayDevices
+    loop -- The event loop the members are driven from
+    """
+    def __init__(self, name, members, loop):
+        self.name = name
+        self.members = members
+        self.keyboard = self._create_device(
+            loop, {name: device.keyboard for name, device in members.items()
+                   if device.keyboard})
+        self.mouse = self._create_device(
+            loop, {name: device.mouse for name, device in members.items()
+                   if device.mouse})
+        self.consumer = self._create_device(
+            loop, {name: device.consumer for name, device in members.items()
+                   if device.consumer})
+
+    def _create_device(self, loop, devices):
+        if not devices:
+            return None
+
+        device_cls = type(next(iter(devices.values())))
+        debug('%s: broadcasting %s to %s' % (self.name, device_cls.__name__,
+                                             ', '.join(devices)))
+        function = BroadcastFunction(
+            loop, {name: device.function for name, device in devices.items()})
+        return device_cls(None, loop, function)
+
+    def status(self):
+        """
+        Return the status of each member's keyboard, mouse and consumer
+        control (see BroadcastFunction.status())
+        """
+        status = dict()
+        for function_name, device in [('keyboard', self.keyboard),
+                                      ('mouse', self.mouse),
+                                      ('consumer', self.consumer)]:
+            if device:
+                status[function_name] = device.function.status()
+
+        return status
@@ -22,24 +22,63 @@
 #   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
 
 import configparser
+import io
 import os
-from usb_gadget import UsbGadget, UsbProtocolVersion
+from collections import namedtuple
+from usb_gadget import UsbGadget, UsbProtocolVersion, CONFIGFS_ROOT
+
+""" The configuration of a single gadget, which can be compared to a new one """
+GadgetSpec = namedtuple('GadgetSpec', [
+    'name', 'usb_version', 'vendor_id', 'product_id', 'serial',
+    'manufacturer', 'product', 'udc_device', 'keyboard_mode', 'mouse_mode',
+    'consumer', 'composite', 'poll_interval'
+])
+
+""" The configuration of a passthrough from local input devices """
+PassthroughSpec = namedtuple('PassthroughSpec', [
+    'name', 'devices', 'target', 'grab'
+])
 
 class DaemonConfig(configparser.ConfigParser):
     DEFAULTS = {
-        'debug': False,
+        'debug':              False,
+        'configfs_root':      CONFIGFS_ROOT,
+        'stats_socket':       '',
+        'control_socket':     '',
+        'control_address':    '',
+        'ring_dir':           '',
+        'macro_dir':          '',
+        'persistent_gadgets': False,
+        'workers':            False,
     }
     GADGET_DEFAULTS = {
-        'has_keyboard': True,
-        'has_mouse':    True,
-        'usb_version':  1.1,
-        'vendor_id':    0xa4ac,
-        'product_id':   0x0525,
-        'serial':       '1337beef',
-        'manufacturer': 'hidrelayd',
-        'product':      'Remote HID device'
+        'has_keyboard':  True,
+        'has_mouse':     True,
+        'has_consumer':  False,
+        'composite':     False,
+        'keyboard_mode': 'boot',
+        'mouse_mode':    'relative',
+        'poll_interval': 0,
+        'usb_version':   1.1,
+        'vendor_id':     0xa4ac,
+        'product_id':    0x0525,
+        'serial':        '1337beef',
+        'manufacturer':  'hidrelayd',
+        'product':       'Remote HID device',
+        'cpus':          '',
+    }
+
+    POOL_DEFAULTS = {
+        'size': 1,
+    }
+
+    PASSTHROUGH_DEFAULTS = {
+        'grab': True,
     }
 
+    KEYBOARD_MODES = ['boot', 'nkro']
+    MOUSE_MODES = ['relative', 'absolute']
+
     def __init__(self):
         super().__init__()
 
@@ -53,35 +92,249 @@ class DaemonConfig(configparser.ConfigParser):
             if not self.has_option('hidrelayd', option):
                 self.set('hidrelayd', option, str(self.DEFAULTS[option]))
 
+        if self.get('hidrelayd', 'control_address'):
+            self.get_control_address()
+
         has_at_least_one_gadget = False
 
         for section in self.sections():
             if section.startswith("gadget:"):
                 has_at_least_one_gadget = True
+                self._check_gadget(section, 'gadget')
 
-                gadget_name = section.split(":")[1]
-                if gadget_name == "":
-                    raise configparser.Error(
-                        "Empty gadget name for section %s" % section)
+            elif section.startswith("pool:"):
+                # Pooled gadgets can be attached on demand, so a config with
+                # only pools is fine
+                has_at_least_one_gadget = True
+                self._check_pool(section)
 
-                for option in self.GADGET_DEFAULTS:
-                    if not self.has_option(section, option):
-                        self.set(section, option,
-                                 str(self.GADGET_DEFAULTS[option]))
+            elif section.startswith("group:"):
+                self._check_group(section)
 
-                # We can't have a gadget configuration with no devices
-                if self.getboolean(section, 'has_keyboard') == False and \
-                   self.getboolean(section, 'has_mouse') == False:
-                    raise configparser.Error(
-                        "Gadget '%s' must have at least one mouse or keyboard" %
-                        gadget_name)
+            elif section.startswith("passthrough:"):
+                self._check_passthrough(section)
 
             elif section != "hidrelayd":
                 raise configparser.Error("Unknown section '%s'" % section)
 
         if not has_at_least_one_gadget:
             raise configparser.Error(
-                "Must have at least one USB gadget specified in the config")
+                "Must have at least one USB gadget or pool specified in the "
+                "config")
+
+        if self.getboolean('hidrelayd', 'workers'):
+            self._check_workers()
+
+    def _check_workers(self):
+        # Workers only know about their own gadget, so anything spanning
+        # gadgets has to live in the supervisor
+        for section in self.sections():
+            if section.startswith("pool:"):
+                raise configparser.Error("Pools can't be used with workers")
+
+            if section.startswith("passthrough:") and \
+               not self.has_section("gadget:" + self.get(section, 'target')):
+                raise configparser.Error(
+                    "Passthrough '%s' must target a gadget when using "
+                    "workers" % section.split(":")[1])
+
+    def _check_gadget(self, section, kind):
+        gadget_name = section.split(":")[1]
+        if gadget_name == "":
+            raise configparser.Error(
+                "Empty %s name for section %s" % (kind, section))
+
+        for option in self.GADGET_DEFAULTS:
+            if not self.has_option(section, option):
+                self.set(section, option, str(self.GADGET_DEFAULTS[option]))
+
+        # We can't have a gadget configuration with no devices
+        if self.getboolean(section, 'has_keyboard') == False and \
+           self.getboolean(section, 'has_mouse') == False and \
+           self.getboolean(section, 'has_consumer') == False:
+            raise configparser.Error(
+                "%s '%s' must have at least one mouse, keyboard or consumer "
+                "control" % (kind.capitalize(), gadget_name))
+
+        keyboard_mode = self.get(section, 'keyboard_mode')
+        if keyboard_mode not in self.KEYBOARD_MODES:
+            raise configparser.Error(
+                "Invalid keyboard mode '%s' for %s '%s'" % (
+                    keyboard_mode, kind, gadget_name))
+
+        mouse_mode = self.get(section, 'mouse_mode')
+        if mouse_mode not in self.MOUSE_MODES:
+            raise configparser.Error(
+                "Invalid mouse mode '%s' for %s '%s'" % (
+                    mouse_mode, kind, gadget_name))
+
+        poll_interval = self.getfloat(section, 'poll_interval')
+        if poll_interval < 0:
+            raise configparser.Error(
+                "Invalid poll interval '%s' for %s '%s'" % (
+                    poll_interval, kind, gadget_name))
+
+        self.get_cpus(section)
+
+    def _check_pool(self, section):
+        self._check_gadget(section, 'pool')
+        if self.has_option(section, 'udc_device'):
+            raise configparser.Error(
+                "Pool '%s' can't have a udc_device, gadgets are bound when "
+                "they're attached" % section.split(":")[1])
+
+        for option in self.POOL_DEFAULTS:
+            if not self.has_option(section, option):
+                self.set(section, option, str(self.POOL_DEFAULTS[option]))
+
+        if self.getint(section, 'size') < 0:
+            raise configparser.Error(
+                "Invalid size '%s' for pool '%s'" % (
+                    self.get(section, 'size'), section.split(":")[1]))
+
+    def _check_group(self, section):
+        group_name = section.split(":")[1]
+        if group_name == "":
+            raise configparser.Error("Empty group name for section %s" % section)
+
+        members = self.get_group_members(section)
+        if not members:
+            raise configparser.Error(
+                "Broadcast group '%s' must have at least one gadget" %
+                group_name)
+
+        for member in members:
+            if not self.has_section("gadget:" + member):
+                raise configparser.Error(
+                    "Unknown gadget '%s' in broadcast group '%s'" % (
+                        member, group_name))
+
+        # Every member has to take the same reports, since they're only
+        # encoded once for the whole group
+        for function, mode in [('keyboard', 'keyboard_mode'),
+                               ('mouse', 'mouse_mode')]:
+            modes = set()
+            for member in members:
+                member_section = "gadget:" + member
+                # Member sections might not have their defaults filled in yet
+                if self.getboolean(member_section, 'has_' + function,
+                                   fallback=True):
+                    modes.add(self.get(member_section, mode,
+                                       fallback=self.GADGET_DEFAULTS[mode]))
+
+            if len(modes) > 1:
+                raise configparser.Error(
+                    "Gadgets in broadcast group '%s' must all use the same %s"
+                    % (group_name, mode))
+
+    def _check_passthrough(self, section):
+        name = section.split(":")[1]
+        if name == "":
+            raise configparser.Error(
+                "Empty passthrough name for section %s" % section)
+
+        for option in self.PASSTHROUGH_DEFAULTS:
+            if not self.has_option(section, option):
+                self.set(section, option,
+                         str(self.PASSTHROUGH_DEFAULTS[option]))
+
+        if not self.get_passthrough_devices(section):
+            raise configparser.Error(
+                "Passthrough '%s' must have at least one input device" % name)
+
+        target = self.get(section, 'target', fallback='')
+        if not self.has_section("gadget:" + target) and \
+           not self.has_section("group:" + target):
+            raise configparser.Error(
+                "Unknown gadget or group '%s' for passthrough '%s'" % (
+                    target, name))
+
+    def get_passthrough_devices(self, section):
+        """
+        Get the paths of the input devices in a passthrough configuration
+        section
+        """
+        return [path.strip() for path in
+                self.get(section, 'devices', fallback='').split(',')
+                if path.strip()]
+
+    def get_cpus(self, section):
+        """
+        Parse the CPUs a gadget's worker is pinned to, a list like 0,2-3, into
+        a set. Returns None if it isn't pinned.
+        """
+        cpus = set()
+        value = self.get(section, 'cpus')
+        try:
+            for cpu_range in value.split(','):
+                if not cpu_range.strip():
+                    continue
+
+                first, _, last = cpu_range.partition('-')
+                cpus.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise configparser.Error(
+                "Invalid CPU list '%s' in section '%s'" % (value, section))
+
+        return cpus or None
+
+    def get_worker_config(self, name):
+        """
+        Get the DaemonConfig for the worker serving the gadget called name:
+        just that gadget and the passthroughs to it. The supervisor handles
+        control clients and broadcast groups, and each worker gets its own
+        stats socket with the gadget name appended to the path.
+        """
+        sections = ['hidrelayd', 'gadget:' + name] + [
+            section for section in self.sections()
+            if section.startswith('passthrough:') and
+            self.get(section, 'target') == name
+        ]
+        worker_config = configparser.ConfigParser(interpolation=None)
+        for section in sections:
+            worker_config[section] = {
+                option: self.get(section, option, raw=True)
+                for option in self.options(section)
+            }
+
+        daemon = worker_config['hidrelayd']
+        daemon['control_socket'] = ''
+        daemon['control_address'] = ''
+        if daemon['stats_socket']:
+            daemon['stats_socket'] += '.' + name
+
+        # Going through the parser again fills in and checks everything the
+        # same way as the full config
+        f = io.StringIO()
+        worker_config.write(f)
+        f.seek(0)
+        config = DaemonConfig()
+        config.read_file(f, '<worker %s>' % name)
+        return config
+
+    def get_group_members(self, section):
+        """
+        Get the names of the gadgets in a broadcast group configuration section
+        """
+        return [member.strip() for member in
+                self.get(section, 'gadgets', fallback='').split(',')
+                if member.strip()]
+
+    def get_control_address(self):
+        """
+        Parse the TCP address to listen for control clients on into a
+        (host, port) tuple, or None if there isn't one
+        """
+        address = self.get('hidrelayd', 'control_address')
+        if not address:
+            return None
+
+        try:
+            host, port = address.rsplit(':', 1)
+            return (host.strip('[]'), int(port))
+        except ValueError:
+            raise configparser.Error(
+                "Invalid control address '%s'" % address)
 
     def get_usb_version(self, section):
         """
@@ -93,6 +346,61 @@ class DaemonConfig(configparser.ConfigParser):
         except Exception:
             raise configparser.Error(
                 "Invalid USB protocol revision '%s' in section '%s'" % (
-                    version_str, section))
+                    self.get(section, 'usb_version'), section))
 
         return usb_version
+
+    def get_gadget_spec(self, section):
+        """
+        Get the GadgetSpec for a gadget or pool configuration section. The
+        keyboard or mouse mode is None if the gadget doesn't have one, and
+        pooled gadgets don't have a UDC.
+        """
+        return GadgetSpec(
+            name=section.split(':')[1],
+            usb_version=self.get_usb_version(section),
+            vendor_id=self.getint(section, 'vendor_id'),
+            product_id=self.getint(section, 'product_id'),
+            serial=self.get(section, 'serial'),
+            manufacturer=self.get(section, 'manufacturer'),
+            product=self.get(section, 'product'),
+            udc_device=self.get(section, 'udc_device')
+                       if section.startswith('gadget:') else None,
+            keyboard_mode=self.get(section, 'keyboard_mode')
+                          if self.getboolean(section, 'has_keyboard') else None,
+            mouse_mode=self.get(section, 'mouse_mode')
+                       if self.getboolean(section, 'has_mouse') else None,
+            consumer=self.getboolean(section, 'has_consumer'),
+            composite=self.getboolean(section, 'composite'),
+            poll_interval=self.getfloat(section, 'poll_interval'))
+
+    def get_gadget_specs(self):
+        """ Get a dict of gadget names to the GadgetSpec for each gadget """
+        specs = dict()
+        for section in self.sections():
+            if section.startswith('gadget:'):
+                spec = self.get_gadget_spec(section)
+                specs[spec.name] = spec
+
+        return specs
+
+    def get_pool_specs(self):
+        """
+        Get a dict of pool names to a (GadgetSpec, size) tuple for each pool
+        """
+        return {section.split(':')[1]: (self.get_gadget_spec(section),
+                                        self.getint(section, 'size'))
+                for section in self.sections() if section.startswith('pool:')}
+
+    def get_passthrough_specs(self):
+        """
+        Get a dict of passthrough names to the PassthroughSpec for each
+        passthrough
+        """
+        return {section.split(':')[1]: PassthroughSpec(
+                    name=section.split(':')[1],
+                    devices=tuple(self.get_passthrough_devices(section)),
+                    target=self.get(section, 'target'),
+                    grab=self.getboolean(section, 'grab'))
+                for section in self.sections()
+                if section.startswith('passthrough:')}
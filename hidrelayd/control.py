@@ -0,0 +1,658 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+A compact binary protocol for controlling relay devices remotely, served over
+UNIX and/or TCP sockets.
+
+Every message starts with a header (all integers are big endian):
+  Length (2 bytes) -- The length of the rest of the message
+  Opcode (1 byte)
+  Function (1 byte) -- FUNCTION_KEYBOARD, FUNCTION_MOUSE or FUNCTION_CONSUMER
+  Target length (1 byte)
+  Target (utf-8) -- The name of the gadget or broadcast group to send to
+followed by the payload for the opcode:
+  OP_RAW      -- One or more pre-encoded reports, back to back
+  OP_SET      -- Keyboard: modifier mask (1 byte) followed by usages (1 byte
+                 each). Mouse: button mask (1 byte). Consumer control: usage
+                 (2 bytes), or 0 for none
+  OP_PRESS    -- Keyboard: usages to press (1 byte each, modifiers included).
+                 Mouse: button mask to press (1 byte). Consumer control: usage
+                 (2 bytes)
+  OP_RELEASE  -- Same as OP_PRESS, but releases. Consumer control: no payload
+  OP_TYPE     -- Layout name length (1 byte), layout name, utf-8 text
+  OP_MOVE     -- Relative mouse: dx, dy (2 bytes each, signed), and optionally
+                 a duration in milliseconds (2 bytes)
+  OP_MOVE_TO  -- Absolute mouse: x, y (2 bytes each)
+  OP_RECORD   -- Start recording a macro from the gadget, no payload
+  OP_RECORD_STOP -- Stop recording, and save the macro as the utf-8 name given
+  OP_REPLAY   -- Replay speed in percent (2 bytes), utf-8 macro name
+  OP_ATTACH   -- utf-8 pool name, a NUL byte, and the utf-8 name of the UDC to
+                 attach a gadget from the pool to. The target is the name of
+                 the new session, which can be sent input like any gadget.
+  OP_DETACH   -- Release the target session's gadget back to its pool, no
+                 payload
+  OP_HOLD     -- Duration in milliseconds (4 bytes), then Keyboard: usage to
+                 hold down (1 byte). Mouse: button mask to hold down (1 byte)
+  OP_REPEAT   -- Keyboard: interval and duration in milliseconds (2 and 4
+                 bytes), then the usage to tap every interval (1 byte)
+  OP_PRIORITY -- PRIORITY_BATCH or PRIORITY_INTERACTIVE (1 byte)
+  OP_LOCK     -- Only let our input to the target through, no payload
+  OP_UNLOCK   -- No payload
+The function is ignored for the macro, pool, priority and lock opcodes.
+
+Each connection gets its own input session for each target it sends input
+to (see arbitration.py), so clients don't release each other's keys. Sessions
+start out with batch priority, and anything the client held down is released
+when it disconnects. Macros are replayed straight to the gadget.
+
+Clients don't have to wait for replies between messages. The server handles
+every complete message it has received, and then sends a single reply for the
+whole batch:
+  Length (2 bytes), REPLY_ACK (1 byte), sequence number of the last message
+  handled (4 bytes), number of messages handled (4 bytes)
+preceded by a reply for each message that failed:
+  Length (2 bytes), REPLY_ERROR (1 byte), sequence number (4 bytes), utf-8
+  error message
+Messages are numbered from 0 in the order they're sent on a connection.
+"""
+
+import asyncio
+import os
+import socket
+from logging import debug, exception, info
+from struct import Struct
+
+from arbitration import InputArbiter, InputArbiters, PRIORITY_BATCH, \
+                        PRIORITY_INTERACTIVE
+from ghid import Device
+from macro import MacroError
+from pool import GadgetPools
+from usb_gadget import UsbGadget
+
+OP_RAW = 0x01
+OP_SET = 0x02
+OP_PRESS = 0x03
+OP_RELEASE = 0x04
+OP_TYPE = 0x05
+OP_MOVE = 0x06
+OP_MOVE_TO = 0x07
+OP_RECORD = 0x08
+OP_RECORD_STOP = 0x09
+OP_REPLAY = 0x0a
+OP_ATTACH = 0x0b
+OP_DETACH = 0x0c
+OP_HOLD = 0x0d
+OP_REPEAT = 0x0e
+OP_PRIORITY = 0x0f
+OP_LOCK = 0x10
+OP_UNLOCK = 0x11
+
+FUNCTION_KEYBOARD = 0
+FUNCTION_MOUSE = 1
+FUNCTION_CONSUMER = 2
+
+FUNCTION_NAMES = {
+    FUNCTION_KEYBOARD: 'keyboard',
+    FUNCTION_MOUSE: 'mouse',
+    FUNCTION_CONSUMER: 'consumer',
+}
+
+REPLY_ACK = 0x80
+REPLY_ERROR = 0x81
+
+LENGTH = Struct('!H')
+HEADER = Struct('!HBBB')
+MOVE = Struct('!hh')
+MOVE_DURATION = Struct('!hhH')
+MOVE_TO = Struct('!HH')
+USAGE = Struct('!H')
+REPLAY = Struct('!H')
+HOLD = Struct('!I')
+REPEAT = Struct('!HI')
+ACK = Struct('!HBII')
+ERROR = Struct('!HBI')
+
+MAX_MESSAGE_LENGTH = 0xffff
+
+class ProtocolError(Exception):
+    pass
+
+def encode_message(op, target, function, payload=b''):
+    """ Encode a message for the control protocol """
+    target = target.encode()
+    length = HEADER.size - LENGTH.size + len(target) + len(payload)
+    if length > MAX_MESSAGE_LENGTH:
+        raise ProtocolError('Message too long')
+
+    return HEADER.pack(length, op, function, len(target)) + target + \
+        bytes(payload)
+
+def decode_text(payload, what):
+    """
+    Decode the utf-8 text in a payload, raising a ProtocolError naming what
+    it was if it isn't valid
+    """
+    try:
+        return bytes(payload).decode()
+    except UnicodeDecodeError:
+        raise ProtocolError('%s must be utf-8' % what)
+
+def encode_error(seq, message):
+    """ Encode the error reply for message number seq, message is bytes """
+    return ERROR.pack(ERROR.size - LENGTH.size + len(message), REPLY_ERROR,
+                      seq) + message
+
+def encode_ack(seq, count):
+    """ Encode the ack for a batch of count messages ending with seq """
+    return ACK.pack(ACK.size - LENGTH.size, REPLY_ACK, seq, count)
+
+class ControlProtocol(asyncio.Protocol):
+    """
+    Handles the messages from a single control client
+
+    Keyword arguments:
+    devices -- The dict of RelayDevices that can be sent input
+    groups -- The dict of BroadcastGroups that can be sent input
+    arbiters -- The InputArbiters to start input sessions from
+    macros -- The MacroLibrary to record and replay macros with, if any
+    pools -- The GadgetPools to attach sessions from, if any
+    """
+    def __init__(self, devices, groups, arbiters, macros=None, pools=None):
+        self.devices = devices
+        self.groups = groups
+        self.arbiters = arbiters
+        self.macros = macros
+        self.pools = pools
+        self.transport = None
+        self.name = 'control client'
+        self._sessions = dict()
+        self._buf = b''
+        self._seq = 0
+        self._handlers = {
+            OP_RAW: self._raw,
+            OP_SET: self._set,
+            OP_PRESS: self._press,
+            OP_RELEASE: self._release,
+            OP_TYPE: self._type,
+            OP_MOVE: self._move,
+            OP_MOVE_TO: self._move_to,
+            OP_HOLD: self._hold,
+            OP_REPEAT: self._repeat,
+        }
+        self._session_handlers = {
+            OP_PRIORITY: self._priority,
+            OP_LOCK: self._lock,
+            OP_UNLOCK: self._unlock,
+        }
+        self._macro_handlers = {
+            OP_RECORD: self._record,
+            OP_RECORD_STOP: self._record_stop,
+            OP_REPLAY: self._replay,
+        }
+        self._pool_handlers = {
+            OP_ATTACH: self._attach,
+            OP_DETACH: self._detach,
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            self.name = 'control client %s:%d' % peer[:2]
+        debug('%s connected' % self.name)
+
+    def connection_lost(self, exc):
+        debug('%s disconnected' % self.name)
+        self.transport = None
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+    def _find_relay(self, target):
+        relay = self.devices.get(target) or self.groups.get(target)
+        if relay is None:
+            raise ProtocolError("Unknown target '%s'" % target)
+
+        return relay
+
+    def _find_device(self, relay, target, function):
+        name = FUNCTION_NAMES.get(function)
+        if name is None:
+            raise ProtocolError('Unknown function %d' % function)
+
+        device = getattr(relay, name)
+        if device is None:
+            raise ProtocolError("'%s' doesn't have that function" % target)
+
+        return device
+
+    def _session(self, target):
+        session = self._sessions.get(target)
+        if session is None:
+            session = self.arbiters.session(target, self.name)
+            self._sessions[target] = session
+
+        return session
+
+    @staticmethod
+    def _expect(payload, *sizes):
+        """ Make sure a payload is one of the given sizes """
+        if len(payload) not in sizes:
+            raise ProtocolError('Payload length must be %s, not %d' % (
+                ' or '.join(str(size) for size in sizes), len(payload)))
+
+    def _raw(self, session, device, function, payload):
+        size = device.packet.size
+        if not payload or len(payload) % size:
+            raise ProtocolError('Raw reports must be %d bytes long' % size)
+
+        session.write_reports(FUNCTION_NAMES[function], payload)
+
+    def _set(self, session, device, function, payload):
+        if function == FUNCTION_KEYBOARD:
+            if not payload:
+                raise ProtocolError('Missing the modifier mask')
+            session.set_keys(payload[0], list(payload[1:]))
+        elif function == FUNCTION_CONSUMER:
+            self._expect(payload, USAGE.size)
+            session.set_consumer(*USAGE.unpack(payload))
+        else:
+            self._expect(payload, 1)
+            session.set_buttons(payload[0])
+
+    def _press(self, session, device, function, payload):
+        if function == FUNCTION_KEYBOARD:
+            if not payload:
+                raise ProtocolError('No keys to press')
+            session.press_keys(*payload)
+        elif function == FUNCTION_CONSUMER:
+            self._expect(payload, USAGE.size)
+            session.set_consumer(*USAGE.unpack(payload))
+        else:
+            self._expect(payload, 1)
+            session.press_buttons(payload[0])
+
+    def _release(self, session, device, function, payload):
+        if function == FUNCTION_KEYBOARD:
+            if not payload:
+                raise ProtocolError('No keys to release')
+            session.release_keys(*payload)
+        elif function == FUNCTION_CONSUMER:
+            self._expect(payload, 0)
+            session.set_consumer(0)
+        else:
+            self._expect(payload, 1)
+            session.release_buttons(payload[0])
+
+    def _type(self, session, device, function, payload):
+        if function != FUNCTION_KEYBOARD:
+            raise ProtocolError('Only keyboards can type')
+        if not payload or payload[0] >= len(payload):
+            raise ProtocolError('Missing the layout name')
+
+        layout_length = payload[0]
+        layout = decode_text(payload[1:layout_length + 1], 'Layout name')
+        session.type_text(decode_text(payload[layout_length + 1:], 'Text'),
+                          layout)
+
+    def _move(self, session, device, function, payload):
+        if function != FUNCTION_MOUSE:
+            raise ProtocolError('Only mice can be moved')
+        self._expect(payload, MOVE.size, MOVE_DURATION.size)
+
+        if len(payload) == MOVE_DURATION.size:
+            dx, dy, duration = MOVE_DURATION.unpack(payload)
+            session.move(dx, dy, duration=duration / 1000)
+        else:
+            session.move(*MOVE.unpack(payload))
+
+    def _move_to(self, session, device, function, payload):
+        if function != FUNCTION_MOUSE:
+            raise ProtocolError('Only mice can be moved')
+        self._expect(payload, MOVE_TO.size)
+
+        session.move_to(*MOVE_TO.unpack(payload))
+
+    def _hold(self, session, device, function, payload):
+        if function == FUNCTION_CONSUMER:
+            raise ProtocolError("Consumer controls can't be held")
+        self._expect(payload, HOLD.size + 1)
+
+        duration, = HOLD.unpack_from(payload)
+        if function == FUNCTION_KEYBOARD:
+            session.hold_key(payload[HOLD.size], duration / 1000)
+        else:
+            session.hold_buttons(payload[HOLD.size], duration / 1000)
+
+    def _repeat(self, session, device, function, payload):
+        if function != FUNCTION_KEYBOARD:
+            raise ProtocolError('Only keys can be repeated')
+        self._expect(payload, REPEAT.size + 1)
+
+        interval, duration = REPEAT.unpack_from(payload)
+        if not interval:
+            raise ProtocolError('Repeat interval must be greater than 0')
+
+        session.repeat_key(payload[REPEAT.size], interval / 1000,
+                           duration / 1000)
+
+    def _priority(self, session, payload):
+        self._expect(payload, 1)
+        priority = payload[0]
+        if priority not in (PRIORITY_BATCH, PRIORITY_INTERACTIVE):
+            raise ProtocolError('Unknown priority %d' % priority)
+
+        session.set_priority(priority)
+
+    def _lock(self, session, payload):
+        self._expect(payload, 0)
+        session.lock()
+
+    def _unlock(self, session, payload):
+        self._expect(payload, 0)
+        session.unlock()
+
+    def _record(self, target, relay, payload):
+        self._expect(payload, 0)
+        if target not in self.devices:
+            raise ProtocolError("Can't record broadcast group '%s'" % target)
+
+        self.macros.record(target, relay)
+
+    def _record_stop(self, target, relay, payload):
+        self.macros.stop_recording(target,
+                                   decode_text(payload, 'Macro name'))
+
+    def _replay(self, target, relay, payload):
+        if len(payload) < REPLAY.size:
+            raise ProtocolError('Missing the replay speed')
+
+        speed, = REPLAY.unpack_from(payload)
+        if not speed:
+            raise ProtocolError('Replay speed must be greater than 0')
+
+        self.macros.replay(target, relay,
+                           decode_text(payload[REPLAY.size:], 'Macro name'),
+                           speed / 100)
+
+    def _attach(self, target, payload):
+        try:
+            pool, udc_device = decode_text(payload, 'Attach').split('\0')
+        except ValueError:
+            raise ProtocolError('Attach needs a pool and a UDC')
+
+        self.pools.attach(target, pool, udc_device)
+
+    def _detach(self, target, payload):
+        self._expect(payload, 0)
+        self.pools.detach(target)
+
+    def _handle(self, view):
+        length, op, function, target_length = HEADER.unpack_from(view)
+        payload_start = HEADER.size + target_length
+        if payload_start > len(view):
+            raise ProtocolError('Target runs past the end of the message')
+        target = decode_text(view[HEADER.size:payload_start], 'Target')
+
+        # Sessions don't exist until they're attached
+        handler = self._pool_handlers.get(op)
+        if handler is not None:
+            if self.pools is None:
+                raise ProtocolError('Pools are not enabled')
+
+            handler(target, view[payload_start:])
+            return
+
+        relay = self._find_relay(target)
+
+        handler = self._handlers.get(op)
+        if handler is not None:
+            device = self._find_device(relay, target, function)
+            handler(self._session(target), device, function,
+                    view[payload_start:])
+            return
+
+        handler = self._session_handlers.get(op)
+        if handler is not None:
+            handler(self._session(target), view[payload_start:])
+            return
+
+        handler = self._macro_handlers.get(op)
+        if handler is None:
+            raise ProtocolError('Unknown opcode 0x%x' % op)
+        if self.macros is None:
+            raise ProtocolError('Macros are not enabled')
+
+        handler(target, relay, view[payload_start:])
+
+    def data_received(self, data):
+        if self._buf:
+            data = self._buf + data
+        view = memoryview(data)
+        end = len(view)
+
+        offset = 0
+        handled = 0
+        replies = list()
+        while end - offset >= LENGTH.size:
+            length, = LENGTH.unpack_from(view, offset)
+            message_end = offset + LENGTH.size + length
+            if message_end > end:
+                break
+
+            try:
+                if length < HEADER.size - LENGTH.size:
+                    raise ProtocolError('Message too short')
+                self._handle(view[offset:message_end])
+            except (ProtocolError, MacroError, GadgetPools.Exception,
+                    UsbGadget.Exception, InputArbiter.Exception, OSError,
+                    Device.GadgetUnboundError, ValueError) as e:
+                message = (str(e) or type(e).__name__).encode()
+                replies.append(encode_error(self._seq, message))
+            except Exception:
+                # A bug on our end shouldn't cost the client its connection,
+                # or anything it's holding down
+                exception('%s: Failed to handle message %d' % (self.name,
+                                                               self._seq))
+                replies.append(encode_error(self._seq, b'Internal error'))
+
+            self._seq += 1
+            handled += 1
+            offset = message_end
+
+        self._buf = bytes(view[offset:])
+        if handled:
+            replies.append(encode_ack(self._seq - 1, handled))
+            self.transport.write(b''.join(replies))
+
+class ControlServer():
+    """
+    Listens for control clients on a UNIX socket and/or a TCP address.
+
+    Keyword arguments:
+    loop -- The event loop to serve clients from
+    devices -- The dict of RelayDevices that can be sent input
+    groups -- The dict of BroadcastGroups that can be sent input
+    macros -- The MacroLibrary to record and replay macros with, if any
+    pools -- The GadgetPools to attach sessions from, if any
+    path -- The path of the UNIX socket to listen on, if any
+    address -- A (host, port) tuple of the TCP address to listen on, if any
+    arbiters -- The InputArbiters to share with anything else sending input,
+                a new one is created if this isn't given
+    """
+    def __init__(self, loop, devices, groups, macros=None, pools=None,
+                 path=None, address=None, arbiters=None):
+        self.loop = loop
+        self.devices = devices
+        self.groups = groups
+        self.arbiters = arbiters or InputArbiters(loop, devices, groups)
+        self.macros = macros
+        self.pools = pools
+        self.path = path
+        self.address = address
+        self._servers = list()
+
+    def _create_protocol(self):
+        return ControlProtocol(self.devices, self.groups, self.arbiters,
+                               self.macros, self.pools)
+
+    async def start(self):
+        if self.path:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+            self._servers.append(await self.loop.create_unix_server(
+                self._create_protocol, self.path))
+            info('Listening for control clients on %s' % self.path)
+
+        if self.address:
+            server = await self.loop.create_server(self._create_protocol,
+                                                   *self.address)
+            for sock in server.sockets:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._servers.append(server)
+            info('Listening for control clients on %s:%d' % self.address)
+
+    async def add_client(self, sock):
+        """ Serve a control client on a socket that's already connected """
+        await self.loop.connect_accepted_socket(self._create_protocol, sock)
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+        self._servers.clear()
+
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class ControlClient():
+    """
+    A minimal blocking client for the control protocol. Messages are sent
+    without waiting for replies; call read_replies() to collect them.
+
+    Keyword arguments:
+    sock -- A connected socket to the control server
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = b''
+
+    def send(self, op, target, function, payload=b''):
+        self.sock.sendall(encode_message(op, target, function, payload))
+
+    def raw(self, target, function, reports):
+        self.send(OP_RAW, target, function, reports)
+
+    def press(self, target, *keys):
+        self.send(OP_PRESS, target, FUNCTION_KEYBOARD, bytes(keys))
+
+    def release(self, target, *keys):
+        self.send(OP_RELEASE, target, FUNCTION_KEYBOARD, bytes(keys))
+
+    def type_text(self, target, text, layout='us'):
+        layout = layout.encode()
+        self.send(OP_TYPE, target, FUNCTION_KEYBOARD,
+                  bytes([len(layout)]) + layout + text.encode())
+
+    def move(self, target, dx, dy, duration=None):
+        if duration is None:
+            payload = MOVE.pack(dx, dy)
+        else:
+            payload = MOVE_DURATION.pack(dx, dy, int(duration * 1000))
+        self.send(OP_MOVE, target, FUNCTION_MOUSE, payload)
+
+    def move_to(self, target, x, y):
+        self.send(OP_MOVE_TO, target, FUNCTION_MOUSE, MOVE_TO.pack(x, y))
+
+    def press_consumer(self, target, usage):
+        self.send(OP_PRESS, target, FUNCTION_CONSUMER, USAGE.pack(usage))
+
+    def release_consumer(self, target):
+        self.send(OP_RELEASE, target, FUNCTION_CONSUMER)
+
+    def hold(self, target, key, duration):
+        self.send(OP_HOLD, target, FUNCTION_KEYBOARD,
+                  HOLD.pack(int(duration * 1000)) + bytes([key]))
+
+    def hold_button(self, target, btn_mask, duration):
+        self.send(OP_HOLD, target, FUNCTION_MOUSE,
+                  HOLD.pack(int(duration * 1000)) + bytes([btn_mask]))
+
+    def repeat(self, target, key, interval, duration):
+        self.send(OP_REPEAT, target, FUNCTION_KEYBOARD,
+                  REPEAT.pack(int(interval * 1000), int(duration * 1000)) +
+                  bytes([key]))
+
+    def set_priority(self, target, priority):
+        self.send(OP_PRIORITY, target, 0, bytes([priority]))
+
+    def lock(self, target):
+        self.send(OP_LOCK, target, 0)
+
+    def unlock(self, target):
+        self.send(OP_UNLOCK, target, 0)
+
+    def record(self, target):
+        self.send(OP_RECORD, target, 0)
+
+    def record_stop(self, target, name):
+        self.send(OP_RECORD_STOP, target, 0, name.encode())
+
+    def replay(self, target, name, speed=1.0):
+        self.send(OP_REPLAY, target, 0,
+                  REPLAY.pack(int(speed * 100)) + name.encode())
+
+    def attach(self, session, pool, udc_device):
+        self.send(OP_ATTACH, session, 0,
+                  ('%s\0%s' % (pool, udc_device)).encode())
+
+    def detach(self, session):
+        self.send(OP_DETACH, session, 0)
+
+    def read_replies(self):
+        """
+        Wait for the next ack from the server, returning a tuple of the
+        sequence number of the last message it handled and a list of
+        (sequence number, error message) tuples for any that failed
+        """
+        errors = list()
+        while True:
+            while len(self._buf) < LENGTH.size or \
+                  len(self._buf) < LENGTH.size + \
+                  LENGTH.unpack_from(self._buf)[0]:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError('Control server disconnected')
+                self._buf += data
+
+            length, = LENGTH.unpack_from(self._buf)
+            reply = self._buf[:LENGTH.size + length]
+            self._buf = self._buf[LENGTH.size + length:]
+
+            if reply[LENGTH.size] == REPLY_ERROR:
+                _, _, seq = ERROR.unpack_from(reply)
+                errors.append((seq, reply[ERROR.size:].decode()))
+            else:
+                _, _, seq, count = ACK.unpack(reply)
+                return seq, errors
@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+import asyncio
+import configparser
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from logging import debug, info, warning, error
+
+from arbitration import InputArbiters
+from broadcast import BroadcastGroup
+from config import DaemonConfig
+from control import ControlServer
+from macro import MacroLibrary
+from metrics import FunctionStats, PassthroughStats, StatsServer
+from passthrough import Passthrough
+from pool import GadgetPool, GadgetPools
+from relay_device import RelayDevice
+from ring import RingChannel
+from startup import StartupProfile
+from usb_gadget import UsbGadget, hidg_monitor
+
+class Daemon():
+    """
+    The core of hidrelayd: a single asyncio event loop that drives the I/O for
+    every relay device we serve, so that one slow or unplugged host can't hold
+    up input to any of the others.
+
+    Keyword arguments:
+    config -- The DaemonConfig to create relay devices from
+    loop -- The event loop to use, a new one is created if this isn't given
+    config_path -- Where the config was loaded from, so it can be reloaded on
+                   SIGHUP
+    profile -- The StartupProfile to time startup with
+    """
+    """ The most gadgets we'll bring up at the same time """
+    MAX_STARTUP_THREADS = 32
+
+    class StartupError(Exception):
+        pass
+
+    def __init__(self, config, loop=None, config_path=None, profile=None):
+        self.config = config
+        self.config_path = config_path
+        self.profile = profile or StartupProfile()
+        self.loop = loop or asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        hidg_monitor.start(self.loop)
+
+        self.devices = dict()
+        self.groups = dict()
+        self.rings = dict()
+        self.passthroughs = dict()
+        self.arbiters = InputArbiters(self.loop, self.devices, self.groups)
+        self.ring_dir = config.get('hidrelayd', 'ring_dir')
+
+        # Stats are only collected at all if something can read them
+        stats_socket = config.get('hidrelayd', 'stats_socket')
+        if stats_socket:
+            self.stats_server = StatsServer(stats_socket, self.devices,
+                                            self.passthroughs, self.groups)
+        else:
+            self.stats_server = None
+
+        # Pooled gadgets are built along with everything else
+        self.pools = GadgetPools(self.devices, self.groups)
+        pooled = dict()
+        for name, (spec, size) in config.get_pool_specs().items():
+            pool = GadgetPool(name, spec, config, self.loop,
+                              stats=bool(self.stats_server))
+            self.pools.add(pool)
+            for i in range(size):
+                gadget_spec = pool.new_spec()
+                pooled[gadget_spec.name] = (gadget_spec, pool)
+
+        debug('Initializing relay devices...')
+        self._start_devices(config.get_gadget_specs(), pooled)
+        self._create_groups()
+        self._update_passthroughs(config.get_passthrough_specs())
+
+        if self.stats_server:
+            self.loop.run_until_complete(self.stats_server.start())
+
+        macro_dir = config.get('hidrelayd', 'macro_dir')
+        self.macros = MacroLibrary(self.loop, macro_dir) if macro_dir else None
+
+        self.control_server = ControlServer(
+            self.loop, self.devices, self.groups, self.macros, self.pools,
+            path=config.get('hidrelayd', 'control_socket'),
+            address=config.get_control_address(), arbiters=self.arbiters)
+        self.loop.run_until_complete(self.control_server.start())
+
+    def _start_devices(self, specs, pooled):
+        """
+        Bring up all of our gadgets at once. Building the configfs tree and
+        binding are all blocking writes to configfs, and some UDCs are slow to
+        bind, so each gadget gets its own thread. Gadgets that fail are
+        reported and left out, instead of keeping the rest from starting.
+
+        Keyword arguments:
+        specs -- A dict of gadget names to GadgetSpecs
+        pooled -- A dict of gadget names to a (GadgetSpec, GadgetPool) tuple,
+                  for the gadgets to build for each pool
+        """
+        all_specs = dict(specs)
+        all_specs.update({name: spec for name, (spec, pool) in pooled.items()})
+
+        failed = list()
+        with ThreadPoolExecutor(
+            max_workers=max(min(len(all_specs), self.MAX_STARTUP_THREADS), 1),
+            thread_name_prefix='startup'
+        ) as executor:
+            futures = {
+                name: executor.submit(RelayDevice, spec, self.config,
+                                      self.loop, self.profile)
+                for name, spec in all_specs.items()
+            }
+
+        # Anything touching the event loop has to happen from this thread
+        for name, future in futures.items():
+            try:
+                device = future.result()
+                if name not in pooled:
+                    with self.profile.phase('hidg discovery', name):
+                        device.connect()
+            except Exception as e:
+                error('Failed to bring up gadget %s: %s' % (name, e))
+                failed.append(name)
+                continue
+
+            if name in pooled:
+                pooled[name][1].add(device)
+            else:
+                self.devices[name] = device
+                self._device_changed(name)
+
+        if failed:
+            error('%d of %d gadgets failed to start: %s' % (
+                len(failed), len(all_specs), ', '.join(failed)))
+        if all_specs and len(failed) == len(all_specs):
+            raise Daemon.StartupError('No gadgets could be started')
+
+    def _add_device(self, spec):
+        device = RelayDevice(spec, self.config, self.loop)
+        device.connect()
+        self.devices[spec.name] = device
+        self._device_changed(spec.name)
+
+    def _remove_device(self, name):
+        self._close_rings(name)
+        self.devices.pop(name).remove()
+
+    def _close_rings(self, name):
+        for ring in self.rings.pop(name, []):
+            ring.close()
+
+    def _device_changed(self, name):
+        """
+        Hook up the stats and rings for a relay device that was just created,
+        or had its functions replaced
+        """
+        device = self.devices[name]
+        if self.stats_server:
+            for function_name, function in device.functions():
+                if function.stats is None:
+                    function.stats = FunctionStats()
+
+        self._close_rings(name)
+        if self.ring_dir:
+            self.rings[name] = [
+                RingChannel(self.loop, '%s/%s.%s' % (self.ring_dir, name,
+                                                     function_name),
+                            hid_device)
+                for function_name, hid_device in [
+                    ('keyboard', device.keyboard), ('mouse', device.mouse),
+                    ('consumer', device.consumer)
+                ] if hid_device
+            ]
+
+    def _create_groups(self):
+        # Groups are cheap and hold no state of their own, so they're just
+        # recreated from scratch. The dict is updated in place since the
+        # control server shares it.
+        self.groups.clear()
+        for section in self.config.sections():
+            if not section.startswith("group:"):
+                continue
+
+            name = section.split(':')[1]
+            # Skipping any members we failed to create
+            members = {member: self.devices[member]
+                       for member in self.config.get_group_members(section)
+                       if member in self.devices}
+            self.groups[name] = BroadcastGroup(name, members, self.loop)
+
+    def _update_passthroughs(self, specs):
+        """
+        Bring the passthroughs in line with a dict of PassthroughSpecs. Their
+        targets are looked up by name as input comes in, so only passthroughs
+        whose own configuration changed need to be recreated.
+        """
+        for name, passthrough in list(self.passthroughs.items()):
+            if specs.get(name) != passthrough.spec:
+                info('Removing passthrough %s' % name)
+                self.passthroughs.pop(name).close()
+
+        for name, spec in specs.items():
+            if name in self.passthroughs:
+                continue
+
+            passthrough = Passthrough(self.loop, spec, self.arbiters)
+            if self.stats_server:
+                passthrough.stats = PassthroughStats()
+            self.passthroughs[name] = passthrough
+
+    def _read_config(self):
+        """ Read the config back in from config_path """
+        config = DaemonConfig()
+        with open(self.config_path) as f:
+            config.read_file(f, self.config_path)
+        return config
+
+    def reload(self):
+        """
+        Reload the config, and apply it to the running relay devices. Only
+        gadgets that were added, removed or changed are touched, the rest
+        keep serving input throughout.
+        """
+        info('Reloading %s' % self.config_path)
+        try:
+            config = self._read_config()
+            specs = config.get_gadget_specs()
+        except (OSError, configparser.Error) as e:
+            error('Failed to reload config, keeping the old one: %s' % e)
+            return
+
+        if dict(config['hidrelayd']) != dict(self.config['hidrelayd']):
+            warning('Changes to the [hidrelayd] section require a restart')
+            config['hidrelayd'] = self.config['hidrelayd']
+        if config.get_pool_specs() != self.config.get_pool_specs():
+            warning('Changes to pools require a restart')
+
+        self.config = config
+        sessions = self.pools.sessions()
+        for name in dict.fromkeys(list(self.devices) + list(specs)):
+            if name in sessions:
+                if name in specs:
+                    error("Gadget %s conflicts with an attached session, "
+                          "not adding it" % name)
+                continue
+
+            device = self.devices.get(name)
+            old_functions = device.functions() if device else None
+            spec = specs.get(name)
+            try:
+                if spec is None:
+                    info('Removing gadget %s' % name)
+                    self._remove_device(name)
+                elif device is None:
+                    info('Adding gadget %s' % name)
+                    self._add_device(spec)
+                elif device.spec == spec:
+                    continue
+                elif device.reconfigure(spec):
+                    info('Reconfigured gadget %s' % name)
+                    if device.functions() != old_functions:
+                        self._device_changed(name)
+                else:
+                    info('Recreating gadget %s' % name)
+                    self._remove_device(name)
+                    self._add_device(spec)
+            except (OSError, UsbGadget.Exception) as e:
+                error('Failed to apply the new config for gadget %s: %s' % (
+                    name, e))
+
+        self._create_groups()
+        self._update_passthroughs(config.get_passthrough_specs())
+
+    def run(self):
+        """ Serve input to all of our relay devices until we get signalled """
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.add_signal_handler(sig, self.loop.stop)
+        if self.config_path:
+            self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+        info('All relay devices are ready')
+        self.profile.finish()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        for passthrough in self.passthroughs.values():
+            passthrough.close()
+
+        for name in list(self.rings):
+            self._close_rings(name)
+
+        self.control_server.close()
+        if self.macros:
+            self.macros.close()
+        if self.stats_server:
+            self.stats_server.close()
+
+        for device in self.devices.values():
+            device.close()
+
+        hidg_monitor.stop()
+        self.loop.close()
@@ -21,77 +21,545 @@
 # Authors:
 #   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
 
+import asyncio
+import errno
 import os
 import pyudev
 import weakref
 
+from collections import deque
 from enum import Enum
-from struct import Struct
+from itertools import islice, repeat
+from logging import debug, error
+from time import perf_counter
 
-__all__ = ["Keyboard", "Mouse"]
+import keymap
+import timers
+from hiddesc import (Descriptor, Collection, Input, Output, LogicalMaximum,
+                     LogicalMinimum, ReportCount, ReportSize, Usage,
+                     UsageMaximum, UsageMinimum, UsagePage, APPLICATION,
+                     PHYSICAL, CONSTANT, VARIABLE, RELATIVE,
+                     PAGE_GENERIC_DESKTOP, PAGE_KEYBOARD, PAGE_LED,
+                     PAGE_BUTTON, PAGE_CONSUMER)
+from usb_gadget import hidg_monitor
+
+__all__ = ["Keyboard", "NkroKeyboard", "Mouse", "AbsoluteMouse",
+           "ConsumerControl", "CompositeFunction"]
 
 class HidProtocol(Enum):
+    NONE = 0
     KEYBOARD = 1
     MOUSE = 2
 
 class Device():
-    def __init__(self, gadget, protocol):
+    """
+    The base class for HID devices. Each device normally gets its own
+    HidFunction on the gadget, but an existing object with the same write
+    interface can be passed as function instead, in which case gadget may be
+    None and the device's output reports are passed to the function's
+    on_output_report.
+
+    Subclasses describe their reports with a hiddesc.Descriptor, and take
+    HID_DESCRIPTOR and the packet Struct for their input reports from it.
+    """
+    """ Whether the device implements the boot protocol """
+    BOOT_PROTOCOL = True
+
+    def __init__(self, gadget, protocol, loop, on_output_report=None,
+                 function=None):
         self.gadget = gadget
-        self.function = gadget.create_function(protocol, self.packet.size,
-                                               self.HID_DESCRIPTOR)
-        self.char_dev = None
+        if function is None:
+            function = HidFunction(gadget, loop, protocol, self.packet.size,
+                                   self.HID_DESCRIPTOR, on_output_report,
+                                   self.BOOT_PROTOCOL)
+        elif on_output_report is not None:
+            function.on_output_report = on_output_report
+        self.function = function
+        # Reports are packed into here and copied by the function only if
+        # they need to be queued, so writing a report doesn't allocate one
+        self._report = bytearray(self.packet.size)
 
     class GadgetUnboundError(Exception):
         def __init__(self):
             super().__init__("The UsbGadget for this device is not bound to anything")
 
-    def _io_func(func):
-        def func_wrapper(self, *args, **kwargs):
-            if self.char_dev == None or self.char_dev.closed:
+    def connect(self):
+        self.function.connect()
+
+    def close(self):
+        self.function.close()
+
+    def reset(self):
+        """
+        Forget everything we know about the state of the host, e.g. before
+        the device gets bound to a different one
+        """
+        pass
+
+    def track_report(self, report):
+        """
+        Take on the state a report that was written to our function behind our
+        back, like a raw report from a client, left the host in
+        """
+        pass
+
+class HidFunction():
+    """
+    A hidg function on a UsbGadget, along with the char dev the kernel exposes
+    for it once the gadget is bound. The char dev is opened non-blocking and
+    reports are queued until the host has picked up the previous one, so a
+    slow or disconnected host never stalls the event loop.
+
+    Keyword arguments:
+    gadget -- The UsbGadget to create the function on
+    loop -- The asyncio event loop to flush queued reports from
+    protocol -- The HID protocol of the function
+    report_length -- The length of the reports sent to the host
+    report_descriptor -- The HID report descriptor for the function
+    on_output_report -- Called with each output report the host sends us
+    boot_protocol -- Whether the function implements the boot protocol
+
+    If stats is set to a metrics.FunctionStats, it's updated as reports are
+    written. It should be set before the function is used. If recorder is set,
+    it's called with every report sent to the function.
+
+    The host only picks up one report each time it polls us, so anything
+    written faster than that waits in the queue. How often the host polls is
+    learned from how quickly a backlog of reports drains, unless it's set with
+    set_poll_interval(). Reports sent with a merge function can be merged into
+    the report queued ahead of them, so that the host gets the newest state on
+    its next poll instead of working through a backlog.
+    """
+    """ The poll interval we assume until we learn the actual one """
+    DEFAULT_POLL_INTERVAL = 0.004
+    """ The range of poll intervals allowed for interrupt endpoints """
+    MIN_POLL_INTERVAL = 0.000125
+    MAX_POLL_INTERVAL = 0.255
+
+    def __init__(self, gadget, loop, protocol, report_length,
+                 report_descriptor, on_output_report=None, boot_protocol=True):
+        self.gadget = gadget
+        self.loop = loop
+        self.configfs_dir = gadget.create_function(protocol, report_length,
+                                                   report_descriptor,
+                                                   boot_protocol)
+        self.on_output_report = on_output_report
+        self.stats = None
+        self.recorder = None
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL
+        self.char_dev = None
+        self._queue = deque()
+        self._queue_times = deque()
+        self._tail_merge = None
+        self._learn_poll_interval = True
+        self._last_flush_write = None
+        self._writer_fd = None
+        self._reader_fd = None
+        self._device_number = None
+        self._connected = False
+
+    @property
+    def queue_depth(self):
+        """ The number of reports waiting for the host to pick them up """
+        return len(self._queue)
+
+    def set_poll_interval(self, interval):
+        """
+        Set the host's poll interval in seconds, instead of learning it. None
+        goes back to learning it.
+        """
+        if interval is None:
+            self._learn_poll_interval = True
+        else:
+            self._learn_poll_interval = False
+            self.poll_interval = interval
+
+    def connect(self):
+        """
+        Open the char dev for this function, and start listening for output
+        reports from the host. This happens automatically on the first write
+        after the gadget is bound, but output reports won't be received until
+        then unless this is called.
+        """
+        self.close()
+        try:
+            self.char_dev = self.gadget.find_hidg_device(self.configfs_dir)
+        except pyudev.DeviceNotFoundByNumberError:
+            raise Device.GadgetUnboundError()
+
+        if self._connected and self.stats is not None:
+            self.stats.reconnects += 1
+        self._connected = True
+
+        # Stop using the char dev as soon as udev tells us it's gone, so the
+        # next write reconnects to its replacement
+        self._device_number = os.fstat(self.char_dev.fileno()).st_rdev
+        hidg_monitor.watch(self._device_number, self._node_removed)
+
+        if self.on_output_report is not None:
+            self._reader_fd = self.char_dev.fileno()
+            self.loop.add_reader(self._reader_fd, self._read)
+
+    def _start_writer(self):
+        if self._writer_fd is None:
+            self._writer_fd = self.char_dev.fileno()
+            self.loop.add_writer(self._writer_fd, self._flush)
+
+    def _stop_writer(self):
+        if self._writer_fd is not None:
+            self.loop.remove_writer(self._writer_fd)
+            self._writer_fd = None
+
+    def _stop_reader(self):
+        if self._reader_fd is not None:
+            self.loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    def _read(self):
+        try:
+            report = os.read(self._reader_fd, 64)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            error("%s: Failed to read output report: %s" % (
+                self.configfs_dir.path, e.strerror))
+            self.close()
+            return
+
+        self.on_output_report(report)
+
+    def _node_removed(self):
+        debug("%s: hidg node removed" % self.configfs_dir.path)
+        self._device_number = None
+        self.close()
+
+    def _write_failed(self, e):
+        error("%s: Dropping %d queued report(s) after write failure: %s" % (
+            self.configfs_dir.path, len(self._queue) + 1, e.strerror))
+        if self.stats is not None:
+            if e.errno == errno.ESHUTDOWN:
+                self.stats.eshutdown += 1
+            else:
+                self.stats.errors += 1
+
+        self.close()
+
+    def _write_now(self, fd, report):
+        """
+        Try to write a report straight to the char dev, returning False if the
+        host hasn't picked up the last report yet
+        """
+        stats = self.stats
+        if stats is None:
+            try:
+                os.write(fd, report)
+            except BlockingIOError:
+                return False
+            return True
+
+        start = perf_counter()
+        try:
+            os.write(fd, report)
+        except BlockingIOError:
+            stats.eagain += 1
+            return False
+
+        stats.record_write(len(report), perf_counter() - start)
+        return True
+
+    def _flush(self):
+        fd = self.char_dev.fileno()
+        queue = self._queue
+        queue_times = self._queue_times
+        stats = self.stats
+        last_write = self._last_flush_write
+        self._last_flush_write = None
+        while queue:
+            try:
+                os.write(fd, queue[0])
+            except BlockingIOError:
+                if stats is not None:
+                    stats.eagain += 1
+
+                # The host just took the first report we wrote last time we
+                # were here, so the time since then is one poll interval
+                if self._learn_poll_interval:
+                    now = perf_counter()
+                    if last_write is not None:
+                        self._update_poll_interval(now - last_write)
+                    self._last_flush_write = now
+                return
+            except OSError as e:
+                self._write_failed(e)
+                return
+
+            report = queue.popleft()
+            if stats is not None and queue_times:
+                stats.record_write(len(report),
+                                   perf_counter() - queue_times.popleft())
+
+        self._tail_merge = None
+        self._stop_writer()
+
+    def _update_poll_interval(self, sample):
+        sample = min(max(sample, self.MIN_POLL_INTERVAL),
+                     self.MAX_POLL_INTERVAL)
+        self.poll_interval += (sample - self.poll_interval) / 8
+
+    def write(self, report, merge=None):
+        """
+        Send a report to the host. If nothing is queued ahead of the report
+        it's written immediately, otherwise it's queued and written from the
+        event loop once the host has read the reports ahead of it.
+
+        If merge is given and the report queued ahead of this one was also
+        sent with a merge function, merge(queued, report) is called to combine
+        them into a single report. It should return the combined report, or
+        None if they can't be combined without the host missing something.
+        """
+        if self.recorder is not None:
+            self.recorder(report)
+        if self.char_dev is None or self.char_dev.closed:
+            self.connect()
+
+        queue = self._queue
+        if not queue:
+            try:
+                if self._write_now(self.char_dev.fileno(), report):
+                    return
+            except OSError as e:
+                self._write_failed(e)
+                return
+        elif merge is not None and self._tail_merge is not None:
+            merged = merge(queue[-1], report)
+            if merged is not None:
+                queue[-1] = merged
+                if self.stats is not None:
+                    self.stats.coalesced += 1
+                return
+
+        self._tail_merge = merge
+        queue.append(bytes(report))
+        if self.stats is not None:
+            self._queue_times.append(perf_counter())
+        self._start_writer()
+
+    def write_many(self, reports, report_length):
+        """
+        Send a buffer of back to back reports, each report_length bytes long,
+        to the host. The buffer must not be modified afterwards, since the
+        reports that can't be written right away are queued as views into it.
+        """
+        if self.char_dev is None or self.char_dev.closed:
+            self.connect()
+
+        view = memoryview(reports)
+        offsets = range(0, len(view), report_length)
+        if self.recorder is not None:
+            for offset in offsets:
+                self.recorder(view[offset:offset + report_length])
+
+        if not self._queue:
+            fd = self.char_dev.fileno()
+            for offset in offsets:
                 try:
-                    self.char_dev = self.gadget.find_hidg_device(
-                        self.function)
-                except pyudev.DeviceNotFoundByNumberError:
-                    raise Device.GadgetUnboundError()
+                    if not self._write_now(fd,
+                                           view[offset:offset + report_length]):
+                        offsets = range(offset, len(view), report_length)
+                        break
+                except OSError as e:
+                    self._write_failed(e)
+                    return
+            else:
+                return
+
+        self._tail_merge = None
+        self._queue.extend(view[offset:offset + report_length]
+                           for offset in offsets)
+        if self.stats is not None:
+            self._queue_times.extend(repeat(perf_counter(), len(offsets)))
+        self._start_writer()
+
+    def close(self):
+        """ Drop any queued reports and close the char dev, if it's open """
+        self._stop_writer()
+        self._stop_reader()
+        self._queue.clear()
+        self._queue_times.clear()
+        self._tail_merge = None
+        self._last_flush_write = None
+        if self._device_number is not None:
+            hidg_monitor.unwatch(self._device_number, self._node_removed)
+            self._device_number = None
+        if self.char_dev is not None:
+            self.char_dev.close()
+
+def with_report_id(descriptor, report_id):
+    """
+    Add a report ID to a report descriptor containing a single application
+    collection, so it can share a function with other descriptors
+    """
+    start = descriptor.index(b'\xa1\x01') + 2
+    return descriptor[:start] + bytes([0x85, report_id]) + descriptor[start:]
+
+class CompositeFunction(HidFunction):
+    """
+    A single HID function shared by several devices, telling their reports
+    apart with report IDs. This only uses one endpoint and one char dev for
+    all of them, but none of the devices can use the boot protocol.
 
-            return func(self, *args, **kwargs)
-        return func_wrapper
+    Keyword arguments:
+    gadget -- The UsbGadget to create the function on
+    loop -- The asyncio event loop to flush queued reports from
+    device_classes -- A dict of report IDs to the Device subclass that will
+                      use them
+
+    Devices are created on the function with
+    device_cls(gadget, loop, composite.report_function(report_id)).
+    """
+    def __init__(self, gadget, loop, device_classes):
+        descriptor = b''.join(with_report_id(device_cls.HID_DESCRIPTOR,
+                                             report_id)
+                              for report_id, device_cls in
+                              device_classes.items())
+        report_length = max(device_cls.packet.size
+                            for device_cls in device_classes.values()) + 1
+        super().__init__(gadget, loop, HidProtocol.NONE.value, report_length,
+                         descriptor, self._output_report,
+                         boot_protocol=False)
+
+        self._report_functions = {
+            report_id: ReportIdFunction(self, report_id)
+            for report_id in device_classes
+        }
+
+    def report_function(self, report_id):
+        """ Get the function for the device using report_id to write to """
+        return self._report_functions[report_id]
+
+    def _output_report(self, report):
+        report_function = self._report_functions.get(report[0])
+        if report_function and report_function.on_output_report:
+            report_function.on_output_report(report[1:])
+
+class ReportIdFunction():
+    """
+    Stands in for the HidFunction of a device on a CompositeFunction, adding
+    the device's report ID to each report it writes
+    """
+    def __init__(self, function, report_id):
+        self.function = function
+        self.report_id = report_id
+        self.loop = function.loop
+        self.configfs_dir = function.configfs_dir
+        self.on_output_report = None
+        self.recorder = None
+        self._prefix = bytes([report_id])
+        # Reports get copied in behind the report ID, which the function only
+        # copies again if it has to queue them. Devices always write the same
+        # size of report, so this only gets resized once.
+        self._report = bytearray(self._prefix)
+        self._merges = dict()
+
+    @property
+    def poll_interval(self):
+        return self.function.poll_interval
+
+    @property
+    def queue_depth(self):
+        return self.function.queue_depth
+
+    def _merge(self, merge):
+        # Keep one wrapper around for each merge function, rather than
+        # creating a new one for every report
+        try:
+            return self._merges[merge]
+        except KeyError:
+            pass
+
+        prefix = self._prefix
+        def merge_with_id(queued, report):
+            # Reports for other devices share the queue with ours
+            if queued[0] != report[0]:
+                return None
+
+            merged = merge(queued[1:], report[1:])
+            return None if merged is None else prefix + merged
+
+        self._merges[merge] = merge_with_id
+        return merge_with_id
+
+    def write(self, report, merge=None):
+        if self.recorder is not None:
+            self.recorder(report)
+
+        buf = self._report
+        if len(buf) != len(report) + 1:
+            buf = self._report = bytearray(self._prefix + report)
+        else:
+            buf[1:] = report
+
+        self.function.write(buf, self._merge(merge) if merge else None)
+
+    def write_many(self, reports, report_length):
+        if self.recorder is not None:
+            view = memoryview(reports)
+            for offset in range(0, len(view), report_length):
+                self.recorder(view[offset:offset + report_length])
+
+        # Interleave the report ID with the reports a column at a time, which
+        # is much quicker than going report by report
+        count = len(reports) // report_length
+        stride = report_length + 1
+        buf = bytearray(count * stride)
+        buf[0::stride] = self._prefix * count
+        for column in range(report_length):
+            buf[column + 1::stride] = reports[column::report_length]
+
+        self.function.write_many(buf, stride)
+
+    def connect(self):
+        self.function.connect()
+
+    def close(self):
+        self.function.close()
 
 class Keyboard(Device):
-    HID_DESCRIPTOR = bytes([
-        0x05, 0x01, # USAGE_PAGE (Generic Desktop)
-        0x09, 0x06, # USAGE (Keyboard)
-        0xa1, 0x01, # COLLECTION (Application)
-        0x05, 0x07, #   USAGE_PAGE (Keyboard)
-        0x19, 0xe0, #   USAGE_MINIMUM (KB Leftcontrol)
-        0x29, 0xe7, #   USAGE_MAXIMUM (KB Right GUI)
-        0x15, 0x00, #   LOGICAL_MINIMUM (0)
-        0x25, 0x01, #   LOGICAL_MAXIMUM (1)
-        0x75, 0x01, #   REPORT_SIZE (1)
-        0x95, 0x08, #   REPORT_COUNT (8)
-        0x81, 0x02, #   INPUT (Var)
-        0x95, 0x01, #   REPORT_COUNT (1)
-        0x75, 0x08, #   REPORT_SIZE (8)
-        0x81, 0x03, #   INPUT (Cnst, Var)
-        0x95, 0x05, #   REPORT_COUNT (5)
-        0x75, 0x01, #   REPORT_SIZE (1)
-        0x05, 0x08, #   USAGE_PAGE (LED)
-        0x19, 0x01, #   USAGE_MINIMUM (1)
-        0x29, 0x05, #   USAGE_MAXIMUM (5)
-        0x91, 0x02, #   OUTPUT (Var)
-        0x95, 0x01, #   REPORT_COUNT (1)
-        0x75, 0x03, #   REPORT_SIZE (3)
-        0x91, 0x03, #   OUTPUT(Cnst, Var)
-        0x95, 0x06, #   REPORT_COUNT (6)
-        0x75, 0x08, #   REPORT_SIZE (8)
-        0x15, 0x00, #   LOGICAL_MINIMUM (0)
-        0x25, 0x65, #   LOGICAL_MAXIMUM (101)
-        0x05, 0x07, #   USAGE_PAGE (Keyboard)
-        0x19, 0x00, #   USAGE_MINIMUM (None)
-        0x29, 0x65, #   USAGE_MAXIMUM (KB Application)
-        0x81, 0x00, #   INPUT ()
-        0xc0        # END_COLLECTION
-    ])
+    descriptor = Descriptor(
+        UsagePage(PAGE_GENERIC_DESKTOP),
+        Usage(0x06),                            # Keyboard
+        Collection(APPLICATION,
+            UsagePage(PAGE_KEYBOARD),
+            UsageMinimum(0xe0),                 # Left Control
+            UsageMaximum(0xe7),                 # Right GUI
+            LogicalMinimum(0),
+            LogicalMaximum(1),
+            ReportSize(1),
+            ReportCount(8),
+            Input(VARIABLE, 'modifiers'),
+            ReportCount(1),
+            ReportSize(8),
+            Input(CONSTANT | VARIABLE),
+            ReportCount(5),
+            ReportSize(1),
+            UsagePage(PAGE_LED),
+            UsageMinimum(0x01),                 # Num Lock
+            UsageMaximum(0x05),                 # Kana
+            Output(VARIABLE),
+            ReportCount(1),
+            ReportSize(3),
+            Output(CONSTANT | VARIABLE),
+            ReportCount(6),
+            ReportSize(8),
+            LogicalMinimum(0),
+            LogicalMaximum(0x65),
+            UsagePage(PAGE_KEYBOARD),
+            UsageMinimum(0x00),                 # None
+            UsageMaximum(0x65),                 # Application
+            Input(0, 'keys'),
+        )
+    )
+    HID_DESCRIPTOR = descriptor.bytes
 
     class Modifier(Enum):
         LEFT_CTRL   = 0x01
@@ -103,13 +571,60 @@ class Keyboard(Device):
         RIGHT_ALT   = 0x40
         RIGHT_META  = 0x80
 
+    class Led(Enum):
+        NUM_LOCK    = 0x01
+        CAPS_LOCK   = 0x02
+        SCROLL_LOCK = 0x04
+        COMPOSE     = 0x08
+        KANA        = 0x10
+
     MODIFIER_MASK = 0xFF
-    packet = Struct('cx6s')
+    """ The usages for the modifier keys, in the same order as their bits """
+    MODIFIER_USAGES = range(0xe0, 0xe8)
+    MAX_KEYS = 6
+    """ The highest key usage the descriptor lets us report """
+    MAX_USAGE = 0x65
+    SCROLL_LOCK_KEY = 0x47
+    packet = descriptor.input
 
-    def __init__(self, gadget):
-        super().__init__(gadget, HidProtocol.KEYBOARD.value)
+    def __init__(self, gadget, loop, function=None):
+        protocol = HidProtocol.KEYBOARD if self.BOOT_PROTOCOL else \
+            HidProtocol.NONE
+        super().__init__(gadget, protocol.value, loop, self._led_report,
+                         function)
         self.__pressed_keys = []
         self.__modifier_mask = 0
+        self.__leds = 0
+        self.__led_callbacks = list()
+
+    @property
+    def leds(self):
+        """
+        A mask of the Keyboard.Led values the host last told us are lit. This
+        is only kept up to date while we're connected to the host.
+        """
+        return self.__leds
+
+    def add_led_callback(self, cb):
+        """
+        Register a callback to be called as cb(keyboard, leds) whenever the host
+        changes the state of the keyboard LEDs
+        """
+        self.__led_callbacks.append(cb)
+
+    def remove_led_callback(self, cb):
+        self.__led_callbacks.remove(cb)
+
+    def _led_report(self, report):
+        leds = report[-1]
+        if leds == self.__leds:
+            return
+
+        debug("%s: LEDs changed to 0x%x" % (self.function.configfs_dir.path,
+                                           leds))
+        self.__leds = leds
+        for cb in list(self.__led_callbacks):
+            cb(self, leds)
 
     @property
     def pressed_keys(self):
@@ -119,78 +634,688 @@ class Keyboard(Device):
     def modifier_mask(self):
         return self.__modifier_mask
 
-    @Device._io_func
     def set_pressed(self, modifier_mask=0, keys=[]):
         assert not modifier_mask & ~self.MODIFIER_MASK
-        assert len(keys) <= 6
+        assert len(keys) <= self.MAX_KEYS
 
-        self.char_dev.write(self.packet.pack(bytes([modifier_mask]),
-                                             bytes(keys)))
+        self.packet.pack_into(self._report, 0, modifier_mask, bytes(keys))
+        self.function.write(self._report)
         self.__pressed_keys = keys
         self.__modifier_mask = modifier_mask
 
+    def _split_modifiers(self, keys):
+        """
+        Split a list of usages into a mask of the modifier keys in it, and a
+        list of the remaining keys
+        """
+        modifier_mask = 0
+        other_keys = []
+        for key in keys:
+            if key in self.MODIFIER_USAGES:
+                modifier_mask |= 1 << (key - self.MODIFIER_USAGES.start)
+            else:
+                other_keys.append(key)
+
+        return modifier_mask, other_keys
+
+    def press(self, *keys):
+        """
+        Press the given keys, on top of whatever keys are already held down.
+        Modifiers can be pressed by passing their usages (0xe0-0xe7).
+        """
+        modifier_mask, keys = self._split_modifiers(keys)
+        pressed = self.__pressed_keys
+        new_keys = [k for k in keys if k not in pressed]
+        if new_keys or modifier_mask & ~self.__modifier_mask:
+            self.set_pressed(self.__modifier_mask | modifier_mask,
+                             pressed + new_keys)
+
+    def release(self, *keys):
+        """ Release the given keys, leaving any other keys held down """
+        modifier_mask, keys = self._split_modifiers(keys)
+        pressed = self.__pressed_keys
+        remaining = [k for k in pressed if k not in keys]
+        if len(remaining) != len(pressed) or \
+           modifier_mask & self.__modifier_mask:
+            self.set_pressed(self.__modifier_mask & ~modifier_mask, remaining)
+
+    def hold(self, key, duration):
+        """
+        Press a key, and release it again after duration seconds. Returns a
+        future that completes once the key has been released, and cancelling
+        it releases the key early.
+        """
+        return timers.hold(self.function.loop, lambda: self.press(key),
+                           lambda: self.release(key), duration)
+
+    def repeat(self, key, interval, until=None):
+        """
+        Tap a key every interval seconds, until until() returns true or, if
+        until is a number, for that many seconds. Returns a future that
+        completes with the number of taps, and cancelling it stops the taps.
+        """
+        def tap():
+            self.press(key)
+            self.release(key)
+
+        return timers.repeat(self.function.loop, tap, interval, until)
+
+    @classmethod
+    def pack_press(cls, buf, offset, modifier_mask, key):
+        """
+        Pack a report pressing a single key into buf at offset, for building
+        up buffers of precompiled reports
+        """
+        cls.packet.pack_into(buf, offset, modifier_mask, bytes([key]))
+
+    def _clear_state(self):
+        self.__pressed_keys = []
+        self.__modifier_mask = 0
+
+    def track_report(self, report):
+        modifier_mask, keys = self.packet.unpack_from(report)
+        # Usages below 0x04 are errors rather than keys
+        self.__pressed_keys = [key for key in keys if key > 0x03]
+        self.__modifier_mask = modifier_mask
+
+    def reset(self):
+        self._clear_state()
+        self.__leds = 0
+
+    def type_text(self, text, layout='us'):
+        """
+        Type out a string on the host, as if it was typed on a keyboard with
+        the given layout (see keymap.LAYOUTS). The whole string is compiled
+        into a single buffer of press and release reports ahead of time, so
+        this returns as soon as the reports are queued. Any keys that were
+        pressed beforehand are released once the text has been typed. If the
+        host has Caps Lock on, letters are typed with shift inverted so they
+        still come out in the right case.
+
+        Raises a ValueError if the text can't be typed with the layout.
+        """
+        caps_lock = bool(self.__leds & self.Led.CAPS_LOCK.value)
+        reports = keymap.compile_text(text, layout, type(self), caps_lock)
+        self.function.write_many(reports, self.packet.size)
+        self._clear_state()
+
+    async def probe(self, timeout=1.0):
+        """
+        Check whether the host is alive and has enumerated us by tapping Scroll
+        Lock and waiting for the host to update the LEDs, then tapping it again
+        to put things back the way they were. Returns whether or not the host
+        responded before the timeout.
+        """
+        changed = self.function.loop.create_future()
+
+        def led_cb(keyboard, leds):
+            if not changed.done():
+                changed.set_result(leds)
+
+        modifier_mask, keys = self.modifier_mask, self.pressed_keys
+        self.add_led_callback(led_cb)
+        try:
+            self.set_pressed(modifier_mask, keys + [self.SCROLL_LOCK_KEY])
+            self.set_pressed(modifier_mask, keys)
+            await asyncio.wait_for(changed, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.remove_led_callback(led_cb)
+
+        self.set_pressed(modifier_mask, keys + [self.SCROLL_LOCK_KEY])
+        self.set_pressed(modifier_mask, keys)
+        return True
+
+class NkroKeyboard(Keyboard):
+    """
+    A keyboard that reports the state of every key as a bitmap, so that any
+    number of keys can be held down at once and each press or release only
+    costs a single report.
+
+    The first 8 bytes of each report follow the boot keyboard layout, with
+    the first 6 pressed keys (or ErrorRollOver if there's more) in the key
+    array. The descriptor marks them as padding, so hosts using the report
+    protocol only look at the bitmap while BIOSes using the boot protocol only
+    look at the boot report. Firmware that insists on reports being exactly 8
+    bytes long needs keyboard_mode = boot instead.
+
+    Only usages up to MAX_USAGE fit in the bitmap, anything higher raises a
+    ValueError.
+    """
+    descriptor = Descriptor(
+        UsagePage(PAGE_GENERIC_DESKTOP),
+        Usage(0x06),                            # Keyboard
+        Collection(APPLICATION,
+            UsagePage(PAGE_KEYBOARD),
+            UsageMinimum(0xe0),                 # Left Control
+            UsageMaximum(0xe7),                 # Right GUI
+            LogicalMinimum(0),
+            LogicalMaximum(1),
+            ReportSize(1),
+            ReportCount(8),
+            Input(VARIABLE, 'modifiers'),
+            ReportCount(1),
+            ReportSize(8),
+            Input(CONSTANT | VARIABLE),
+            ReportCount(6),
+            Input(CONSTANT | VARIABLE, 'boot_keys'),
+            ReportCount(5),
+            ReportSize(1),
+            UsagePage(PAGE_LED),
+            UsageMinimum(0x01),                 # Num Lock
+            UsageMaximum(0x05),                 # Kana
+            Output(VARIABLE),
+            ReportCount(1),
+            ReportSize(3),
+            Output(CONSTANT | VARIABLE),
+            UsagePage(PAGE_KEYBOARD),
+            UsageMinimum(0x00),                 # None
+            UsageMaximum(0x7f),                 # Mute
+            LogicalMinimum(0),
+            LogicalMaximum(1),
+            ReportSize(1),
+            ReportCount(128),
+            Input(VARIABLE, 'bitmap'),
+        )
+    )
+    HID_DESCRIPTOR = descriptor.bytes
+
+    """
+    Layout:
+      Modifier bitmask (1 byte)
+      Reserved (1 byte)
+      Boot protocol key array (6 bytes)
+      Key bitmap, one bit for each usage from 0x00-0x7f (16 bytes)
+    """
+    packet = descriptor.input
+
+    BITMAP_SIZE = 16
+    MAX_USAGE = 0x7f
+    # Any number of keys can be held down
+    MAX_KEYS = None
+    ROLLOVER_ERROR = bytes([0x01] * 6)
+
+    def __init__(self, gadget, loop, function=None):
+        super().__init__(gadget, loop, function)
+        self.__bitmap = bytearray(self.BITMAP_SIZE)
+        # Pressed keys in the order they were pressed, for the boot report
+        self.__keys = dict()
+        self.__modifier_mask = 0
+
+    @property
+    def pressed_keys(self):
+        return list(self.__keys)
+
+    @property
+    def modifier_mask(self):
+        return self.__modifier_mask
+
+    def __write(self):
+        keys = self.__keys
+        if len(keys) <= 6:
+            boot_keys = bytes(islice(keys, 6))
+        else:
+            boot_keys = self.ROLLOVER_ERROR
+
+        self.packet.pack_into(self._report, 0, self.__modifier_mask,
+                              boot_keys, self.__bitmap)
+        self.function.write(self._report)
+
+    def _check_usages(self, keys):
+        for key in keys:
+            if not 0 <= key <= self.MAX_USAGE:
+                raise ValueError('Usage 0x%x is out of range for an NKRO '
+                                 'keyboard' % key)
+
+    def set_pressed(self, modifier_mask=0, keys=[]):
+        assert not modifier_mask & ~self.MODIFIER_MASK
+        self._check_usages(keys)
+
+        self.__bitmap[:] = bytes(self.BITMAP_SIZE)
+        self.__keys = dict()
+        self.__modifier_mask = modifier_mask
+        for key in keys:
+            self.__bitmap[key >> 3] |= 1 << (key & 7)
+            self.__keys[key] = None
+
+        self.__write()
+
+    def press(self, *keys):
+        modifier_mask, keys = self._split_modifiers(keys)
+        self._check_usages(keys)
+        bitmap = self.__bitmap
+        changed = modifier_mask & ~self.__modifier_mask
+        for key in keys:
+            bit = 1 << (key & 7)
+            if not bitmap[key >> 3] & bit:
+                bitmap[key >> 3] |= bit
+                self.__keys[key] = None
+                changed = True
+
+        if changed:
+            self.__modifier_mask |= modifier_mask
+            self.__write()
+
+    def release(self, *keys):
+        modifier_mask, keys = self._split_modifiers(keys)
+        self._check_usages(keys)
+        bitmap = self.__bitmap
+        changed = modifier_mask & self.__modifier_mask
+        for key in keys:
+            bit = 1 << (key & 7)
+            if bitmap[key >> 3] & bit:
+                bitmap[key >> 3] &= ~bit
+                del self.__keys[key]
+                changed = True
+
+        if changed:
+            self.__modifier_mask &= ~modifier_mask
+            self.__write()
+
+    def is_pressed(self, key):
+        return 0 <= key <= self.MAX_USAGE and \
+            bool(self.__bitmap[key >> 3] & (1 << (key & 7)))
+
+    @classmethod
+    def pack_press(cls, buf, offset, modifier_mask, key):
+        bitmap = bytearray(cls.BITMAP_SIZE)
+        bitmap[key >> 3] = 1 << (key & 7)
+        cls.packet.pack_into(buf, offset, modifier_mask, bytes([key]), bitmap)
+
+    def _clear_state(self):
+        self.__bitmap[:] = bytes(self.BITMAP_SIZE)
+        self.__keys = dict()
+        self.__modifier_mask = 0
+
+    def track_report(self, report):
+        modifier_mask, _, bitmap = self.packet.unpack_from(report)
+        self.__bitmap[:] = bitmap
+        self.__keys = dict.fromkeys(
+            key for key in range(0x04, self.MAX_USAGE + 1)
+            if bitmap[key >> 3] & (1 << (key & 7)))
+        self.__modifier_mask = modifier_mask
+
+def button_mask(buttons, valid_mask):
+    """
+    Turn a Mouse.Button or a mask of them into a mask, raising a ValueError
+    if it has any buttons outside of valid_mask
+    """
+    if isinstance(buttons, Mouse.Button):
+        return buttons.value
+
+    if buttons & ~valid_mask:
+        raise ValueError('Unknown mouse buttons in 0x%x' % buttons)
+    return buttons
+
 class Mouse(Device):
-    HID_DESCRIPTOR = bytes([
-        0x05, 0x01, # USAGE_PAGE (Generic Desktop)
-        0x09, 0x02, # USAGE (Mouse)
-        0xa1, 0x01, # COLLECTION (Application)
-        0x09, 0x01, #   USAGE (Pointer)
-        0xa1, 0x00, #   COLLECTION (Physical)
-        0x05, 0x09, #     USAGE_PAGE (Button)
-        0x19, 0x01, #     USAGE_MINIMUM (Button 1)
-        0x29, 0x03, #     USAGE_MAXIMUM (Button 3)
-        0x15, 0x00, #     LOGICAL_MINIMUM (0)
-        0x25, 0x01, #     LOGICAL_MAXIMUM (1)
-        0x95, 0x03, #     REPORT_COUNT (3)
-        0x75, 0x01, #     REPORT_SIZE (1)
-        0x81, 0x02, #     INPUT (Data,Var,Abs)
-        0x95, 0x01, #     REPORT_COUNT (1)
-        0x75, 0x05, #     REPORT_SIZE (5)
-        0x81, 0x03, #     INPUT (Cnst,Var,Abs)
-        0x05, 0x01, #     USAGE_PAGE (Generic Desktop)
-        0x09, 0x30, #     USAGE (X)
-        0x09, 0x31, #     USAGE (Y)
-        0x15, 0x81, #     LOGICAL_MINIMUM (-127)
-        0x25, 0x7f, #     LOGICAL_MAXIMUM (127)
-        0x75, 0x08, #     REPORT_SIZE (8)
-        0x95, 0x02, #     REPORT_COUNT (2)
-        0x81, 0x06, #     INPUT (Data,Var,Rel)
-        0xc0,       #   END_COLLECTION
-        0xc0        # END_COLLECTION
-    ])
+    descriptor = Descriptor(
+        UsagePage(PAGE_GENERIC_DESKTOP),
+        Usage(0x02),                            # Mouse
+        Collection(APPLICATION,
+            Usage(0x01),                        # Pointer
+            Collection(PHYSICAL,
+                UsagePage(PAGE_BUTTON),
+                UsageMinimum(1),
+                UsageMaximum(3),
+                LogicalMinimum(0),
+                LogicalMaximum(1),
+                ReportCount(3),
+                ReportSize(1),
+                Input(VARIABLE, 'buttons'),
+                ReportCount(1),
+                ReportSize(5),
+                Input(CONSTANT | VARIABLE),
+                UsagePage(PAGE_GENERIC_DESKTOP),
+                Usage(0x30),                    # X
+                Usage(0x31),                    # Y
+                LogicalMinimum(-127),
+                LogicalMaximum(127),
+                ReportSize(8),
+                ReportCount(2),
+                Input(VARIABLE | RELATIVE, ('x', 'y')),
+            )
+        )
+    )
+    HID_DESCRIPTOR = descriptor.bytes
 
     """
     Layout:
       Button bitmask (1 byte)
-      X-translation (1 byte)
-      Y-translation (1 byte)
+      X-translation (1 byte, signed)
+      Y-translation (1 byte, signed)
     """
-    packet = Struct('ccc')
+    packet = descriptor.input
 
-    def Button(Enum):
+    class Button(Enum):
         LEFT   = (1 << 0)
         RIGHT  = (1 << 1)
         MIDDLE = (1 << 2)
 
     BUTTON_MASK = 0x7
+    MAX_DELTA = 127
 
-    def __init__(self, gadget):
-        super().__init__(gadget, HidProtocol.MOUSE.value)
+    def __init__(self, gadget, loop, function=None):
+        super().__init__(gadget, HidProtocol.MOUSE.value, loop,
+                         function=function)
         self.__btn_mask = 0
 
+    def reset(self):
+        self.__btn_mask = 0
+
+    def track_report(self, report):
+        self.__btn_mask = report[0] & self.BUTTON_MASK
+
     @property
     def btn_mask(self):
         return self.__btn_mask
 
-    @Device._io_func
     def set_pressed(self, btn_mask=0):
         assert not btn_mask & ~self.BUTTON_MASK
 
-        self.char_dev.write(self.packet.pack(bytes([btn_mask]),
-                                             bytes([0]), bytes([0])))
+        self.packet.pack_into(self._report, 0, btn_mask, 0, 0)
+        self.function.write(self._report)
         self.__btn_mask = btn_mask
 
-    @Device._io_func
-    def move(self, x, y):
-        self.char_dev.write(self.packet.pack(bytes([self.__btn_mask]),
-                                             bytes([x]), bytes([y])))
+    def hold(self, button, duration):
+        """
+        Press a button, either a Button or a mask of them, and release it
+        again after duration seconds. Returns a future that completes once the
+        button has been released, and cancelling it releases the button early.
+        Raises a ValueError for buttons we don't have.
+        """
+        btn_mask = button_mask(button, self.BUTTON_MASK)
+        return timers.hold(
+            self.function.loop,
+            lambda: self.set_pressed(self.__btn_mask | btn_mask),
+            lambda: self.set_pressed(self.__btn_mask & ~btn_mask), duration)
+
+    def move(self, x, y, btn_mask=None):
+        """
+        Move the pointer by (x, y) with a single report. If btn_mask is given,
+        the buttons are changed in the same report.
+        """
+        assert abs(x) <= self.MAX_DELTA and abs(y) <= self.MAX_DELTA
+
+        if btn_mask is None:
+            btn_mask = self.__btn_mask
+        assert not btn_mask & ~self.BUTTON_MASK
+
+        self.packet.pack_into(self._report, 0, btn_mask, x, y)
+        self.function.write(self._report, self._merge_moves)
+        self.__btn_mask = btn_mask
+
+    @classmethod
+    def _merge_moves(cls, queued, report):
+        queued_btn_mask, queued_x, queued_y = cls.packet.unpack(queued)
+        btn_mask, x, y = cls.packet.unpack(report)
+        x += queued_x
+        y += queued_y
+        if btn_mask != queued_btn_mask or \
+           abs(x) > cls.MAX_DELTA or abs(y) > cls.MAX_DELTA:
+            return None
+
+        return cls.packet.pack(btn_mask, x, y)
+
+    def _pack_moves(self, dx, dy, count):
+        """
+        Pack a movement of (dx, dy) split as evenly as possible across count
+        reports into a single buffer
+        """
+        size = self.packet.size
+        buf = bytearray(size * count)
+        pack_into = self.packet.pack_into
+        btn_mask = self.__btn_mask
+
+        last_x = last_y = 0
+        for i in range(1, count + 1):
+            x = dx * i // count
+            y = dy * i // count
+            pack_into(buf, (i - 1) * size, btn_mask, x - last_x, y - last_y)
+            last_x, last_y = x, y
+
+        return buf
+
+    def move_by(self, dx, dy, duration=None):
+        """
+        Move the pointer by an arbitrary amount. Movements too large to fit
+        into a single report are split into the fewest reports possible and
+        written all at once.
+
+        If a duration (in seconds) is given, the movement is instead spread out
+        evenly over that amount of time, one batch of reports each time the
+        host polls us. In that case a future is returned that completes once
+        the last report has been queued, and cancelling it stops the movement
+        where it is.
+        """
+        max_delta = self.MAX_DELTA
+        count = max(-(-abs(dx) // max_delta), -(-abs(dy) // max_delta))
+        size = self.packet.size
+        loop = self.function.loop
+
+        if duration is None:
+            if count:
+                self.function.write_many(self._pack_moves(dx, dy, count),
+                                         size)
+            return None
+
+        interval = self.function.poll_interval
+        ticks = max(round(duration / interval), 1)
+        count = max(count, ticks)
+        reports = self._pack_moves(dx, dy, count)
+        done = loop.create_future()
+
+        # Use absolute deadlines so that scheduling delays don't add up
+        start = loop.time()
+        def write_batch(tick):
+            if done.cancelled():
+                return
+
+            start_report = count * tick // ticks
+            end_report = count * (tick + 1) // ticks
+            try:
+                self.function.write_many(
+                    memoryview(reports)[start_report * size:end_report * size],
+                    size)
+            except Exception as e:
+                done.set_exception(e)
+                return
+
+            if tick + 1 == ticks:
+                done.set_result(None)
+            else:
+                loop.call_at(start + (tick + 1) * interval, write_batch,
+                             tick + 1)
+
+        write_batch(0)
+        return done
+
+class AbsoluteMouse(Device):
+    """
+    A pointing device that reports absolute coordinates, like a tablet. This
+    lets us put the pointer anywhere on the host's screen with a single report,
+    without having to worry about pointer acceleration. Coordinates are scaled
+    by the host to the size of its screen, with (0, 0) being the top left
+    corner and (MAX_COORD, MAX_COORD) being the bottom right.
+    """
+    descriptor = Descriptor(
+        UsagePage(PAGE_GENERIC_DESKTOP),
+        Usage(0x02),                            # Mouse
+        Collection(APPLICATION,
+            Usage(0x01),                        # Pointer
+            Collection(PHYSICAL,
+                UsagePage(PAGE_BUTTON),
+                UsageMinimum(1),
+                UsageMaximum(3),
+                LogicalMinimum(0),
+                LogicalMaximum(1),
+                ReportCount(3),
+                ReportSize(1),
+                Input(VARIABLE, 'buttons'),
+                ReportCount(1),
+                ReportSize(5),
+                Input(CONSTANT | VARIABLE),
+                UsagePage(PAGE_GENERIC_DESKTOP),
+                Usage(0x30),                    # X
+                Usage(0x31),                    # Y
+                LogicalMinimum(0, size=2),
+                LogicalMaximum(0x7fff),
+                ReportSize(16),
+                ReportCount(2),
+                Input(VARIABLE, ('x', 'y')),
+            )
+        )
+    )
+    HID_DESCRIPTOR = descriptor.bytes
+
+    """
+    Layout:
+      Button bitmask (1 byte)
+      X-coordinate (2 bytes, little endian)
+      Y-coordinate (2 bytes, little endian)
+    """
+    packet = descriptor.input
+
+    Button = Mouse.Button
+    BUTTON_MASK = Mouse.BUTTON_MASK
+    MAX_COORD = 0x7fff
+    BOOT_PROTOCOL = False
+
+    def __init__(self, gadget, loop, function=None):
+        super().__init__(gadget, HidProtocol.NONE.value, loop,
+                         function=function)
+        self.__btn_mask = 0
+        self.__x = 0
+        self.__y = 0
+
+    def reset(self):
+        self.__btn_mask = 0
+        self.__x = 0
+        self.__y = 0
+
+    def track_report(self, report):
+        btn_mask, self.__x, self.__y = self.packet.unpack_from(report)
+        self.__btn_mask = btn_mask & self.BUTTON_MASK
+
+    @property
+    def btn_mask(self):
+        return self.__btn_mask
+
+    @property
+    def position(self):
+        """ The last (x, y) coordinates we moved the pointer to """
+        return (self.__x, self.__y)
+
+    def set_pressed(self, btn_mask=0):
+        assert not btn_mask & ~self.BUTTON_MASK
+
+        self.packet.pack_into(self._report, 0, btn_mask, self.__x, self.__y)
+        self.function.write(self._report)
+        self.__btn_mask = btn_mask
+
+    def hold(self, button, duration):
+        """
+        Press a button, either a Button or a mask of them, and release it
+        again after duration seconds. Returns a future that completes once the
+        button has been released, and cancelling it releases the button early.
+        Raises a ValueError for buttons we don't have.
+        """
+        btn_mask = button_mask(button, self.BUTTON_MASK)
+        return timers.hold(
+            self.function.loop,
+            lambda: self.set_pressed(self.__btn_mask | btn_mask),
+            lambda: self.set_pressed(self.__btn_mask & ~btn_mask), duration)
+
+    def move_to(self, x, y):
+        """ Move the pointer to the given coordinates with a single report """
+        assert 0 <= x <= self.MAX_COORD and 0 <= y <= self.MAX_COORD
+
+        self.packet.pack_into(self._report, 0, self.__btn_mask, x, y)
+        self.function.write(self._report, self._merge_moves)
+        self.__x = x
+        self.__y = y
+
+    @classmethod
+    def _merge_moves(cls, queued, report):
+        # Only the newest position matters, as long as the buttons match
+        if queued[0] != report[0]:
+            return None
+
+        return bytes(report)
+
+class ConsumerControl(Device):
+    """
+    The media keys found on a lot of keyboards, like play/pause and volume
+    up. Only one usage can be pressed at a time.
+    """
+    descriptor = Descriptor(
+        UsagePage(PAGE_CONSUMER),
+        Usage(0x01),                            # Consumer Control
+        Collection(APPLICATION,
+            LogicalMinimum(0),
+            LogicalMaximum(0x3ff),
+            UsageMinimum(0x000),                # Unassigned
+            UsageMaximum(0x3ff),
+            ReportSize(16),
+            ReportCount(1),
+            Input(0, 'usage'),
+        )
+    )
+    HID_DESCRIPTOR = descriptor.bytes
+
+    """
+    Layout:
+      Pressed usage, or 0 for none (2 bytes, little endian)
+    """
+    packet = descriptor.input
+
+    class Usage(Enum):
+        SCAN_NEXT     = 0xb5
+        SCAN_PREVIOUS = 0xb6
+        STOP          = 0xb7
+        PLAY_PAUSE    = 0xcd
+        MUTE          = 0xe2
+        VOLUME_UP     = 0xe9
+        VOLUME_DOWN   = 0xea
+
+    MAX_USAGE = 0x3ff
+    BOOT_PROTOCOL = False
+
+    def __init__(self, gadget, loop, function=None):
+        super().__init__(gadget, HidProtocol.NONE.value, loop,
+                         function=function)
+        self.__usage = 0
+
+    def reset(self):
+        self.__usage = 0
+
+    def track_report(self, report):
+        self.__usage, = self.packet.unpack_from(report)
+
+    @property
+    def usage(self):
+        """ The usage that's currently pressed, or 0 """
+        return self.__usage
+
+    def set_pressed(self, usage=0):
+        assert 0 <= usage <= self.MAX_USAGE
+
+        self.packet.pack_into(self._report, 0, usage)
+        self.function.write(self._report)
+        self.__usage = usage
+
+    def press(self, usage):
+        self.set_pressed(usage)
+
+    def release(self):
+        self.set_pressed(0)
+
+    def tap(self, usage):
+        """ Press and release a usage """
+        assert 0 < usage <= self.MAX_USAGE
+
+        # The release report is all zeroes
+        reports = bytearray(self.packet.size * 2)
+        self.packet.pack_into(reports, 0, usage)
+        self.function.write_many(reports, self.packet.size)
+        self.__usage = 0
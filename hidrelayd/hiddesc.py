@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+from struct import Struct
+
+# Usage pages
+PAGE_GENERIC_DESKTOP = 0x01
+PAGE_KEYBOARD        = 0x07
+PAGE_LED             = 0x08
+PAGE_BUTTON          = 0x09
+PAGE_CONSUMER        = 0x0c
+
+# Collection types
+PHYSICAL    = 0x00
+APPLICATION = 0x01
+
+# Flags for Input and Output, anything not set here defaults to 0 (data,
+# array, absolute)
+CONSTANT = 0x01
+VARIABLE = 0x02
+RELATIVE = 0x04
+
+""" The size bits of an item's prefix for each length of data """
+DATA_SIZES = {0: 0, 1: 1, 2: 2, 4: 3}
+""" The Struct format for each size of integer field """
+INT_FORMATS = {8: 'B', 16: 'H', 32: 'I'}
+
+class Item():
+    """
+    A short item in a report descriptor. The data is encoded in as few bytes
+    as possible unless size is given, since some hosts are picky about how
+    certain items are encoded.
+    """
+    """ The prefix of the item, without the size bits """
+    PREFIX = None
+    SIGNED = False
+
+    def __init__(self, data, size=None):
+        self.data = data
+        self.size = size
+
+    def __bytes__(self):
+        if self.data is None:
+            return bytes([self.PREFIX])
+
+        if self.size is not None:
+            sizes = [self.size]
+        else:
+            sizes = [1, 2, 4]
+
+        for size in sizes:
+            try:
+                data = self.data.to_bytes(size, 'little', signed=self.SIGNED)
+                break
+            except OverflowError:
+                pass
+        else:
+            raise ValueError('%d is too large for the item' % self.data)
+
+        return bytes([self.PREFIX | DATA_SIZES[size]]) + data
+
+    def walk(self):
+        yield self
+
+class UsagePage(Item):
+    PREFIX = 0x04
+
+class LogicalMinimum(Item):
+    PREFIX = 0x14
+    SIGNED = True
+
+class LogicalMaximum(Item):
+    PREFIX = 0x24
+    SIGNED = True
+
+class ReportSize(Item):
+    PREFIX = 0x74
+
+class ReportCount(Item):
+    PREFIX = 0x94
+
+class Usage(Item):
+    PREFIX = 0x08
+
+class UsageMinimum(Item):
+    PREFIX = 0x18
+
+class UsageMaximum(Item):
+    PREFIX = 0x28
+
+class Input(Item):
+    """ An input field, which gets packed as name unless it's padding """
+    PREFIX = 0x80
+
+    def __init__(self, flags=0, name=None):
+        super().__init__(flags)
+        self.name = name
+
+class Output(Item):
+    PREFIX = 0x90
+
+class EndCollection(Item):
+    PREFIX = 0xc0
+
+    def __init__(self):
+        super().__init__(None)
+
+class Collection(Item):
+    """ A collection of type collection_type, containing items """
+    PREFIX = 0xa0
+
+    def __init__(self, collection_type, *items):
+        super().__init__(collection_type)
+        self.items = items
+
+    def walk(self):
+        yield self
+        for item in self.items:
+            yield from item.walk()
+        yield EndCollection()
+
+class Descriptor():
+    """
+    A report descriptor compiled from items. bytes is the encoded descriptor,
+    and input is a little endian Struct that packs the fields of the input
+    report from arguments in the order the fields were declared in. Their
+    names end up in fields.
+
+    Whole byte fields are packed from integers, which are signed if the
+    field's logical minimum is negative. An array of 8-bit values with a single
+    name is packed from bytes instead, while a tuple of names gives each value
+    its own integer. Fields smaller than a byte get packed along with whatever
+    padding follows them as a single unsigned integer (or bytes, if that
+    doesn't come out to 1, 2 or 4 bytes), so they must start on a byte
+    boundary.
+    """
+    def __init__(self, *items):
+        self.items = items
+        encoded = bytearray()
+        formats = list()
+        fields = list()
+        report_size = report_count = logical_minimum = 0
+        # Sub-byte fields get gathered up until the next byte boundary
+        bit_count = 0
+        bit_field = None
+
+        for item in (i for item in items for i in item.walk()):
+            encoded += bytes(item)
+            if isinstance(item, ReportSize):
+                report_size = item.data
+            elif isinstance(item, ReportCount):
+                report_count = item.data
+            elif isinstance(item, LogicalMinimum):
+                logical_minimum = item.data
+            if not isinstance(item, Input):
+                continue
+
+            name = item.name
+            if not bit_count and report_size in INT_FORMATS:
+                if name is None:
+                    formats.append('%dx' % (report_size * report_count // 8))
+                    continue
+
+                fmt = INT_FORMATS[report_size]
+                if logical_minimum < 0:
+                    fmt = fmt.lower()
+
+                if not isinstance(name, str):
+                    if len(name) != report_count:
+                        raise ValueError('%d names given for %d values' %
+                                         (len(name), report_count))
+                    formats.append(fmt * report_count)
+                    fields.extend(name)
+                    continue
+                elif report_count == 1:
+                    formats.append(fmt)
+                elif report_size == 8:
+                    formats.append('%ds' % report_count)
+                else:
+                    raise ValueError('%s needs a name for each value' % name)
+                fields.append(name)
+                continue
+
+            if name is not None:
+                if bit_count:
+                    raise ValueError("%s doesn't start on a byte boundary" %
+                                     name)
+                bit_field = name
+            bit_count += report_size * report_count
+            if bit_count % 8:
+                continue
+
+            if bit_field is None:
+                formats.append('%dx' % (bit_count // 8))
+            else:
+                formats.append(INT_FORMATS.get(bit_count,
+                                               '%ds' % (bit_count // 8)))
+                fields.append(bit_field)
+            bit_count = 0
+            bit_field = None
+
+        if bit_count:
+            raise ValueError("The input report isn't a whole number of bytes")
+
+        self.bytes = bytes(encoded)
+        self.input = Struct('<' + ''.join(formats))
+        self.fields = tuple(fields)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Keyboard layout tables, used to translate text into the HID usages that need
+to be pressed on the host in order to type it out.
+"""
+
+from functools import lru_cache
+
+SHIFT = 0x02 # Keyboard.Modifier.LEFT_SHIFT
+ALTGR = 0x40 # Keyboard.Modifier.RIGHT_ALT
+
+# The HID usages for each row of keys on a 105 key ISO keyboard, from left to
+# right. ANSI keyboards are missing the 0x32 and 0x64 keys, and have 0x31 at
+# the end of the top letter row instead.
+ROW_E = [0x35, 0x1e, 0x1f, 0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27,
+         0x2d, 0x2e]
+ROW_D = [0x14, 0x1a, 0x08, 0x15, 0x17, 0x1c, 0x18, 0x0c, 0x12, 0x13, 0x2f,
+         0x30]
+ROW_C = [0x04, 0x16, 0x07, 0x09, 0x0a, 0x0b, 0x0d, 0x0e, 0x0f, 0x33, 0x34,
+         0x32]
+ROW_B = [0x64, 0x1d, 0x1b, 0x06, 0x19, 0x05, 0x11, 0x10, 0x36, 0x37, 0x38]
+ROW_B_ANSI = ROW_B[1:]
+
+# Keys that type the same thing regardless of the layout
+COMMON = {
+    '\n': (0, 0x28), # Enter
+    '\t': (0, 0x2b), # Tab
+    ' ':  (0, 0x2c), # Space
+}
+
+# Each layout is a list of (usages, plain, shifted, altgr) rows. A '\0' means
+# the key doesn't type anything directly in that position (e.g. it's a dead
+# key), so we never try to use it.
+LAYOUT_ROWS = {
+    'us': [
+        (ROW_E,      "`1234567890-=", "~!@#$%^&*()_+", ""),
+        (ROW_D,      "qwertyuiop[]",  "QWERTYUIOP{}",  ""),
+        ([0x31],     "\\",            "|",             ""),
+        (ROW_C,      "asdfghjkl;'",   "ASDFGHJKL:\"",  ""),
+        (ROW_B_ANSI, "zxcvbnm,./",    "ZXCVBNM<>?",    ""),
+    ],
+    'uk': [
+        (ROW_E, "`1234567890-=", "¬!\"£$%^&*()_+", "¦\0\0\0€"),
+        (ROW_D, "qwertyuiop[]",  "QWERTYUIOP{}",   "\0\0é\0\0\0úíó"),
+        (ROW_C, "asdfghjkl;'#",  "ASDFGHJKL:@~",   "á"),
+        (ROW_B, "\\zxcvbnm,./",  "|ZXCVBNM<>?",    ""),
+    ],
+    'de': [
+        (ROW_E, "\0001234567890ß\0", "°!\"§$%&/()=?\0",
+                "\0\0²³\0\0\0{[]}\\"),
+        (ROW_D, "qwertzuiopü+",      "QWERTZUIOPÜ*",  "@\0€\0\0\0\0\0\0\0\0~"),
+        (ROW_C, "asdfghjklöä#",      "ASDFGHJKLÖÄ'",  ""),
+        (ROW_B, "<yxcvbnm,.-",       ">YXCVBNM;:_",   "|\0\0\0\0\0\0µ"),
+    ],
+    'fr': [
+        (ROW_E, "²&é\"'(-è_çà)=", "\0001234567890°+",
+                "\0\0\0#{[|\0\\^@]}"),
+        (ROW_D, "azertyuiop\0$",  "AZERTYUIOP\0£",  "\0\0€\0\0\0\0\0\0\0\0¤"),
+        (ROW_C, "qsdfghjklmù*",   "QSDFGHJKLM%µ",   ""),
+        (ROW_B, "<wxcvbn,;:!",    ">WXCVBN?./§",    ""),
+    ],
+}
+
+def _build_layout(rows):
+    layout = dict(COMMON)
+    for usages, *levels in rows:
+        for modifiers, chars in zip([0, SHIFT, ALTGR], levels):
+            for usage, char in zip(usages, chars):
+                if char != '\0' and char not in layout:
+                    layout[char] = (modifiers, usage)
+
+    return layout
+
+"""
+A mapping of layout names to tables of characters, and the (modifier mask,
+usage) needed to type each of them with that layout
+"""
+LAYOUTS = {name: _build_layout(rows) for name, rows in LAYOUT_ROWS.items()}
+
+def _find_letters(rows, layout):
+    letters = set()
+    for usages, plain, shifted, *_ in rows:
+        for usage, lower, upper in zip(usages, plain, shifted):
+            if lower != upper and lower.upper() == upper and \
+               layout[lower] == (0, usage) and layout[upper] == (SHIFT, usage):
+                letters.update((lower, upper))
+
+    return frozenset(letters)
+
+"""
+A mapping of layout names to the characters typed by letter keys, the only
+keys Caps Lock has any effect on. Keys like 'ß' on de don't count even though
+the character has an uppercase form, since Caps Lock leaves them alone.
+"""
+LETTERS = {name: _find_letters(rows, LAYOUTS[name])
+           for name, rows in LAYOUT_ROWS.items()}
+
+def translate(text, layout, caps_lock=False):
+    """
+    Translate text into a list of (modifier mask, usage) keypresses for the
+    given layout, raising a ValueError for any characters it can't type. If
+    caps_lock is True, shift is inverted for the layout's LETTERS to account
+    for the host having Caps Lock turned on.
+    """
+    try:
+        table = LAYOUTS[layout]
+    except KeyError:
+        raise ValueError("Unknown keyboard layout '%s'" % layout)
+
+    try:
+        presses = [table[c] for c in text]
+    except KeyError as e:
+        raise ValueError("Can't type %r with the '%s' keyboard layout" % (
+            e.args[0], layout))
+
+    if caps_lock:
+        letters = LETTERS[layout]
+        presses = [(modifiers ^ SHIFT, usage) if c in letters
+                   else (modifiers, usage)
+                   for c, (modifiers, usage) in zip(text, presses)]
+
+    return presses
+
+@lru_cache(maxsize=256)
+def compile_text(text, layout, keyboard_cls, caps_lock=False):
+    """
+    Compile text into a single buffer containing a press and release report
+    for every character in it, in the report format used by keyboard_cls.
+    Results are cached, so text that gets typed often is only compiled once.
+    """
+    presses = translate(text, layout, caps_lock)
+    size = keyboard_cls.packet.size
+    pack_press = keyboard_cls.pack_press
+    buf = bytearray(size * len(presses) * 2)
+
+    # Release reports are all zeroes, so we only need to pack the presses
+    offset = 0
+    for modifiers, usage in presses:
+        pack_press(buf, offset, modifiers, usage)
+        offset += size * 2
+
+    return bytes(buf)
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+End to end latency measurements, using the kernel's dummy_hcd driver to plug a
+gadget straight back into the machine it's running on. Reports are sent
+through a Keyboard and Mouse as usual, and read back from the host side's
+hidraw nodes (or evdev nodes, with -e), so the numbers include everything a
+real host would see: queueing in the daemon, the gadget stack, the host's
+polling and the host's HID stack. This needs root, and a kernel with
+CONFIG_USB_DUMMY_HCD.
+
+The reports only ever tap right shift and wiggle the pointer back and forth,
+and the host's evdev nodes for the gadget are grabbed while we run, so nothing
+else on the machine sees them.
+
+Usage: python3 hidrelayd/loopback.py [-n REPORTS] [-u UDC] [-V VERSION] [-e]
+"""
+
+import argparse
+import asyncio
+import fcntl
+import os
+import sys
+import time
+import uuid
+
+from kmod import Kmod
+
+from benchmark import report_times
+from ghid import Keyboard, Mouse
+from passthrough import (EVENT, EVIOCGRAB, EVIOCSCLOCKID, CLOCK_ID, EV_SYN,
+                         SYN_REPORT)
+from usb_gadget import UsbGadget, UsbProtocolVersion, hidg_monitor
+
+""" How long to wait for the host side to enumerate the gadget """
+ENUMERATE_TIMEOUT = 10.0
+""" How long to wait for a report to make it to the host """
+REPORT_TIMEOUT = 1.0
+
+def load_modules():
+    km = Kmod()
+    for module in ['libcomposite', 'dummy_hcd']:
+        if km.module_from_name(module).refcnt == 0:
+            km.modprobe(module)
+
+def find_dummy_udc():
+    udcs = sorted(udc for udc in os.listdir('/sys/class/udc')
+                  if udc.startswith('dummy_udc'))
+    if not udcs:
+        sys.exit('No dummy_udc UDCs found, is dummy_hcd loaded?')
+    return udcs[0]
+
+def test_reports(device):
+    """
+    Get a pair of reports for device that undo each other, and don't do
+    anything on the host
+    """
+    if isinstance(device, Keyboard):
+        return device.packet.pack(0x20, b''), device.packet.pack(0, b'')
+    return device.packet.pack(0, 1, 0), device.packet.pack(0, -1, 0)
+
+def send(device, i):
+    """ Send the i'th report in a sequence of test_reports() """
+    if isinstance(device, Keyboard):
+        device.set_pressed(0 if i & 1 else 0x20)
+    else:
+        device.move(-1 if i & 1 else 1, 0)
+
+def find_host_nodes(context, serial, devices):
+    """
+    Wait for the host to enumerate the gadget with the given serial, returning
+    a dict of each of devices to the (hidraw node, evdev node) the host created
+    for it. Devices are told apart by their report descriptors.
+    """
+    deadline = time.monotonic() + ENUMERATE_TIMEOUT
+    while True:
+        nodes = dict()
+        for hid in context.list_devices(subsystem='hid'):
+            usb_device = hid.find_parent('usb', 'usb_device')
+            if usb_device is None or \
+               usb_device.attributes.get('serial') != serial.encode():
+                continue
+
+            with open(hid.sys_path + '/report_descriptor', 'rb') as f:
+                descriptor = f.read()
+            hidraw = [child.device_node for child in
+                      context.list_devices(subsystem='hidraw', parent=hid)
+                      if child.device_node]
+            evdev = [child.device_node for child in
+                     context.list_devices(subsystem='input', parent=hid)
+                     if child.sys_name.startswith('event')]
+            for device in devices:
+                if descriptor == device.HID_DESCRIPTOR and hidraw and evdev:
+                    nodes[device] = (hidraw[0], evdev[0])
+
+        if len(nodes) == len(devices):
+            return nodes
+        if time.monotonic() > deadline:
+            sys.exit('Timed out waiting for the host to enumerate the gadget')
+        time.sleep(0.05)
+
+class HostNode():
+    """
+    The host's end of one of our devices, timestamping each report as it
+    arrives in the same clock as time.monotonic(). With evdev, the timestamp
+    comes from the host's input core rather than from us reading the event,
+    and the node is grabbed since a grab keeps anyone else from reading it.
+    """
+    def __init__(self, loop, path, evdev):
+        self.loop = loop
+        self.evdev = evdev
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        if evdev:
+            fcntl.ioctl(self.fd, EVIOCGRAB, 1)
+            fcntl.ioctl(self.fd, EVIOCSCLOCKID,
+                        CLOCK_ID.pack(time.CLOCK_MONOTONIC))
+        self.arrivals = list()
+        self._waiter = None
+        loop.add_reader(self.fd, self._read)
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, EVENT.size * 64)
+        except BlockingIOError:
+            return
+
+        now = time.monotonic()
+        if not self.evdev:
+            self.arrivals.append(now)
+        else:
+            for sec, usec, type, code, value in EVENT.iter_unpack(data):
+                if type == EV_SYN and code == SYN_REPORT:
+                    self.arrivals.append(sec + usec / 1000000)
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait(self, count):
+        """
+        Wait until count reports have arrived in total, giving up if the host
+        goes REPORT_TIMEOUT seconds without getting any of them
+        """
+        while len(self.arrivals) < count:
+            self._waiter = self.loop.create_future()
+            await asyncio.wait_for(self._waiter, REPORT_TIMEOUT)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+async def measure_latency(name, device, node, count):
+    """
+    Send count reports one at a time, waiting for each one to show up on the
+    host before sending the next
+    """
+    latencies = list()
+    for i in range(count):
+        start = time.monotonic()
+        send(device, i)
+        await node.wait(len(node.arrivals) + 1)
+        latencies.append(node.arrivals[-1] - start)
+
+    report_times('%s latency' % name, latencies)
+
+async def measure_throughput(name, device, node, count):
+    """
+    Queue count reports all at once, and see how quickly the host takes them
+    """
+    press, release = test_reports(device)
+    reports = (press + release) * (count // 2)
+    already = len(node.arrivals)
+
+    start = time.monotonic()
+    device.function.write_many(reports, device.packet.size)
+    await node.wait(already + count // 2 * 2)
+    elapsed = node.arrivals[-1] - start
+
+    print('%-28s %8.0f reports/s  (poll interval %.3fms)' % (
+        '%s throughput' % name, (count // 2 * 2) / elapsed,
+        device.function.poll_interval * 1e3))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure hidrelayd's end to end latency with dummy_hcd"
+    )
+    parser.add_argument('-n', '--reports', type=int, default=1000,
+                        help='Number of reports to send to each device')
+    parser.add_argument('-u', '--udc',
+                        help='The dummy_udc to use (default: the first one)')
+    parser.add_argument('-V', '--usb-version', default='1.1',
+                        choices=['1.1', '2.0'],
+                        help='The USB version for the gadget to use')
+    parser.add_argument('-e', '--evdev', action='store_true',
+                        help='Read reports back from evdev instead of hidraw')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit('This needs to be run as root')
+
+    load_modules()
+    udc = args.udc or find_dummy_udc()
+    loop = asyncio.new_event_loop()
+    hidg_monitor.start(loop)
+
+    serial = uuid.uuid4().hex[:16]
+    gadget = UsbGadget(
+        'hidrelayd-loopback-%s' % serial,
+        version=UsbProtocolVersion['USB_' + args.usb_version.replace('.', '_')],
+        serial=serial)
+    devices = [Keyboard(gadget, loop), Mouse(gadget, loop)]
+    host_nodes = list()
+    try:
+        gadget.bind(udc)
+        nodes = find_host_nodes(hidg_monitor.context, serial, devices)
+        for device in devices:
+            hidraw, evdev = nodes[device]
+            if not args.evdev:
+                # Keep the rest of the machine from seeing any of our input
+                grab = os.open(evdev, os.O_RDONLY | os.O_NONBLOCK)
+                fcntl.ioctl(grab, EVIOCGRAB, 1)
+                host_nodes.append(grab)
+
+            name = type(device).__name__.lower()
+            node = HostNode(loop, evdev if args.evdev else hidraw, args.evdev)
+            try:
+                loop.run_until_complete(
+                    measure_latency(name, device, node, args.reports))
+                loop.run_until_complete(
+                    measure_throughput(name, device, node, args.reports))
+            finally:
+                node.close()
+    finally:
+        for fd in host_nodes:
+            os.close(fd)
+        for device in devices:
+            device.close()
+        gadget.remove()
+        hidg_monitor.stop()
+        loop.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Recording and replaying macros: the exact stream of reports sent to a relay
+device's keyboard, mouse and consumer control, along with when each one was
+sent.
+
+Macro files start with a header:
+  Magic (4 bytes), version (2 bytes), record count (4 bytes)
+followed by a record for each report (all little endian):
+  Time since the previous record in microseconds (4 bytes)
+  Function (1 byte) -- KEYBOARD, MOUSE or CONSUMER
+  Report length (1 byte)
+  Report
+Pauses longer than the time field can hold, a little over 71 minutes, are cut
+short when recording.
+"""
+
+import ctypes
+import mmap
+import os
+import statistics
+import tempfile
+from logging import debug, error, info
+from struct import Struct
+from time import monotonic_ns
+
+MAGIC = b'HRMC'
+VERSION = 1
+HEADER = Struct('<4sHI')
+RECORD = Struct('<IBB')
+""" The longest a record can wait after the one before it, in microseconds """
+MAX_DELTA = 0xffffffff
+
+KEYBOARD = 0
+MOUSE = 1
+CONSUMER = 2
+FUNCTIONS = {KEYBOARD: 'keyboard', MOUSE: 'mouse', CONSUMER: 'consumer'}
+
+class MacroError(Exception):
+    pass
+
+class Macro():
+    """
+    A macro file, mapped into memory and indexed so it can be replayed without
+    any further parsing
+
+    Keyword arguments:
+    path -- The macro file to load
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise MacroError('%s is too short to be a macro' % path)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        """ A list of (time in seconds, function, report) tuples """
+        self.records = list()
+        view = memoryview(self._mmap)
+        try:
+            self._index(view)
+        except MacroError:
+            self.records.clear()
+            view.release()
+            self._mmap.close()
+            raise
+
+    def _index(self, view):
+        magic, version, count = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise MacroError('%s is not a macro we understand' % self.path)
+
+        # Everything has to be checked against the size of the file, which
+        # might have been cut short or be something else entirely
+        size = len(view)
+        offset = HEADER.size
+        time = 0
+        for i in range(count):
+            if offset + RECORD.size > size:
+                raise MacroError('%s is truncated at record %d' % (self.path,
+                                                                    i))
+            delta, function, length = RECORD.unpack_from(view, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                raise MacroError('%s is truncated at record %d' % (self.path,
+                                                                    i))
+
+            time += delta
+            self.records.append((time / 1e6, function,
+                                 view[offset:offset + length]))
+            offset += length
+
+    @property
+    def duration(self):
+        return self.records[-1][0] if self.records else 0
+
+class MacroRecorder():
+    """
+    Records every report sent to a relay device's HID devices until
+    stop() is called
+
+    Keyword arguments:
+    relay -- The RelayDevice to record
+    """
+    def __init__(self, relay):
+        self.relay = relay
+        self._buf = bytearray()
+        self._count = 0
+        self._last_time = None
+        self._functions = list()
+
+        for function_id, name in FUNCTIONS.items():
+            device = getattr(relay, name)
+            if device is None:
+                continue
+
+            function = device.function
+            if function.recorder is not None:
+                raise MacroError('Already recording %s' % name)
+            function.recorder = self._recorder(function_id)
+            self._functions.append(function)
+
+    def _recorder(self, function_id):
+        def record(report):
+            now = monotonic_ns()
+            if self._last_time is None:
+                self._last_time = now
+            delta = (now - self._last_time) // 1000
+            if delta > MAX_DELTA:
+                # Nobody is going to miss the rest of a 71 minute pause
+                delta = MAX_DELTA
+                self._last_time = now
+            else:
+                self._last_time += delta * 1000
+
+            self._buf += RECORD.pack(delta, function_id, len(report))
+            self._buf += report
+            self._count += 1
+
+        return record
+
+    def stop(self, path):
+        """
+        Stop recording, and save the macro to path. The old macro at path, if
+        any, is replaced in one go: it might still be mapped by a Macro that's
+        being replayed, and truncating it would pull the pages out from under
+        the player.
+        """
+        for function in self._functions:
+            function.recorder = None
+
+        # Macro names can't start with a dot, so this can't clobber one
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                        prefix='.macro-')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, self._count))
+                f.write(self._buf)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+        info('Recorded %d reports to %s' % (self._count, path))
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', _Timespec), ('it_value', _Timespec)]
+
+class TimerFd():
+    """
+    A CLOCK_MONOTONIC timerfd, which lets us wake up on the event loop with
+    far better precision than the loop's own timers can give us
+    """
+    CLOCK_MONOTONIC = 1
+    TFD_TIMER_ABSTIME = 1
+
+    _libc = None
+
+    def __init__(self):
+        if TimerFd._libc is None:
+            TimerFd._libc = ctypes.CDLL(None, use_errno=True)
+
+        self.fd = self._libc.timerfd_create(self.CLOCK_MONOTONIC,
+                                            os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def set(self, deadline):
+        """ Arm the timer to fire at deadline (in loop.time() seconds) """
+        ns = int(deadline * 1e9)
+        spec = _Itimerspec(_Timespec(0, 0),
+                           _Timespec(ns // 1000000000, ns % 1000000000))
+        if self._libc.timerfd_settime(self.fd, self.TFD_TIMER_ABSTIME,
+                                      ctypes.byref(spec), None) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def clear(self):
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+class MacroPlayer():
+    """
+    Replays a macro to a relay device (or broadcast group), scheduling each
+    report off of a timerfd so it goes out within microseconds of when it's
+    due. How late each report was is kept so we can report the jitter once
+    we're done.
+
+    Keyword arguments:
+    loop -- The event loop to replay the macro from
+    macro -- The Macro to replay
+    relay -- The RelayDevice or BroadcastGroup to send the reports to
+    speed -- How much faster than it was recorded to replay the macro
+    """
+    def __init__(self, loop, macro, relay, speed=1.0):
+        assert speed > 0
+
+        self.loop = loop
+        self.macro = macro
+        self.speed = speed
+        self.done = loop.create_future()
+        self.lateness = list()
+
+        self._functions = dict()
+        for function_id, name in FUNCTIONS.items():
+            device = getattr(relay, name)
+            if device is not None:
+                self._functions[function_id] = device.function
+
+        self._index = 0
+        self._timer = TimerFd()
+        self._start = loop.time()
+        loop.add_reader(self._timer.fd, self._fire)
+        self.done.add_done_callback(self._finish)
+        self._fire()
+
+    def _fire(self):
+        records = self.macro.records
+        try:
+            self._timer.clear()
+            now = self.loop.time()
+            while self._index < len(records):
+                time, function_id, report = records[self._index]
+                deadline = self._start + time / self.speed
+                if deadline > now:
+                    self._timer.set(deadline)
+                    return
+
+                function = self._functions.get(function_id)
+                if function is not None:
+                    function.write(report)
+                self.lateness.append(now - deadline)
+                self._index += 1
+                now = self.loop.time()
+        except Exception as e:
+            # Whatever went wrong, failing the future removes our reader so
+            # we don't get called again to fail the same way forever
+            self.done.set_exception(e)
+            return
+
+        self.done.set_result(self.stats())
+
+    def _finish(self, future):
+        self.loop.remove_reader(self._timer.fd)
+        self._timer.close()
+
+    def cancel(self):
+        self.done.cancel()
+
+    def stats(self):
+        """
+        Return a dict describing how late the reports we've sent so far were,
+        in seconds
+        """
+        if not self.lateness:
+            return {'reports': 0}
+
+        lateness = sorted(self.lateness)
+        return {
+            'reports': len(lateness),
+            'mean': statistics.fmean(lateness),
+            'p50': lateness[len(lateness) // 2],
+            'p99': lateness[min(len(lateness) * 99 // 100, len(lateness) - 1)],
+            'max': lateness[-1],
+        }
+
+class MacroLibrary():
+    """
+    A directory of macros, which can be recorded from and replayed to relay
+    devices. Loaded macros are cached until the file changes, so replaying the
+    same macro again starts right away.
+
+    Keyword arguments:
+    loop -- The event loop to replay macros from
+    path -- The directory to keep macros in
+    """
+    def __init__(self, loop, path):
+        self.loop = loop
+        self.path = path
+        self._cache = dict()
+        self._recorders = dict()
+        self._players = set()
+
+    def _macro_path(self, name):
+        if not name or '/' in name or name.startswith('.'):
+            raise MacroError("Invalid macro name '%s'" % name)
+
+        return '%s/%s' % (self.path, name)
+
+    def load(self, name):
+        path = self._macro_path(name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            raise MacroError("No macro named '%s'" % name)
+
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        debug('Loading macro %s' % path)
+        macro = Macro(path)
+        self._cache[name] = (key, macro)
+        return macro
+
+    def record(self, relay_name, relay):
+        """ Start recording the input sent to a relay device """
+        if relay_name in self._recorders:
+            raise MacroError("Already recording '%s'" % relay_name)
+
+        self._recorders[relay_name] = MacroRecorder(relay)
+        info('Recording macro from %s' % relay_name)
+
+    def stop_recording(self, relay_name, name):
+        """ Stop recording a relay device, and save the macro as name """
+        path = self._macro_path(name)
+        try:
+            recorder = self._recorders.pop(relay_name)
+        except KeyError:
+            raise MacroError("Not recording '%s'" % relay_name)
+
+        recorder.stop(path)
+        self._cache.pop(name, None)
+
+    def replay(self, relay_name, relay, name, speed=1.0):
+        """
+        Start replaying a macro to a relay device or broadcast group, returning
+        the MacroPlayer doing it
+        """
+        player = MacroPlayer(self.loop, self.load(name), relay, speed)
+        self._players.add(player)
+
+        def replay_done(future):
+            self._players.discard(player)
+            if future.cancelled():
+                return
+            if future.exception():
+                error('Replaying %s to %s failed: %s' % (
+                    name, relay_name, future.exception()))
+                return
+
+            stats = future.result()
+            if stats['reports']:
+                info('Replayed %s to %s: %d reports, lateness p50 %.3fms '
+                     'p99 %.3fms max %.3fms' % (
+                         name, relay_name, stats['reports'],
+                         stats['p50'] * 1e3, stats['p99'] * 1e3,
+                         stats['max'] * 1e3))
+
+        player.done.add_done_callback(replay_done)
+        return player
+
+    def close(self):
+        for player in list(self._players):
+            player.cancel()
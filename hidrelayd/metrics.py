@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+import asyncio
+import os
+from bisect import bisect_left
+from logging import debug, info
+
+class FunctionStats():
+    """
+    Counters for a single HID function, updated on every report we write to
+    the host. Everything lives in fixed-size slots so that updating them is
+    about as cheap as it gets.
+    """
+    """ Upper bounds of the write latency histogram buckets, in seconds """
+    LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                       0.01, 0.025, 0.05, 0.1, 0.25)
+
+    __slots__ = ['reports', 'bytes', 'eagain', 'eshutdown', 'errors',
+                 'reconnects', 'coalesced', 'latency_counts', 'latency_sum']
+
+    def __init__(self):
+        self.reports = 0
+        self.bytes = 0
+        self.eagain = 0
+        self.eshutdown = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.coalesced = 0
+        # The last slot counts writes slower than the largest bucket
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def record_write(self, length, latency):
+        """
+        Record a report of the given length being written, latency seconds
+        after it was sent
+        """
+        self.reports += 1
+        self.bytes += length
+        self.latency_counts[bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+class PassthroughStats():
+    """
+    Counters for a passthrough, updated on every report it sends on to its
+    target
+    """
+    LATENCY_BUCKETS = FunctionStats.LATENCY_BUCKETS
+
+    __slots__ = ['reports', 'dropped', 'latency_counts', 'latency_sum']
+
+    def __init__(self):
+        self.reports = 0
+        self.dropped = 0
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def record_report(self, latency):
+        """
+        Record a report being sent latency seconds after the input device
+        sent the events behind it
+        """
+        self.reports += 1
+        self.latency_counts[bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+COUNTERS = [
+    ('reports_written_total', 'reports', 'Reports written to the host'),
+    ('bytes_written_total', 'bytes', 'Bytes written to the host'),
+    ('eagain_total', 'eagain',
+     "Writes deferred because the host hadn't read the last report yet"),
+    ('eshutdown_total', 'eshutdown',
+     'Writes that failed because the host disconnected'),
+    ('write_errors_total', 'errors', 'Writes that failed for other reasons'),
+    ('reconnects_total', 'reconnects', 'Times the hidg node was reopened'),
+    ('coalesced_total', 'coalesced',
+     'Reports merged into the report queued ahead of them'),
+]
+
+PASSTHROUGH_COUNTERS = [
+    ('passthrough_reports_total', 'reports',
+     'Reports sent on from input devices'),
+    ('passthrough_dropped_total', 'dropped',
+     'Times the kernel dropped events from an input device'),
+]
+
+def format_histogram(lines, name, labels, stats):
+    """ Add the lines for the latency histogram in stats to lines """
+    total = 0
+    for bound, count in zip(stats.LATENCY_BUCKETS + ('+Inf',),
+                            stats.latency_counts):
+        total += count
+        lines.append('hidrelayd_%s_bucket{%s,le="%s"} %d' % (
+            name, labels, bound, total))
+    lines.append('hidrelayd_%s_sum{%s} %f' % (name, labels, stats.latency_sum))
+    lines.append('hidrelayd_%s_count{%s} %d' % (name, labels, total))
+
+def format_stats(devices, passthroughs=None, groups=None):
+    """
+    Format the stats for every HID function in a dict of RelayDevices, along
+    with the stats for a dict of Passthroughs and the status of the members
+    of a dict of BroadcastGroups, in the Prometheus text exposition format
+    """
+    functions = list()
+    for name, device in sorted(devices.items()):
+        for function_name, function in device.functions():
+            if function.stats is not None:
+                functions.append(('gadget="%s",function="%s"' % (
+                    name, function_name), function))
+
+    lines = list()
+    def metric(name, metric_type, help_text):
+        lines.append('# HELP hidrelayd_%s %s' % (name, help_text))
+        lines.append('# TYPE hidrelayd_%s %s' % (name, metric_type))
+
+    for name, attr, help_text in COUNTERS:
+        metric(name, 'counter', help_text)
+        for labels, function in functions:
+            lines.append('hidrelayd_%s{%s} %d' % (
+                name, labels, getattr(function.stats, attr)))
+
+    metric('queue_depth', 'gauge', 'Reports waiting for the host to read them')
+    for labels, function in functions:
+        lines.append('hidrelayd_queue_depth{%s} %d' % (
+            labels, function.queue_depth))
+
+    metric('poll_interval_seconds', 'gauge',
+           'How often the host polls us for reports')
+    for labels, function in functions:
+        lines.append('hidrelayd_poll_interval_seconds{%s} %f' % (
+            labels, function.poll_interval))
+
+    metric('write_latency_seconds', 'histogram',
+           'Time from a report being sent to the host accepting it')
+    for labels, function in functions:
+        format_histogram(lines, 'write_latency_seconds', labels,
+                         function.stats)
+
+    passthrough_stats = list()
+    for name, passthrough in sorted((passthroughs or {}).items()):
+        if passthrough.stats is not None:
+            passthrough_stats.append(('passthrough="%s"' % name,
+                                      passthrough.stats))
+
+    if passthrough_stats:
+        for name, attr, help_text in PASSTHROUGH_COUNTERS:
+            metric(name, 'counter', help_text)
+            for labels, stats in passthrough_stats:
+                lines.append('hidrelayd_%s{%s} %d' % (
+                    name, labels, getattr(stats, attr)))
+
+        metric('passthrough_latency_seconds', 'histogram',
+               'Time from an input device sending events to us sending the '
+               'report for them')
+        for labels, stats in passthrough_stats:
+            format_histogram(lines, 'passthrough_latency_seconds', labels,
+                             stats)
+
+    members = list()
+    for name, group in sorted((groups or {}).items()):
+        for function_name, status in sorted(group.status().items()):
+            for member, member_status in sorted(status.items()):
+                members.append(('group="%s",member="%s",function="%s"' % (
+                    name, member, function_name), member_status))
+
+    if members:
+        metric('group_member_queue_depth', 'gauge',
+               'Reports a broadcast group member has waiting for its host')
+        for labels, status in members:
+            lines.append('hidrelayd_group_member_queue_depth{%s} %d' % (
+                labels, status['queue_depth']))
+
+        metric('group_member_lagging', 'gauge',
+               'Whether a broadcast group member is falling behind the rest')
+        for labels, status in members:
+            lines.append('hidrelayd_group_member_lagging{%s} %d' % (
+                labels, status['lagging']))
+
+        metric('group_member_failing', 'gauge',
+               'Whether the last write to a broadcast group member failed')
+        for labels, status in members:
+            lines.append('hidrelayd_group_member_failing{%s} %d' % (
+                labels, status['error'] is not None))
+
+    return '\n'.join(lines) + '\n'
+
+class StatsServer():
+    """
+    Serves the stats for a dict of RelayDevices over a UNIX socket. Clients that
+    send an HTTP request get an HTTP response (e.g. through
+    curl --unix-socket), anything else just gets the stats and EOF.
+
+    Keyword arguments:
+    path -- Where to create the UNIX socket
+    devices -- The dict of RelayDevices to report the stats of
+    passthroughs -- The dict of Passthroughs to report the stats of
+    groups -- The dict of BroadcastGroups to report the status of
+    """
+    """ How long to wait for clients to send a request """
+    REQUEST_TIMEOUT = 0.1
+
+    def __init__(self, path, devices, passthroughs=None, groups=None):
+        self.path = path
+        self.devices = devices
+        self.passthroughs = passthroughs
+        self.groups = groups
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self._server = await asyncio.start_unix_server(self._handle_client,
+                                                       self.path)
+        info('Serving stats on %s' % self.path)
+
+    def close(self):
+        if self._server is None:
+            return
+
+        self._server.close()
+        self._server = None
+        os.remove(self.path)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(),
+                                             self.REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            request = b''
+
+        body = format_stats(self.devices, self.passthroughs,
+                            self.groups).encode()
+        if request.startswith(b'GET'):
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body))
+        writer.write(body)
+
+        try:
+            await writer.drain()
+        except ConnectionError as e:
+            debug('Stats client went away: %s' % e)
+        writer.close()
@@ -0,0 +1,464 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Passthrough from local evdev input devices to a gadget, so a keyboard and
+mouse plugged into the relay board can drive a host KVM style.
+
+Each input device is grabbed so that nothing else on the board sees its
+events, and read in batches from the event loop. Key and button state is kept
+up to date as events come in, and every SYN_REPORT turns into at most one
+report on each of the target's keyboard, mouse and consumer control, so the
+host sees input grouped the same way the input device sent it.
+"""
+
+import fcntl
+import os
+import time
+from logging import debug, error, info
+from struct import Struct
+
+from arbitration import InputArbiter, PRIORITY_INTERACTIVE
+from ghid import Mouse
+
+# struct input_event, with the timestamp split into seconds and microseconds
+EVENT = Struct('@llHHi')
+# How many events we read at once
+BATCH_SIZE = 64
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+SYN_REPORT = 0
+SYN_DROPPED = 3
+REL_X = 0x00
+REL_Y = 0x01
+KEY_MAX = 0x2ff
+
+EVIOCGRAB = 0x40044590
+EVIOCSCLOCKID = 0x400445a0
+# EVIOCGKEY, sized for a bitmap of every key code
+EVIOCGKEY = 0x80004518 | (((KEY_MAX + 7) // 8) << 16)
+CLOCK_ID = Struct('@i')
+
+""" Linux key codes mapped to the HID keyboard usages they come from """
+KEYBOARD_USAGES = {
+    1: 0x29,    # Esc
+    2: 0x1e, 3: 0x1f, 4: 0x20, 5: 0x21, 6: 0x22, 7: 0x23, 8: 0x24, 9: 0x25,
+    10: 0x26, 11: 0x27,    # 1-9, 0
+    12: 0x2d,   # -
+    13: 0x2e,   # =
+    14: 0x2a,   # Backspace
+    15: 0x2b,   # Tab
+    16: 0x14, 17: 0x1a, 18: 0x08, 19: 0x15, 20: 0x17, 21: 0x1c, 22: 0x18,
+    23: 0x0c, 24: 0x12, 25: 0x13,    # Q-P
+    26: 0x2f,   # [
+    27: 0x30,   # ]
+    28: 0x28,   # Enter
+    29: 0xe0,   # Left Control
+    30: 0x04, 31: 0x16, 32: 0x07, 33: 0x09, 34: 0x0a, 35: 0x0b, 36: 0x0d,
+    37: 0x0e, 38: 0x0f,    # A-L
+    39: 0x33,   # ;
+    40: 0x34,   # '
+    41: 0x35,   # `
+    42: 0xe1,   # Left Shift
+    43: 0x31,   # Backslash
+    44: 0x1d, 45: 0x1b, 46: 0x06, 47: 0x19, 48: 0x05, 49: 0x11,
+    50: 0x10,   # Z-M
+    51: 0x36,   # ,
+    52: 0x37,   # .
+    53: 0x38,   # /
+    54: 0xe5,   # Right Shift
+    55: 0x55,   # Keypad *
+    56: 0xe2,   # Left Alt
+    57: 0x2c,   # Space
+    58: 0x39,   # Caps Lock
+    59: 0x3a, 60: 0x3b, 61: 0x3c, 62: 0x3d, 63: 0x3e, 64: 0x3f, 65: 0x40,
+    66: 0x41, 67: 0x42, 68: 0x43,    # F1-F10
+    69: 0x53,   # Num Lock
+    70: 0x47,   # Scroll Lock
+    71: 0x5f, 72: 0x60, 73: 0x61,    # Keypad 7-9
+    74: 0x56,   # Keypad -
+    75: 0x5c, 76: 0x5d, 77: 0x5e,    # Keypad 4-6
+    78: 0x57,   # Keypad +
+    79: 0x59, 80: 0x5a, 81: 0x5b,    # Keypad 1-3
+    82: 0x62,   # Keypad 0
+    83: 0x63,   # Keypad .
+    85: 0x94,   # Zenkaku/Hankaku
+    86: 0x64,   # Non-US \
+    87: 0x44,   # F11
+    88: 0x45,   # F12
+    89: 0x87,   # Ro
+    90: 0x92,   # Katakana
+    91: 0x93,   # Hiragana
+    92: 0x8a,   # Henkan
+    93: 0x88,   # Katakana/Hiragana
+    94: 0x8b,   # Muhenkan
+    95: 0x8c,   # Keypad JP comma
+    96: 0x58,   # Keypad Enter
+    97: 0xe4,   # Right Control
+    98: 0x54,   # Keypad /
+    99: 0x46,   # Print Screen
+    100: 0xe6,  # Right Alt
+    102: 0x4a,  # Home
+    103: 0x52,  # Up
+    104: 0x4b,  # Page Up
+    105: 0x50,  # Left
+    106: 0x4f,  # Right
+    107: 0x4d,  # End
+    108: 0x51,  # Down
+    109: 0x4e,  # Page Down
+    110: 0x49,  # Insert
+    111: 0x4c,  # Delete
+    116: 0x66,  # Power
+    117: 0x67,  # Keypad =
+    119: 0x48,  # Pause
+    121: 0x85,  # Keypad comma
+    122: 0x90,  # Hangeul
+    123: 0x91,  # Hanja
+    124: 0x89,  # Yen
+    125: 0xe3,  # Left Meta
+    126: 0xe7,  # Right Meta
+    127: 0x65,  # Compose
+    183: 0x68, 184: 0x69, 185: 0x6a, 186: 0x6b, 187: 0x6c, 188: 0x6d,
+    189: 0x6e, 190: 0x6f, 191: 0x70, 192: 0x71, 193: 0x72,
+    194: 0x73,  # F13-F24
+}
+
+""" Linux key codes for media keys mapped to consumer control usages """
+CONSUMER_USAGES = {
+    113: 0xe2,  # Mute
+    114: 0xea,  # Volume Down
+    115: 0xe9,  # Volume Up
+    163: 0xb5,  # Next Song
+    164: 0xcd,  # Play/Pause
+    165: 0xb6,  # Previous Song
+    166: 0xb7,  # Stop
+}
+
+""" Linux mouse button codes mapped to our mouse buttons """
+MOUSE_BUTTONS = {
+    0x110: Mouse.Button.LEFT.value,
+    0x111: Mouse.Button.RIGHT.value,
+    0x112: Mouse.Button.MIDDLE.value,
+}
+
+class InputDevice():
+    """
+    A single evdev node feeding a Passthrough. The state of each key and
+    button on it is tracked separately from any other input devices, so that
+    everything it had held down can be released if it goes away.
+
+    Keyword arguments:
+    passthrough -- The Passthrough to feed
+    path -- The path of the evdev node
+    grab -- Whether to grab the device, so only we get its events
+    """
+    def __init__(self, passthrough, path, grab=True):
+        self.passthrough = passthrough
+        self.path = path
+        self.grab = grab
+        self.fd = None
+        self.clock = time.CLOCK_REALTIME
+
+        # Keyboard usages in the order they were pressed
+        self.keys = dict()
+        self.modifier_mask = 0
+        self.btn_mask = 0
+        self.consumer_usage = 0
+        self.dx = self.dy = 0
+        self.keys_changed = self.buttons_changed = False
+        self.consumer_changed = False
+        self._dropped = False
+        self._buf = bytearray(EVENT.size * BATCH_SIZE)
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            if self.grab:
+                fcntl.ioctl(self.fd, EVIOCGRAB, 1)
+
+            # Timestamp events with the same clock as time.monotonic(), so we
+            # can tell how long they took to get to us
+            try:
+                fcntl.ioctl(self.fd, EVIOCSCLOCKID,
+                            CLOCK_ID.pack(time.CLOCK_MONOTONIC))
+                self.clock = time.CLOCK_MONOTONIC
+            except OSError as e:
+                debug('%s: Using realtime timestamps: %s' % (self.path,
+                                                             e.strerror))
+                self.clock = time.CLOCK_REALTIME
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+        # Anything held down before we grabbed the device is pressed now
+        self._resync()
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        os.close(self.fd)
+        self.fd = None
+        self._release_all()
+
+    def _release_all(self):
+        self.keys_changed = bool(self.keys or self.modifier_mask)
+        self.buttons_changed = bool(self.btn_mask)
+        self.consumer_changed = bool(self.consumer_usage)
+        self.keys = dict()
+        self.modifier_mask = self.btn_mask = self.consumer_usage = 0
+        self.dx = self.dy = 0
+
+    def _resync(self):
+        """
+        Rebuild our state from the keys the kernel says are down, after we
+        missed some events
+        """
+        bitmap = bytearray((KEY_MAX + 7) // 8)
+        try:
+            fcntl.ioctl(self.fd, EVIOCGKEY, bitmap)
+        except OSError as e:
+            debug("%s: Can't get key state: %s" % (self.path, e.strerror))
+            return
+
+        self._release_all()
+        for code in range(KEY_MAX + 1):
+            if bitmap[code >> 3] & (1 << (code & 7)):
+                self._key(code, 1)
+
+    def _key(self, code, value):
+        # Repeats are left up to the host
+        if value == 2:
+            return
+
+        usage = KEYBOARD_USAGES.get(code)
+        if usage is not None:
+            if usage >= 0xe0:
+                bit = 1 << (usage - 0xe0)
+                self.modifier_mask = self.modifier_mask | bit if value \
+                                     else self.modifier_mask & ~bit
+            elif value:
+                self.keys[usage] = None
+            else:
+                self.keys.pop(usage, None)
+            self.keys_changed = True
+            return
+
+        button = MOUSE_BUTTONS.get(code)
+        if button is not None:
+            self.btn_mask = self.btn_mask | button if value \
+                            else self.btn_mask & ~button
+            self.buttons_changed = True
+            return
+
+        usage = CONSUMER_USAGES.get(code)
+        if usage is not None:
+            if value:
+                self.consumer_usage = usage
+            elif self.consumer_usage == usage:
+                self.consumer_usage = 0
+            self.consumer_changed = True
+
+    def read(self):
+        """ Handle every event waiting on the device """
+        buf = self._buf
+        while True:
+            try:
+                length = os.readv(self.fd, [buf])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                error('%s: Lost input device: %s' % (self.path, e.strerror))
+                self.passthrough.lost(self)
+                return
+
+            if not length:
+                error('%s: Lost input device' % self.path)
+                self.passthrough.lost(self)
+                return
+
+            for sec, usec, type, code, value in \
+                EVENT.iter_unpack(memoryview(buf)[:length]):
+                if type == EV_SYN:
+                    if code == SYN_REPORT:
+                        if self._dropped:
+                            self._dropped = False
+                            self._resync()
+                        self.passthrough.sync(self, sec + usec / 1000000)
+                    elif code == SYN_DROPPED:
+                        # The kernel's buffer overflowed, so everything up to
+                        # the next SYN_REPORT is incomplete
+                        self._dropped = True
+                        if self.passthrough.stats is not None:
+                            self.passthrough.stats.dropped += 1
+                elif self._dropped:
+                    continue
+                elif type == EV_KEY:
+                    self._key(code, value)
+                elif type == EV_REL:
+                    if code == REL_X:
+                        self.dx += value
+                    elif code == REL_Y:
+                        self.dy += value
+
+            if length < len(buf):
+                return
+
+class Passthrough():
+    """
+    Forwards input from a set of evdev input devices to a gadget or broadcast
+    group, through an interactive input session so that whoever is sitting at
+    them takes priority over scripted input. The target is looked up by name
+    for every report, so it keeps working when the gadget gets recreated.
+    Input devices that can't be opened, or go away, are retried every
+    REOPEN_INTERVAL seconds, and anything they held down gets released.
+
+    Keyword arguments:
+    loop -- The event loop to read the input devices from
+    spec -- The PassthroughSpec to create the passthrough from
+    arbiters -- The InputArbiters to start our input session from
+
+    If stats is set to a metrics.PassthroughStats, it's updated with how long
+    each report took to get from the input device to the target.
+    """
+    REOPEN_INTERVAL = 1.0
+
+    def __init__(self, loop, spec, arbiters):
+        self.loop = loop
+        self.spec = spec
+        self.name = spec.name
+        self.target = spec.target
+        self.session = arbiters.session(self.target, self.name,
+                                        PRIORITY_INTERACTIVE)
+        self.stats = None
+        self.inputs = [InputDevice(self, path, spec.grab)
+                       for path in spec.devices]
+        self._reopen_handles = dict()
+
+        for input_device in self.inputs:
+            self._open(input_device)
+
+    def _open(self, input_device):
+        self._reopen_handles.pop(input_device, None)
+        try:
+            input_device.open()
+        except OSError as e:
+            debug('%s: Failed to open %s: %s' % (self.name, input_device.path,
+                                                 e.strerror))
+            self._reopen_handles[input_device] = self.loop.call_later(
+                self.REOPEN_INTERVAL, self._open, input_device)
+            return
+
+        info('%s: Forwarding %s to %s' % (self.name, input_device.path,
+                                          self.target))
+        self.loop.add_reader(input_device.fd, input_device.read)
+        self.sync(input_device, None)
+
+    def lost(self, input_device):
+        """ Release everything input_device held, and wait for it to return """
+        self.loop.remove_reader(input_device.fd)
+        input_device.close()
+        self.sync(input_device, None)
+        self._reopen_handles[input_device] = self.loop.call_later(
+            self.REOPEN_INTERVAL, self._open, input_device)
+
+    def sync(self, input_device, timestamp):
+        """
+        Send the changes input_device has seen since its last SYN_REPORT to
+        the target, with a single report for each function. timestamp is when
+        the input device sent the SYN_REPORT, if it came from one.
+        """
+        target = self.session.relay
+        if target is None:
+            return
+
+        try:
+            if input_device.keys_changed:
+                input_device.keys_changed = False
+                if target.keyboard is not None:
+                    self._sync_keyboard()
+            if input_device.buttons_changed or input_device.dx or \
+               input_device.dy:
+                input_device.buttons_changed = False
+                if target.mouse is not None:
+                    self._sync_mouse(target.mouse, input_device)
+                input_device.dx = input_device.dy = 0
+            if input_device.consumer_changed:
+                input_device.consumer_changed = False
+                if target.consumer is not None:
+                    self._sync_consumer()
+        except InputArbiter.Exception as e:
+            debug('%s: Dropping input: %s' % (self.name, e))
+            return
+
+        if timestamp is not None and self.stats is not None:
+            self.stats.record_report(time.clock_gettime(input_device.clock) -
+                                     timestamp)
+
+    def _sync_keyboard(self):
+        # Other input devices may have keys held down as well, the arbiter
+        # takes care of trimming them down to what the keyboard can report
+        if len(self.inputs) == 1:
+            keys = self.inputs[0].keys
+            modifier_mask = self.inputs[0].modifier_mask
+        else:
+            keys = dict()
+            modifier_mask = 0
+            for input_device in self.inputs:
+                keys.update(input_device.keys)
+                modifier_mask |= input_device.modifier_mask
+
+        self.session.set_keys(modifier_mask, keys)
+
+    def _sync_mouse(self, mouse, input_device):
+        btn_mask = 0
+        for other in self.inputs:
+            btn_mask |= other.btn_mask
+
+        dx, dy = input_device.dx, input_device.dy
+        if not isinstance(mouse, Mouse) or (not dx and not dy):
+            # Absolute mice can still take the buttons
+            self.session.set_buttons(btn_mask)
+        else:
+            self.session.move(dx, dy, btn_mask)
+
+    def _sync_consumer(self):
+        usage = 0
+        for input_device in self.inputs:
+            usage = input_device.consumer_usage or usage
+        self.session.set_consumer(usage)
+
+    def close(self):
+        for handle in self._reopen_handles.values():
+            handle.cancel()
+        self._reopen_handles.clear()
+
+        for input_device in self.inputs:
+            if input_device.fd is not None:
+                self.loop.remove_reader(input_device.fd)
+                input_device.close()
+                self.sync(input_device, None)
+        self.session.close()
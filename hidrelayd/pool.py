@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+from itertools import count
+from logging import debug, info
+
+from metrics import FunctionStats
+from relay_device import RelayDevice
+
+class GadgetPool():
+    """
+    A pool of gadgets that are built ahead of time but left unbound, so that
+    attaching one to a UDC only takes a single write to configfs. Released
+    gadgets go back into the pool instead of being torn down.
+
+    Keyword arguments:
+    name -- The name of the pool
+    spec -- The GadgetSpec to build the pool's gadgets from
+    daemon_config -- The DaemonConfig, for the daemon-wide gadget settings
+    loop -- The event loop to drive the gadgets' I/O from
+    stats -- Whether to collect stats for the pool's gadgets
+    """
+    def __init__(self, name, spec, daemon_config, loop, stats=False):
+        self.name = name
+        self.spec = spec
+        self.daemon_config = daemon_config
+        self.loop = loop
+        self.stats = stats
+
+        """ The unbound gadgets that are ready to be attached """
+        self.free = list()
+        """ A dict of session names to the gadgets attached for them """
+        self.attached = dict()
+
+        self._gadget_id = count()
+
+    def new_spec(self):
+        """ Get the spec for the next gadget we add to the pool """
+        return self.spec._replace(
+            name='pool-%s-%d' % (self.name, next(self._gadget_id)))
+
+    def add(self, device):
+        """ Add an unbound RelayDevice built from new_spec() to the pool """
+        if self.stats:
+            for name, function in device.functions():
+                function.stats = FunctionStats()
+
+        self.free.append(device)
+
+    def acquire(self, session, udc_device):
+        """
+        Attach a gadget from the pool to a UDC for a session, returning its
+        RelayDevice. If the pool has run dry, a new gadget gets built.
+        """
+        if not self.free:
+            info('Pool %s is empty, building another gadget' % self.name)
+            self.add(RelayDevice(self.new_spec(), self.daemon_config,
+                                 self.loop))
+
+        device = self.free.pop()
+
+        try:
+            device.attach(udc_device)
+        except Exception:
+            if device.gadget.bound:
+                device.detach()
+            self.free.append(device)
+            raise
+
+        info('Attached %s from pool %s to %s for %s' % (
+            device.gadget.name, self.name, udc_device, session))
+        self.attached[session] = device
+        return device
+
+    def release(self, session):
+        """ Detach the gadget for a session, and put it back in the pool """
+        device = self.attached.pop(session)
+        debug('Returning %s to pool %s' % (device.gadget.name, self.name))
+        device.detach()
+        self.free.append(device)
+
+class GadgetPools():
+    """
+    All of the daemon's gadget pools, along with the sessions attached from
+    them. Attached gadgets are added to the daemon's relay devices under the
+    session's name, so control clients can send them input like any other
+    gadget.
+
+    Keyword arguments:
+    devices -- The dict of RelayDevices to add attached gadgets to
+    groups -- The dict of BroadcastGroups, whose names sessions can't reuse
+    """
+    class Exception(Exception):
+        pass
+
+    def __init__(self, devices, groups):
+        self.devices = devices
+        self.groups = groups
+        self.pools = dict()
+
+    def add(self, pool):
+        self.pools[pool.name] = pool
+
+    def sessions(self):
+        """ Get the names of every attached session """
+        return [session for pool in self.pools.values()
+                for session in pool.attached]
+
+    def attach(self, session, pool_name, udc_device):
+        """ Attach a gadget from a pool to a UDC for a new session """
+        if session in self.devices or session in self.groups:
+            raise GadgetPools.Exception("'%s' is already in use" % session)
+
+        try:
+            pool = self.pools[pool_name]
+        except KeyError:
+            raise GadgetPools.Exception("Unknown pool '%s'" % pool_name)
+
+        self.devices[session] = pool.acquire(session, udc_device)
+
+    def detach(self, session):
+        """ Release a session's gadget back to its pool """
+        for pool in self.pools.values():
+            if session in pool.attached:
+                del self.devices[session]
+                pool.release(session)
+                return
+
+        raise GadgetPools.Exception("No attached session '%s'" % session)
@@ -21,33 +21,233 @@
 # Authors:
 #   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
 
-from logging import debug
+from logging import debug, info
+from startup import StartupProfile
 from usb_gadget import UsbGadget
 from ghid import *
+from ghid import Device
 
 class RelayDevice():
     """
-    The toplevel object for HID relay devices
+    The toplevel object for HID relay devices. Creating one builds and binds
+    the gadget, but doesn't touch the event loop until connect() is called, so
+    relay devices can be created from other threads.
+
+    Keyword arguments:
+    spec -- The GadgetSpec to create the relay device from
+    daemon_config -- The DaemonConfig, for the daemon-wide gadget settings
+    loop -- The event loop to drive the relay device's I/O from
+    profile -- The StartupProfile to record how long each step takes in
     """
-    def __init__(self, section, daemon_config):
-        self.gadget = UsbGadget(
-            name=section.split(':')[1],
-            version=daemon_config.get_usb_version(section),
-            vendor_id=daemon_config.getint(section, 'vendor_id'),
-            product_id=daemon_config.getint(section, 'product_id'),
-            serial=daemon_config.get(section, 'serial'),
-            manufacturer=daemon_config.get(section, 'manufacturer'),
-            product=daemon_config.get(section, 'product')
-        )
-
-        if daemon_config.get(section, 'has_keyboard'):
-            self.keyboard = Keyboard(self.gadget)
-        else:
-            self.keyboard = None
+    KEYBOARD_MODES = {'boot': Keyboard, 'nkro': NkroKeyboard}
+    MOUSE_MODES = {'relative': Mouse, 'absolute': AbsoluteMouse}
+
+    """ The report IDs each device uses in composite mode """
+    KEYBOARD_REPORT_ID = 1
+    MOUSE_REPORT_ID = 2
+    CONSUMER_REPORT_ID = 3
+
+    def __init__(self, spec, daemon_config, loop, profile=None):
+        self.spec = spec
+        self.loop = loop
+        profile = profile or StartupProfile()
+
+        # A worker finding its gadget already there means the last worker for
+        # it crashed, and the host can just keep using it
+        persistent = daemon_config.getboolean('hidrelayd',
+                                              'persistent_gadgets')
+        adopt = persistent or daemon_config.getboolean('hidrelayd', 'workers')
+
+        with profile.phase('configfs tree', spec.name):
+            self.gadget = UsbGadget(
+                name=spec.name,
+                version=spec.usb_version,
+                vendor_id=spec.vendor_id,
+                product_id=spec.product_id,
+                serial=spec.serial,
+                manufacturer=spec.manufacturer,
+                product=spec.product,
+                configfs_root=daemon_config.get('hidrelayd', 'configfs_root'),
+                persistent=persistent,
+                adopt=adopt
+            )
+
+        # Don't leave half-built gadgets lying around if we fail
+        try:
+            with profile.phase('functions', spec.name):
+                self._create_devices()
+                self._set_poll_interval()
 
-        if daemon_config.get(section, 'has_mouse'):
-            self.mouse = Mouse(self.gadget)
+            # Pooled gadgets don't get bound until they're attached
+            if spec.udc_device is not None:
+                with profile.phase('bind', spec.name):
+                    self.gadget.bind(spec.udc_device)
+        except Exception:
+            self.gadget.remove()
+            raise
+
+    def _device_classes(self, spec):
+        """
+        Get a dict of report IDs to the Device subclass the spec calls for, or
+        None if it doesn't have that device
+        """
+        return {
+            self.KEYBOARD_REPORT_ID: self.KEYBOARD_MODES.get(spec.keyboard_mode),
+            self.MOUSE_REPORT_ID: self.MOUSE_MODES.get(spec.mouse_mode),
+            self.CONSUMER_REPORT_ID: ConsumerControl if spec.consumer else None,
+        }
+
+    def _create_devices(self):
+        spec = self.spec
+        device_classes = self._device_classes(spec)
+        if spec.composite:
+            self.composite = CompositeFunction(
+                self.gadget, self.loop,
+                {report_id: device_cls for report_id, device_cls in
+                 device_classes.items() if device_cls})
         else:
-            self.mouse = None
+            self.composite = None
+
+        self.keyboard = self._create_device(device_classes,
+                                            self.KEYBOARD_REPORT_ID)
+        self.mouse = self._create_device(device_classes, self.MOUSE_REPORT_ID)
+        self.consumer = self._create_device(device_classes,
+                                            self.CONSUMER_REPORT_ID)
+
+    def _create_device(self, device_classes, report_id):
+        device_cls = device_classes[report_id]
+        if device_cls is None:
+            return None
+        if self.composite:
+            return device_cls(self.gadget, self.loop,
+                              self.composite.report_function(report_id))
+
+        return device_cls(self.gadget, self.loop)
+
+    def _set_poll_interval(self):
+        # Poll intervals are configured in milliseconds, 0 means learn it
+        poll_interval = self.spec.poll_interval
+        for name, function in self.functions():
+            function.set_poll_interval(poll_interval / 1000 if poll_interval
+                                       else None)
+
+    def reconfigure(self, spec):
+        """
+        Apply a new GadgetSpec to this relay device, only touching what
+        changed. Functions whose mode changed are recreated, and the gadget is
+        only rebound if its functions or UDC changed; everything else keeps
+        serving input. Returns False if the gadget itself changed, in which
+        case the relay device needs to be recreated instead. Composite
+        functions can't be partially changed, so any change to the devices on
+        one counts as the gadget changing.
+        """
+        old = self.spec
+        if spec._replace(udc_device=old.udc_device,
+                         keyboard_mode=old.keyboard_mode,
+                         mouse_mode=old.mouse_mode,
+                         consumer=old.consumer,
+                         poll_interval=old.poll_interval) != old:
+            return False
+
+        functions = (spec.keyboard_mode, spec.mouse_mode, spec.consumer)
+        old_functions = (old.keyboard_mode, old.mouse_mode, old.consumer)
+        if spec.composite and functions != old_functions:
+            return False
+
+        self.spec = spec
+        if functions != old_functions or spec.udc_device != old.udc_device:
+            info('%s: rebinding to apply configuration changes' % spec.name)
+            # Unbinding closes the hidg nodes out from under the functions
+            self.close()
+            if self.gadget.bound:
+                self.gadget.unbind()
+            # The host forgets everything once it sees us disappear
+            for device in [self.keyboard, self.mouse, self.consumer]:
+                if device:
+                    device.reset()
+
+            device_classes = self._device_classes(spec)
+            if spec.keyboard_mode != old.keyboard_mode:
+                self._remove_device(self.keyboard)
+                self.keyboard = self._create_device(device_classes,
+                                                    self.KEYBOARD_REPORT_ID)
+            if spec.mouse_mode != old.mouse_mode:
+                self._remove_device(self.mouse)
+                self.mouse = self._create_device(device_classes,
+                                                 self.MOUSE_REPORT_ID)
+            if spec.consumer != old.consumer:
+                self._remove_device(self.consumer)
+                self.consumer = self._create_device(device_classes,
+                                                    self.CONSUMER_REPORT_ID)
+
+            self._set_poll_interval()
+            self.gadget.bind(spec.udc_device)
+            self.connect()
+        elif spec.poll_interval != old.poll_interval:
+            self._set_poll_interval()
+
+        return True
+
+    def attach(self, udc_device):
+        """ Bind an unbound relay device to a UDC, and start serving input """
+        self.gadget.bind(udc_device)
+        self.spec = self.spec._replace(udc_device=udc_device)
+        self.connect()
+
+    def detach(self):
+        """
+        Unbind the relay device from its UDC, forgetting everything about the
+        host it was attached to
+        """
+        self.close()
+        self.gadget.unbind()
+        self.spec = self.spec._replace(udc_device=None)
+        for device in [self.keyboard, self.mouse, self.consumer]:
+            if device:
+                device.reset()
+
+    def _remove_device(self, device):
+        if device is None:
+            return
+
+        device.close()
+        self.gadget.remove_function(device.function.configfs_dir)
+
+    def connect(self):
+        """
+        Open the hidg nodes for our HID functions so that we start receiving
+        output reports from the host
+        """
+        for name, function in self.functions():
+            try:
+                function.connect()
+            except Device.GadgetUnboundError:
+                debug('%s: hidg node not available yet' % self.gadget.name)
+
+    def functions(self):
+        """
+        Return a list of (name, HidFunction) tuples for each HID function on
+        this relay device
+        """
+        if self.composite:
+            return [('composite', self.composite)]
+
+        functions = list()
+        if self.keyboard:
+            functions.append(('keyboard', self.keyboard.function))
+        if self.mouse:
+            functions.append(('mouse', self.mouse.function))
+        if self.consumer:
+            functions.append(('consumer', self.consumer.function))
+
+        return functions
+
+    def close(self):
+        """ Stop all I/O on this relay device's HID functions """
+        for name, function in self.functions():
+            function.close()
 
-        self.gadget.bind(daemon_config.get(section, 'udc_device'))
+    def remove(self):
+        """ Stop all I/O, and remove the gadget from configfs """
+        self.close()
+        self.gadget.remove()
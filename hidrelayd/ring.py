@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Shared memory rings for feeding raw HID reports to the daemon from local
+producers, without a syscall or a copy for every report.
+
+Each ring belongs to a single HID function on a relay device. The daemon
+creates it in anonymous shared memory, along with an eventfd for wakeups, and
+listens on a UNIX socket. A producer connects to the socket and gets handed
+both file descriptors. Only one producer may be connected to a ring at a time.
+
+The ring is laid out as:
+  Header: magic, version, slot size, slot count and the size of the
+  function's reports (4 bytes each)
+  Head (4 bytes, at HEAD_OFFSET): index of the next slot the daemon will read
+  Tail (4 bytes, at TAIL_OFFSET): index of the next slot the producer will fill
+  Slots (at SLOTS_OFFSET): slot count slots of slot size bytes each, holding
+  the length of the report (1 byte) followed by the report
+Indexes count up forever (wrapping at 2^32), and slot count is always a power
+of two. Every report must be exactly the report size, the daemon skips any
+that aren't.
+
+After each batch the producer signals the eventfd with the number of reports
+it added, and the daemon drains exactly as many reports as it's been signaled
+for. Python can't put a memory barrier between filling the slots and moving
+the tail, so the eventfd is what guarantees that the daemon sees the slots
+filled in: the kernel orders everything the producer wrote before signaling
+it ahead of everything the daemon reads after reading it. The tail is only
+there so a new producer knows where to carry on from.
+"""
+
+import mmap
+import os
+import socket
+from logging import debug, info
+from struct import Struct
+
+from ghid import Device
+
+MAGIC = b'HRRB'
+VERSION = 1
+HEADER = Struct('=4sIIII')
+INDEX = Struct('=I')
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+SLOTS_OFFSET = 192
+INDEX_MASK = 0xffffffff
+
+DEFAULT_SLOT_SIZE = 64
+DEFAULT_SLOT_COUNT = 1024
+
+class RingChannel():
+    """
+    The daemon's end of a ring, draining reports from it into a HID function
+    in batches whenever the producer signals us.
+
+    Keyword arguments:
+    loop -- The event loop to drain the ring from
+    path -- Where to create the UNIX socket producers connect to
+    device -- The Keyboard or Mouse to write the reports to
+    slot_count -- How many reports the ring can hold, must be a power of two
+    """
+    def __init__(self, loop, path, device, slot_count=DEFAULT_SLOT_COUNT,
+                 slot_size=DEFAULT_SLOT_SIZE):
+        assert slot_count & (slot_count - 1) == 0
+        assert device.packet.size < slot_size
+
+        self.loop = loop
+        self.path = path
+        self.device = device
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+
+        size = SLOTS_OFFSET + slot_count * slot_size
+        self._memfd = os.memfd_create('hidrelayd-ring', os.MFD_CLOEXEC)
+        os.ftruncate(self._memfd, size)
+        self._mmap = mmap.mmap(self._memfd, size)
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, slot_size, slot_count,
+                         device.packet.size)
+        self._eventfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self._producer = None
+        """ How many reports we've been signaled for but haven't drained """
+        self._pending = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen()
+        self._socket.setblocking(False)
+
+        loop.add_reader(self._socket.fileno(), self._accept)
+        loop.add_reader(self._eventfd, self._drain)
+        info('Ring for %s listening on %s' % (type(device).__name__, path))
+
+    def _accept(self):
+        try:
+            producer, _ = self._socket.accept()
+        except BlockingIOError:
+            return
+
+        if self._producer is not None:
+            debug('%s: rejecting producer, ring is busy' % self.path)
+            producer.send(b'busy')
+            producer.close()
+            return
+
+        socket.send_fds(producer, [b'ok'], [self._memfd, self._eventfd])
+        producer.setblocking(False)
+        self._producer = producer
+        self.loop.add_reader(producer.fileno(), self._producer_readable)
+        debug('%s: producer connected' % self.path)
+
+    def _producer_readable(self):
+        try:
+            if self._producer.recv(64):
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+
+        # Anything the producer left in the ring still gets drained, even if
+        # it died before signaling us for it. It's gone, so all of its writes
+        # are visible by now.
+        debug('%s: producer disconnected' % self.path)
+        self.loop.remove_reader(self._producer.fileno())
+        self._producer.close()
+        self._producer = None
+        head, = INDEX.unpack_from(self._mmap, HEAD_OFFSET)
+        tail, = INDEX.unpack_from(self._mmap, TAIL_OFFSET)
+        self._pending = (tail - head) & INDEX_MASK
+        self._drain()
+
+    def _drain(self):
+        try:
+            self._pending += os.eventfd_read(self._eventfd)
+        except BlockingIOError:
+            pass
+        if not self._pending:
+            return
+
+        # Don't let a confused producer send us around the ring forever
+        self._pending = min(self._pending, self.slot_count)
+
+        ring = self._mmap
+        view = memoryview(ring)
+        write = self.device.function.write
+        report_size = self.device.packet.size
+        slot_size = self.slot_size
+        mask = self.slot_count - 1
+
+        head, = INDEX.unpack_from(ring, HEAD_OFFSET)
+        skipped = 0
+        try:
+            while self._pending:
+                offset = SLOTS_OFFSET + (head & mask) * slot_size
+                if ring[offset] == report_size:
+                    write(view[offset + 1:offset + 1 + report_size])
+                else:
+                    skipped += 1
+                head = (head + 1) & INDEX_MASK
+                self._pending -= 1
+        except Device.GadgetUnboundError:
+            # Nobody to send the reports to, so they're stale anyway
+            head = (head + self._pending) & INDEX_MASK
+            self._pending = 0
+        finally:
+            INDEX.pack_into(ring, HEAD_OFFSET, head)
+            view.release()
+
+        if skipped:
+            debug('%s: skipped %d reports that weren\'t %d bytes long' % (
+                self.path, skipped, report_size))
+
+    def close(self):
+        self.loop.remove_reader(self._socket.fileno())
+        self.loop.remove_reader(self._eventfd)
+        if self._producer is not None:
+            self.loop.remove_reader(self._producer.fileno())
+            self._producer.close()
+            self._producer = None
+
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._mmap.close()
+        os.close(self._memfd)
+        os.close(self._eventfd)
+
+class RingProducer():
+    """
+    The producer's end of a ring. This is all a local client needs in order
+    to feed reports to the daemon.
+
+    Keyword arguments:
+    path -- The path of the ring's UNIX socket
+    """
+    class BusyError(Exception):
+        def __init__(self):
+            super().__init__("Another producer is already using this ring")
+
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        msg, fds, _, _ = socket.recv_fds(self._socket, 16, 2)
+        if msg != b'ok':
+            self._socket.close()
+            raise RingProducer.BusyError()
+
+        memfd, self._eventfd = fds
+        self._mmap = mmap.mmap(memfd, 0)
+        os.close(memfd)
+
+        magic, version, self.slot_size, self.slot_count, self.report_size = \
+            HEADER.unpack_from(self._mmap)
+        assert magic == MAGIC and version == VERSION
+
+        self._mask = self.slot_count - 1
+        self._tail, = INDEX.unpack_from(self._mmap, TAIL_OFFSET)
+
+    def push(self, report):
+        """
+        Add a single report to the ring, returning False if the ring is full
+        """
+        return self.push_many([report]) == 1
+
+    def push_many(self, reports):
+        """
+        Add a batch of reports to the ring, returning how many fit. The daemon
+        is woken up once for the whole batch. Raises a ValueError if a report
+        isn't report_size bytes long, without adding any of the batch.
+        """
+        ring = self._mmap
+        tail = self._tail
+        head, = INDEX.unpack_from(ring, HEAD_OFFSET)
+        free = self.slot_count - ((tail - head) & INDEX_MASK)
+
+        count = 0
+        for report in reports:
+            if count == free:
+                break
+            if len(report) != self.report_size:
+                raise ValueError('Reports must be %d bytes long' %
+                                 self.report_size)
+
+            offset = SLOTS_OFFSET + (tail & self._mask) * self.slot_size
+            ring[offset] = len(report)
+            ring[offset + 1:offset + 1 + len(report)] = report
+            tail = (tail + 1) & INDEX_MASK
+            count += 1
+
+        if not count:
+            return 0
+
+        self._tail = tail
+        INDEX.pack_into(ring, TAIL_OFFSET, tail)
+        os.eventfd_write(self._eventfd, count)
+
+        return count
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._eventfd)
+        self._socket.close()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+import threading
+from contextlib import contextmanager
+from logging import info
+from time import perf_counter
+
+class StartupProfile():
+    """
+    Keeps track of how long each phase of bringing hidrelayd up takes, both
+    for each gadget and overall, so we can see where our boot-to-ready time
+    goes. Gadgets are brought up in parallel, so phases can be timed from any
+    thread. The profile is logged at the info level, which hidrelayd shows
+    with --profile-startup.
+    """
+    """ The phases we time, in the order they happen """
+    PHASES = ['module load', 'configfs tree', 'functions', 'bind',
+              'hidg discovery']
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.end = None
+
+        """ A dict of phase names to a dict of gadget names to seconds """
+        self.phases = {phase: dict() for phase in self.PHASES}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, phase, gadget=None):
+        """
+        Time a phase of startup for a gadget, or for the whole daemon if no
+        gadget is given
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                times = self.phases[phase]
+                times[gadget] = times.get(gadget, 0) + elapsed
+
+    def finish(self):
+        """ Mark startup as done, and log the profile """
+        self.end = perf_counter()
+        info('Ready after %.1fms' % ((self.end - self.start) * 1e3))
+
+        for phase, times in self.phases.items():
+            if not times:
+                continue
+
+            total = sum(times.values())
+            slowest = max(times, key=times.get)
+            if slowest is None:
+                info('  %-16s %8.1fms' % (phase, total * 1e3))
+            else:
+                info('  %-16s %8.1fms summed, slowest %s %.1fms' % (
+                    phase, total * 1e3, slowest, times[slowest] * 1e3))
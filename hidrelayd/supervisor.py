@@ -0,0 +1,563 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Runs every gadget in its own worker process (see worker.py), so that a GC
+pause, a stuck configfs write or a host that stopped reading in one of them
+can't hold up input to any of the others. The supervisor keeps the control
+sockets and broadcast groups to itself. Each control client gets its own UNIX
+socket connection to every worker it sends input to, and its messages are
+forwarded over them as they are, so the workers see the same protocol and
+give each client its own input session. Workers that exit are restarted,
+backing off if they keep crashing, and adopt their gadget if it's still
+there so the host doesn't notice.
+"""
+
+import asyncio
+import configparser
+import os
+import signal
+import socket
+import subprocess
+import sys
+from collections import deque
+from logging import debug, info, warning, error
+
+from config import DaemonConfig
+from control import ControlServer, ProtocolError, decode_text, \
+                    encode_message, encode_error, encode_ack, LENGTH, \
+                    HEADER, ACK, ERROR, REPLY_ERROR, OP_RECORD, OP_ATTACH, \
+                    OP_DETACH
+
+""" The script each worker process runs """
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'worker.py')
+
+class Worker():
+    """
+    The worker process serving a single gadget. It's started right away.
+
+    Keyword arguments:
+    loop -- The event loop to watch the worker from
+    name -- The name of the gadget
+    config_path -- The config file for the worker to load
+    verbose -- Whether the worker should show debugging messages
+    profile_startup -- Whether the worker should show its startup profile
+    """
+    RESTART_DELAY = 1.0
+    MAX_RESTART_DELAY = 30.0
+    """ How long to give a worker to clean up before killing it """
+    STOP_TIMEOUT = 5.0
+    """ How often to check whether a worker that's going away has exited """
+    REAP_INTERVAL = 0.05
+
+    def __init__(self, loop, name, config_path, verbose=False,
+                 profile_startup=False):
+        self.loop = loop
+        self.name = name
+        self.config_path = config_path
+        self.verbose = verbose
+        self.profile_startup = profile_startup
+        self.process = None
+        self.channel = None
+        self.stopping = False
+        self._started = None
+        self._restart_delay = self.RESTART_DELAY
+        self._restart_handle = None
+        self._reap_handle = None
+
+        self.start()
+
+    def start(self):
+        self._restart_handle = None
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        args = [sys.executable, WORKER_PATH, '-c', self.config_path,
+                '-g', self.name, '--fd', str(worker_channel.fileno())]
+        if self.verbose:
+            args.append('-v')
+        if self.profile_startup:
+            args.append('-p')
+
+        try:
+            # Workers get their own session so that a ^C on the terminal
+            # only reaches us, and they're stopped one at a time
+            self.process = subprocess.Popen(
+                args, pass_fds=(worker_channel.fileno(),),
+                start_new_session=True)
+        except OSError as e:
+            error('Failed to start the worker for %s: %s' % (self.name,
+                                                             e.strerror))
+            channel.close()
+            self._restart()
+            return
+        finally:
+            worker_channel.close()
+
+        debug('Started worker %d for %s' % (self.process.pid, self.name))
+        self._started = self.loop.time()
+        self.channel = channel
+        self.channel.setblocking(False)
+        self.loop.add_reader(self.channel.fileno(), self._channel_readable)
+
+    def _channel_readable(self):
+        # Workers never send anything, this just means they went away
+        try:
+            if self.channel.recv(1):
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+
+        self._close_channel()
+        if self._reap_handle is None:
+            self._reap(self.loop.time() + self.STOP_TIMEOUT)
+
+    def _reap(self, deadline):
+        """
+        Check whether the worker has exited, without blocking the loop, until
+        it has. It's killed if it's still around at deadline. Once it's gone
+        it gets restarted, unless it's being stopped.
+        """
+        status = self.process.poll()
+        if status is None:
+            if deadline is not None and self.loop.time() >= deadline:
+                warning("Worker for %s didn't exit, killing it" % self.name)
+                self.process.kill()
+                deadline = None
+            self._reap_handle = self.loop.call_later(self.REAP_INTERVAL,
+                                                     self._reap, deadline)
+            return
+
+        self._reap_handle = None
+        self._close_channel()
+        if self.stopping:
+            return
+
+        # Only back off for workers that crash soon after starting
+        if self.loop.time() - self._started > self.MAX_RESTART_DELAY:
+            self._restart_delay = self.RESTART_DELAY
+        error('Worker for %s exited with status %d, restarting in %gs' % (
+            self.name, status, self._restart_delay))
+        self._restart()
+
+    def _restart(self):
+        self._restart_handle = self.loop.call_later(self._restart_delay,
+                                                    self.start)
+        self._restart_delay = min(self._restart_delay * 2,
+                                  self.MAX_RESTART_DELAY)
+
+    def _close_channel(self):
+        if self.channel is not None:
+            self.loop.remove_reader(self.channel.fileno())
+            self.channel.close()
+            self.channel = None
+
+    def connect(self):
+        """
+        Open a new connection to the worker's control server, and return our
+        end of it. Raises a ProtocolError if the worker isn't running.
+        """
+        if self.channel is None:
+            raise ProtocolError("Gadget '%s' is restarting" % self.name)
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            socket.send_fds(self.channel, [b'\0'], [theirs.fileno()])
+        except OSError as e:
+            ours.close()
+            raise ProtocolError("Failed to reach the worker for '%s': %s" % (
+                self.name, e.strerror))
+        finally:
+            theirs.close()
+
+        return ours
+
+    def reload(self):
+        """ Have the worker reload its part of the config """
+        if self.channel is not None:
+            self.process.send_signal(signal.SIGHUP)
+
+    def stop(self):
+        """
+        Ask the worker to exit. It's reaped from the loop, or call wait() to
+        wait for it to exit right away.
+        """
+        self.stopping = True
+        if self._restart_handle is not None:
+            self._restart_handle.cancel()
+            self._restart_handle = None
+
+        # Closing the channel would make the worker exit too, and a second
+        # signal could kill it before it removes its gadget
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            if self._reap_handle is None:
+                self._reap(self.loop.time() + self.STOP_TIMEOUT)
+
+    def wait(self):
+        if self._reap_handle is not None:
+            self._reap_handle.cancel()
+            self._reap_handle = None
+
+        if self.process is not None:
+            try:
+                self.process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                warning("Worker for %s didn't exit, killing it" % self.name)
+                self.process.kill()
+                self.process.wait()
+
+        self._close_channel()
+
+class Link(asyncio.Protocol):
+    """
+    A control client's connection to one worker. Messages are numbered by the
+    worker in the order we forward them, so we keep the client's sequence
+    number for each one until the worker acks it.
+
+    Keyword arguments:
+    router -- The RoutingProtocol of the client
+    name -- The name of the worker's gadget
+    """
+    def __init__(self, router, name):
+        self.router = router
+        self.name = name
+        self.transport = None
+        """ How many messages we've forwarded, and the worker has acked """
+        self.sent = 0
+        self.acked = 0
+        self._seqs = deque()
+        self._out = list()
+        self._buf = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.flush()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        for seq in self._seqs:
+            self.router.error(seq, ("Worker for '%s' went away" %
+                                    self.name).encode())
+        self._seqs.clear()
+        self.acked = self.sent
+        self.router.link_lost(self)
+
+    def forward(self, seq, message):
+        """ Queue a message for the worker, until flush() is called """
+        self._seqs.append(seq)
+        self._out.append(message)
+        self.sent += 1
+
+    def flush(self):
+        if self.transport is not None and self._out:
+            self.transport.write(b''.join(self._out))
+            self._out.clear()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data):
+        if self._buf:
+            data = self._buf + data
+        end = len(data)
+
+        offset = 0
+        while end - offset >= LENGTH.size:
+            length, = LENGTH.unpack_from(data, offset)
+            reply_end = offset + LENGTH.size + length
+            if reply_end > end:
+                break
+
+            if data[offset + LENGTH.size] == REPLY_ERROR:
+                _, _, seq = ERROR.unpack_from(data, offset)
+                self.router.error(self._seqs[seq - self.acked],
+                                  data[offset + ERROR.size:reply_end])
+            else:
+                _, _, seq, count = ACK.unpack_from(data, offset)
+                for i in range(seq + 1 - self.acked):
+                    self._seqs.popleft()
+                self.acked = seq + 1
+
+            offset = reply_end
+
+        self._buf = data[offset:]
+        self.router.flush_replies()
+
+class Batch():
+    """
+    The messages handled from a single read from a control client, which get
+    a single ack once every worker they went to has acked them
+    """
+    __slots__ = ['first', 'last', 'errors', 'marks']
+
+    def __init__(self, first, last, errors, marks):
+        self.first = first
+        self.last = last
+        self.errors = errors
+        """ How many messages each Link has to have acked """
+        self.marks = marks
+
+    @property
+    def done(self):
+        return all(link.acked >= sent for link, sent in self.marks.items())
+
+class RoutingProtocol(asyncio.Protocol):
+    """
+    Handles the messages from a single control client in the supervisor,
+    forwarding each one to the worker for its target. Messages to a broadcast
+    group are sent to the worker of every member with the target swapped
+    out. Replies from the workers are merged back together, so the client
+    sees exactly what it would from a single daemon.
+
+    Keyword arguments:
+    supervisor -- The Supervisor with the workers and groups to route to
+    """
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.loop = supervisor.loop
+        self.transport = None
+        self._buf = b''
+        self._seq = 0
+        self._links = dict()
+        self._batches = deque()
+
+    def connection_made(self, transport):
+        debug('Control client connected')
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        debug('Control client disconnected')
+        self.transport = None
+        for link in list(self._links.values()):
+            link.close()
+        self._links.clear()
+
+    def _link(self, name):
+        link = self._links.get(name)
+        if link is None:
+            sock = self.supervisor.workers[name].connect()
+            link = Link(self, name)
+            self._links[name] = link
+            self.loop.create_task(
+                self.loop.connect_accepted_socket(lambda: link, sock))
+
+        return link
+
+    def _route(self, view, seq, links):
+        length, op, function, target_length = HEADER.unpack_from(view)
+        payload_start = HEADER.size + target_length
+        if payload_start > len(view):
+            raise ProtocolError('Target runs past the end of the message')
+        target = decode_text(view[HEADER.size:payload_start], 'Target')
+        if op in (OP_ATTACH, OP_DETACH):
+            raise ProtocolError('Pools are not enabled')
+
+        if target in self.supervisor.workers:
+            routes = [(target, view)]
+        else:
+            members = self.supervisor.groups.get(target)
+            if members is None:
+                raise ProtocolError("Unknown target '%s'" % target)
+            if op == OP_RECORD:
+                raise ProtocolError("Can't record broadcast group '%s'" %
+                                    target)
+
+            payload = view[payload_start:]
+            routes = [(member, encode_message(op, member, function, payload))
+                      for member in members]
+
+        for name, message in routes:
+            link = self._link(name)
+            link.forward(seq, message)
+            links.add(link)
+
+    def error(self, seq, message):
+        """ Record a worker's error for the client's message seq """
+        for batch in self._batches:
+            if batch.first <= seq <= batch.last:
+                batch.errors.append((seq, message))
+                return
+
+    def link_lost(self, link):
+        if self._links.get(link.name) is link:
+            del self._links[link.name]
+        self.flush_replies()
+
+    def flush_replies(self):
+        """ Send the replies for every batch at the front that's done """
+        while self._batches and self._batches[0].done:
+            batch = self._batches.popleft()
+            if self.transport is None:
+                continue
+
+            batch.errors.sort(key=lambda seq_error: seq_error[0])
+            replies = [encode_error(seq, message)
+                       for seq, message in batch.errors]
+            replies.append(encode_ack(batch.last,
+                                      batch.last - batch.first + 1))
+            self.transport.write(b''.join(replies))
+
+    def data_received(self, data):
+        if self._buf:
+            data = self._buf + data
+        view = memoryview(data)
+        end = len(view)
+
+        first = self._seq
+        offset = 0
+        errors = list()
+        links = set()
+        while end - offset >= LENGTH.size:
+            length, = LENGTH.unpack_from(view, offset)
+            message_end = offset + LENGTH.size + length
+            if message_end > end:
+                break
+
+            try:
+                if length < HEADER.size - LENGTH.size:
+                    raise ProtocolError('Message too short')
+                self._route(view[offset:message_end], self._seq, links)
+            except (ProtocolError, OSError) as e:
+                errors.append((self._seq, str(e).encode()))
+
+            self._seq += 1
+            offset = message_end
+
+        self._buf = bytes(view[offset:])
+        if self._seq == first:
+            return
+
+        for link in links:
+            link.flush()
+        self._batches.append(Batch(first, self._seq - 1, errors,
+                                   {link: link.sent for link in links}))
+        self.flush_replies()
+
+class RoutingServer(ControlServer):
+    """ Listens for control clients, and routes their input to the workers """
+    def __init__(self, loop, supervisor, path=None, address=None):
+        super().__init__(loop, supervisor.workers, supervisor.groups,
+                         path=path, address=address)
+        self.supervisor = supervisor
+
+    def _create_protocol(self):
+        return RoutingProtocol(self.supervisor)
+
+class Supervisor():
+    """
+    Starts a worker for every gadget, and keeps them running until we get
+    signalled
+
+    Keyword arguments:
+    config -- The DaemonConfig to start workers for
+    config_path -- Where the config was loaded from. The workers load it from
+                   there too, and it's reloaded on SIGHUP.
+    verbose -- Whether the workers should show debugging messages
+    profile_startup -- Whether the workers should show their startup profiles
+    """
+    def __init__(self, config, config_path, verbose=False,
+                 profile_startup=False):
+        self.config = config
+        self.config_path = config_path
+        self.verbose = verbose
+        self.profile_startup = profile_startup
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.workers = dict()
+        self.groups = dict()
+        self._update_workers(config)
+
+        self.control_server = RoutingServer(
+            self.loop, self, path=config.get('hidrelayd', 'control_socket'),
+            address=config.get_control_address())
+        self.loop.run_until_complete(self.control_server.start())
+
+    def _update_workers(self, config):
+        names = config.get_gadget_specs()
+        for name in list(self.workers):
+            if name not in names:
+                info('Stopping the worker for %s' % name)
+                self.workers.pop(name).stop()
+
+        for name in names:
+            if name not in self.workers:
+                info('Starting a worker for %s' % name)
+                self.workers[name] = Worker(self.loop, name, self.config_path,
+                                            self.verbose,
+                                            self.profile_startup)
+
+        # Updated in place since the control clients share it
+        self.groups.clear()
+        for section in config.sections():
+            if section.startswith('group:'):
+                self.groups[section.split(':')[1]] = \
+                    config.get_group_members(section)
+
+    def reload(self):
+        """
+        Reload the config, starting and stopping workers for gadgets that
+        were added or removed. The rest are told to reload it themselves.
+        """
+        info('Reloading %s' % self.config_path)
+        config = DaemonConfig()
+        try:
+            with open(self.config_path) as f:
+                config.read_file(f, self.config_path)
+        except (OSError, configparser.Error) as e:
+            error('Failed to reload config, keeping the old one: %s' % e)
+            return
+
+        if dict(config['hidrelayd']) != dict(self.config['hidrelayd']):
+            warning('Changes to the [hidrelayd] section require a restart')
+            config['hidrelayd'] = self.config['hidrelayd']
+
+        self.config = config
+        running = set(self.workers)
+        self._update_workers(config)
+        for name in running & set(self.workers):
+            self.workers[name].reload()
+
+    def run(self):
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.add_signal_handler(sig, self.loop.stop)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+        info('All workers have been started')
+        try:
+            self.loop.run_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.control_server.close()
+        for worker in self.workers.values():
+            worker.stop()
+        for worker in self.workers.values():
+            worker.wait()
+
+        self.loop.close()
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+Timed input, like holding a key down for a while or tapping it every so
+often, driven from a single hashed timer wheel per event loop. Adding or
+cancelling a timer is O(1), and the wheel only wakes up when there's a slot
+with timers in it, so thousands of held keys on as many gadgets cost about as
+much as one.
+"""
+
+import weakref
+from math import ceil, floor
+
+""" How far apart the ticks of the wheel are, in seconds """
+RESOLUTION = 0.001
+""" How many slots the wheel has, must be a power of two """
+SLOT_COUNT = 512
+
+class Timer():
+    """ A callback scheduled on a TimerWheel """
+    __slots__ = ['tick', 'callback', 'args', 'wheel']
+
+    def __init__(self, tick, callback, args, wheel):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.wheel = wheel
+
+    @property
+    def cancelled(self):
+        return self.callback is None
+
+    def cancel(self):
+        """ Stop the callback from being called, if it hasn't been yet """
+        if self.callback is not None:
+            self.callback = self.args = None
+            # The timer itself gets dropped once the wheel gets to its slot
+            self.wheel._timer_done()
+
+class TimerWheel():
+    """
+    Schedules callbacks on an event loop with RESOLUTION second granularity.
+    Timers are hashed into slots by the tick they're due on, and each time
+    the wheel comes around to a slot it runs the timers in it that are due and
+    leaves the rest for a later revolution. Cancelled timers are left in
+    place until then, instead of being searched for.
+
+    Keyword arguments:
+    loop -- The event loop to run callbacks from
+    """
+    def __init__(self, loop, resolution=RESOLUTION, slot_count=SLOT_COUNT):
+        assert slot_count & (slot_count - 1) == 0
+
+        self.loop = loop
+        self.resolution = resolution
+        self._slots = [list() for i in range(slot_count)]
+        self._mask = slot_count - 1
+        self._epoch = loop.time()
+        # The last tick we ran the timers for
+        self._tick = 0
+        self._pending = 0
+        self._handle = None
+        self._wakeup_tick = None
+
+    @property
+    def pending(self):
+        """ The number of timers that haven't run or been cancelled yet """
+        return self._pending
+
+    def call_at(self, when, callback, *args):
+        """
+        Call callback(*args) at the loop time when, or on the next tick if
+        that's already passed. Returns a Timer that can be cancelled.
+        """
+        tick = max(ceil((when - self._epoch) / self.resolution),
+                   self._tick + 1)
+        timer = Timer(tick, callback, args, self)
+        self._slots[tick & self._mask].append(timer)
+        self._pending += 1
+        if self._wakeup_tick is None or tick < self._wakeup_tick:
+            self._schedule(tick)
+
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """ Call callback(*args) in delay seconds """
+        return self.call_at(self.loop.time() + delay, callback, *args)
+
+    def _timer_done(self):
+        self._pending -= 1
+        if not self._pending and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._wakeup_tick = None
+
+    def _schedule(self, tick):
+        if self._handle is not None:
+            self._handle.cancel()
+
+        self._wakeup_tick = tick
+        self._handle = self.loop.call_at(self._epoch + tick * self.resolution,
+                                         self._run)
+
+    def _next_tick(self):
+        """
+        Find the next tick with anything in its slot, looking at most one
+        revolution ahead
+        """
+        slots = self._slots
+        mask = self._mask
+        for tick in range(self._tick + 1, self._tick + mask + 2):
+            if slots[tick & mask]:
+                return tick
+
+        return self._tick + mask + 1
+
+    def _run(self):
+        # The loop may run us a hair early, within its clock's resolution
+        now = max(floor((self.loop.time() - self._epoch) / self.resolution),
+                  self._wakeup_tick)
+        self._handle = None
+        self._wakeup_tick = None
+        slots = self._slots
+        mask = self._mask
+
+        # If the loop was held up we might have ticks to catch up on, but
+        # going around the wheel once covers every timer that's due
+        for tick in range(max(self._tick + 1, now - mask), now + 1):
+            self._tick = tick
+            slot = slots[tick & mask]
+            if not slot:
+                continue
+
+            due = [timer for timer in slot if timer.tick <= tick]
+            if len(due) == len(slot):
+                slot.clear()
+            else:
+                slot[:] = [timer for timer in slot if timer.tick > tick]
+
+            for timer in due:
+                callback, args = timer.callback, timer.args
+                if callback is None:
+                    continue
+
+                timer.callback = timer.args = None
+                self._pending -= 1
+                try:
+                    callback(*args)
+                except Exception as e:
+                    self.loop.call_exception_handler({
+                        'message': 'Exception in timer callback %r' % callback,
+                        'exception': e,
+                    })
+        self._tick = max(self._tick, now)
+
+        # Callbacks may have added timers, but none of them can be due
+        # before the next slot we find
+        if self._pending:
+            self._schedule(self._next_tick())
+
+_wheels = weakref.WeakKeyDictionary()
+
+def get_wheel(loop):
+    """ Get the TimerWheel for an event loop, creating it if needed """
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(loop)
+
+    return wheel
+
+def hold(loop, press, release, duration):
+    """
+    Call press() now and release() in duration seconds. Returns a future that
+    completes once release() has been called, and cancelling it calls
+    release() right away.
+    """
+    done = loop.create_future()
+    press()
+
+    def finish():
+        try:
+            release()
+        except Exception as e:
+            done.set_exception(e)
+            return
+        done.set_result(None)
+
+    timer = get_wheel(loop).call_later(duration, finish)
+
+    def cancelled(future):
+        if future.cancelled():
+            timer.cancel()
+            release()
+
+    done.add_done_callback(cancelled)
+    return done
+
+def repeat(loop, action, interval, until=None):
+    """
+    Call action() now and then every interval seconds, until until() returns
+    true (checked before each call) or, if until is a number, until that many
+    seconds have passed. With no until, this goes on until it's cancelled.
+    Returns a future that completes with the number of times action() was
+    called, and cancelling it stops the repeating.
+    """
+    done = loop.create_future()
+    wheel = get_wheel(loop)
+    start = loop.time()
+    if until is None or callable(until):
+        check = until
+    else:
+        deadline = start + until
+        check = lambda: loop.time() >= deadline
+
+    timer = None
+    count = 0
+    # Use absolute deadlines so that scheduling delays don't add up
+    def run():
+        nonlocal timer, count
+        if check is not None and check():
+            done.set_result(count)
+            return
+
+        try:
+            action()
+        except Exception as e:
+            done.set_exception(e)
+            return
+
+        count += 1
+        timer = wheel.call_at(start + count * interval, run)
+
+    def cancelled(future):
+        if future.cancelled() and timer is not None:
+            timer.cancel()
+
+    done.add_done_callback(cancelled)
+    run()
+    return done
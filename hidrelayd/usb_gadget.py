@@ -32,20 +32,57 @@ from enum import Enum
 from logging import debug, info, error
 from itertools import count
 
+""" Where the kernel's USB gadget configfs interface is normally mounted """
+CONFIGFS_ROOT = '/sys/kernel/config/usb_gadget'
+
+def _read_udc(gadget_path):
+    with open(gadget_path + '/UDC') as udc_ctl:
+        return udc_ctl.read().strip()
+
+def _write_udc(gadget_path, udc_dev):
+    # Written directly, the UDC isn't an attribute that adopted gadgets
+    # should compare against
+    debug('%s: "%s" -> UDC' % (gadget_path, udc_dev.strip()))
+    with open(gadget_path + '/UDC', 'w') as udc_ctl:
+        udc_ctl.write(udc_dev)
+
+def _differs(attr_path, value):
+    """ Check whether a configfs attribute has a different value """
+    with open(attr_path,
+              mode='rb' if isinstance(value, bytes) else 'r') as attr:
+        current = attr.read()
+    if not isinstance(value, bytes):
+        current = current.strip()
+
+    return current != value
+
 class ConfigfsDir():
-    def __init__(self, path, is_child=False):
+    def __init__(self, path, is_child=False, adopt=False, on_change=None):
         """
         This is a configfs helper that helps with automatic cleanup of the sysfs
         directories and links that we make by removing them from most recently
         created to least recently created (so as not to make kernel drivers
         complain)
+
+        Keyword arguments:
+        adopt -- Reuse the directory (and any children) if it already exists,
+                 only writing attributes whose values differ
+        on_change -- Called before anything in an adopted directory is changed
         """
         self.path = path
         self.__keep_alive = list()
         self.__child_dirs = list()
         self.__child_links = list()
         self.__extra_cleanup_cbs = list()
-        os.mkdir(self.path)
+        self._adopt = adopt
+        self._on_change = on_change
+
+        if adopt and os.path.isdir(self.path):
+            debug('%s: adopting existing directory' % self.path)
+            self.adopted = True
+        else:
+            os.mkdir(self.path)
+            self.adopted = False
 
         # Ensures directories always get cleaned up on GC
         def cleanup_cb(path, child_dirs, child_links, extra_cleanup_cbs):
@@ -76,10 +113,26 @@ class ConfigfsDir():
         if is_child:
             self._cleanup_handler.atexit = False
 
+    def remove(self):
+        """
+        Remove this directory along with everything we created inside of it
+        right away, instead of waiting for it to be garbage collected
+        """
+        self._cleanup_handler()
+
     def _register_cleanup_cb(self, cb, *args, **kwargs):
         self.__extra_cleanup_cbs.append(tuple([cb, args, kwargs]))
 
+    def _changing(self):
+        if self._on_change:
+            self._on_change()
+
     def _set(self, path, value):
+        if self.adopted:
+            if not _differs(self.path + '/' + path, value):
+                return
+            self._changing()
+
         if isinstance(value, str):
             debug('%s: "%s" -> %s' % (self.path, value, path))
 
@@ -102,7 +155,8 @@ class ConfigfsDir():
         """
         debug('%s: mkdir %s' % (self.path, path))
 
-        new_dir = ConfigfsDir('%s/%s' % (self.path, path), True)
+        new_dir = ConfigfsDir('%s/%s' % (self.path, path), True,
+                              self._adopt, self._on_change)
         if keep_ref:
             self.__keep_alive.append(new_dir)
 
@@ -114,14 +168,106 @@ class ConfigfsDir():
         Create a link to another ConfigfsDir object inside this one. If the
         object is destroyed before self, it's link is automatically removed.
         """
-        debug('%s: %s -> %s' % (self.path, name, dest.path))
-        os.symlink(dest.path, self.path + '/' + name)
+        link_path = self.path + '/' + name
+        if self.adopted and os.path.islink(link_path) and \
+           os.path.realpath(link_path) == os.path.realpath(dest.path):
+            debug('%s: adopting link %s' % (self.path, name))
+        else:
+            self._changing()
+            debug('%s: %s -> %s' % (self.path, name, dest.path))
+            os.symlink(dest.path, link_path)
 
         def link_cleanup_cb(link_path):
             os.remove(link_path)
 
-        self.__child_links.append(weakref.finalize(dest, link_cleanup_cb,
-                                                   self.path + '/' + name))
+        finalizer = weakref.finalize(dest, link_cleanup_cb, link_path)
+        # Like child directories, links are removed by their parent at exit,
+        # if they're removed at all
+        if self._adopt:
+            finalizer.atexit = False
+        self.__child_links.append(finalizer)
+
+    def _unlink(self, name):
+        """ Remove a link created with _link() """
+        link_path = self.path + '/' + name
+        for finalizer in self.__child_links:
+            link = finalizer.peek()
+            if link and link[2] == (link_path,):
+                finalizer()
+                self.__child_links.remove(finalizer)
+                return
+
+class HidgMonitor():
+    """
+    Keeps track of the device nodes for the hidg char devs on the system. Nodes
+    are looked up through udev the first time they're needed, and after that
+    a udev monitor running on the event loop keeps the mapping current as UDCs
+    get bound and unbound, so finding the node for a function doesn't require
+    a trip through udev.
+    """
+    def __init__(self):
+        self.context = pyudev.Context()
+        self.nodes = dict()
+        self._remove_cbs = dict()
+        self._monitor = None
+        self._loop = None
+
+    def start(self, loop):
+        """ Start watching for hidg devices being added or removed """
+        self._monitor = pyudev.Monitor.from_netlink(self.context)
+        self._monitor.filter_by('hidg')
+        self._monitor.start()
+        self._loop = loop
+        loop.add_reader(self._monitor.fileno(), self._handle_events)
+
+    def stop(self):
+        if self._monitor is None:
+            return
+
+        self._loop.remove_reader(self._monitor.fileno())
+        self._monitor = None
+        self._loop = None
+
+    def _handle_events(self):
+        for device in iter(functools.partial(self._monitor.poll, 0), None):
+            device_number = device.device_number
+            debug('udev: %s %s' % (device.action, device.device_node))
+            if device.action == 'add':
+                self.nodes[device_number] = device.device_node
+            elif device.action == 'remove':
+                self.nodes.pop(device_number, None)
+                for cb in self._remove_cbs.pop(device_number, []):
+                    cb()
+
+    def find_node(self, device_number):
+        """
+        Find the device node for a hidg char dev, raising a
+        pyudev.DeviceNotFoundByNumberError if it doesn't exist
+        """
+        try:
+            return self.nodes[device_number]
+        except KeyError:
+            pass
+
+        device = pyudev.Devices.from_device_number(self.context, 'char',
+                                                   device_number)
+        self.nodes[device_number] = device.device_node
+        return device.device_node
+
+    def watch(self, device_number, cb):
+        """
+        Register a callback to be called once the given hidg char dev is
+        removed, e.g. because its gadget was unbound
+        """
+        self._remove_cbs.setdefault(device_number, []).append(cb)
+
+    def unwatch(self, device_number, cb):
+        cbs = self._remove_cbs.get(device_number, [])
+        if cb in cbs:
+            cbs.remove(cb)
+
+""" The HidgMonitor shared by every UsbGadget """
+hidg_monitor = HidgMonitor()
 
 class UsbProtocolVersion(Enum):
     """ A set of enumerators for each USB protocol revision """
@@ -144,6 +290,12 @@ class UsbGadget(ConfigfsDir):
     manufacturer -- A string containing the name of the manufacturer for the
                     gadget
     product -- A string containing the product name for the gadget
+    configfs_root -- The directory to create the gadget in
+    persistent -- Adopt an existing gadget with the same name instead of
+                  recreating it, and leave it in place (and bound) when we
+                  exit, so restarting the daemon is invisible to the host
+    adopt -- Adopt an existing gadget with the same name, but still remove it
+             when we exit. Defaults to the value of persistent.
     """
 
     class Exception(Exception):
@@ -153,14 +305,29 @@ class UsbGadget(ConfigfsDir):
                  version=UsbProtocolVersion.USB_1_1,
                  vendor_id=0xa4ac, product_id=0x0525,
                  serial='', manufacturer='Lyude',
-                 product='Wolf powered HID gadget'):
+                 product='Wolf powered HID gadget',
+                 configfs_root=CONFIGFS_ROOT, persistent=False, adopt=None):
         assert isinstance(version, UsbProtocolVersion)
         assert isinstance(serial, str)
         assert isinstance(manufacturer, str)
         assert isinstance(product, str)
 
         self.name = name
-        super().__init__('/sys/kernel/config/usb_gadget/' + name)
+        path = configfs_root + '/' + name
+
+        # The kernel won't let us change a function while it's bound, and
+        # changes to anything else wouldn't reach the host until it
+        # re-enumerates us anyway
+        def unbind_for_change():
+            if _read_udc(path):
+                info('%s: unbinding to apply configuration changes' % name)
+                _write_udc(path, '\n')
+
+        if adopt is None:
+            adopt = persistent
+        super().__init__(path, adopt=adopt, on_change=unbind_for_change)
+        if persistent:
+            self._cleanup_handler.atexit = False
 
         """ The serial number string for the USB gadget """
         self.serial = serial
@@ -172,11 +339,21 @@ class UsbGadget(ConfigfsDir):
         self.bound = False
 
         self._function_id = count(start=1)
-        self._bound_devs = list()
-
-        self._set('idVendor', hex(vendor_id))
-        self._set('idProduct', hex(product_id))
-        self._set('bcdUSB', hex(version.value))
+        self._device_numbers = dict()
+        self._bound_devs = dict()
+
+        # Functions left over from when we adopted the gadget, any we don't
+        # claim again get removed before binding
+        if self.adopted:
+            self._stale_functions = set(os.listdir(self.path + '/functions'))
+        else:
+            self._stale_functions = set()
+
+        # Written the same way configfs formats them, so that adopted gadgets
+        # compare equal
+        self._set('idVendor', '0x%04x' % vendor_id)
+        self._set('idProduct', '0x%04x' % product_id)
+        self._set('bcdUSB', '0x%04x' % version.value)
 
         strings = self._mkdir('strings/0x409')
         strings._set('serialnumber', serial)
@@ -192,7 +369,7 @@ class UsbGadget(ConfigfsDir):
 
         # Make sure we unbind our UDC device before getting GCd
         def unbind_cleanup_cb(bound_devs, udc_ctl):
-            for dev in bound_devs:
+            for dev in bound_devs.values():
                 dev.close()
             bound_devs.clear()
 
@@ -205,32 +382,103 @@ class UsbGadget(ConfigfsDir):
         self._register_cleanup_cb(unbind_cleanup_cb, self._bound_devs,
                                   self.path + '/UDC')
 
-    def create_function(self, protocol, report_length, report_descriptor):
+    def create_function(self, protocol, report_length, report_descriptor,
+                        boot_protocol=True):
         function_name = 'hid.usb%d' % next(self._function_id)
+        self._stale_functions.discard(function_name)
+        attributes = {
+            'protocol': str(protocol),
+            'report_length': str(report_length),
+            'report_desc': bytes(report_descriptor),
+            'subclass': '1' if boot_protocol else '0',
+        }
+
+        # f_hid refuses to change a function while it's linked into a config,
+        # so an adopted function that doesn't match gets replaced
+        function_path = '%s/functions/%s' % (self.path, function_name)
+        if self.adopted and os.path.isdir(function_path) and \
+           any(_differs(function_path + '/' + name, value)
+               for name, value in attributes.items()):
+            info('%s: recreating changed function %s' % (self.name,
+                                                         function_name))
+            self._remove_function_dir(function_name)
 
         function = self._mkdir('functions/%s' % function_name, keep_ref=False)
-        function._set('protocol', str(protocol))
-        function._set('report_length', str(report_length))
-        function._set('report_desc', bytes(report_descriptor))
-        function._set('subclass', '1')
+        for name, value in attributes.items():
+            function._set(name, value)
         self._gadget_config._link(function_name, function)
 
         return function
 
+    def remove_function(self, function):
+        """
+        Remove a function created with create_function(). The gadget must be
+        unbound first.
+        """
+        assert not self.bound
+        self._gadget_config._unlink(os.path.basename(function.path))
+        self._device_numbers.pop(function.path, None)
+        function.remove()
+
     def find_hidg_device(self, function):
-        device_number = os.makedev(*[int(n) for n in
-                                     function._get('dev').split(':')])
-        device = pyudev.Devices.from_device_number(pyudev.Context(), 'char',
-                                                   device_number)
-        char_dev = open(device.device_node, 'wb', buffering=0)
+        """
+        Open the hidg char dev for one of our functions. The device number for
+        a function never changes, so it's only read from configfs once.
+        """
+        try:
+            device_number = self._device_numbers[function.path]
+        except KeyError:
+            device_number = os.makedev(*[int(n) for n in
+                                         function._get('dev').split(':')])
+            self._device_numbers[function.path] = device_number
+
+        node = hidg_monitor.find_node(device_number)
+        char_dev = os.fdopen(os.open(node, os.O_RDWR | os.O_NONBLOCK),
+                             'r+b', buffering=0)
+
+        old_dev = self._bound_devs.get(device_number)
+        if old_dev is not None:
+            old_dev.close()
+        self._bound_devs[device_number] = char_dev
 
-        self._bound_devs.append(char_dev)
         return char_dev
 
+    def _remove_function_dir(self, function_name):
+        """
+        Remove a function that we didn't create ourselves, unbinding the
+        gadget and unlinking the function from the config first
+        """
+        self._changing()
+
+        config_path = self._gadget_config.path
+        function_path = '%s/functions/%s' % (self.path, function_name)
+        self._device_numbers.pop(function_path, None)
+        for link in os.listdir(config_path):
+            link_path = config_path + '/' + link
+            if os.path.islink(link_path) and \
+               os.path.realpath(link_path) == os.path.realpath(function_path):
+                os.remove(link_path)
+        os.rmdir(function_path)
+
+    def _prune_functions(self):
+        for function_name in self._stale_functions:
+            info('%s: removing stale function %s' % (self.name, function_name))
+            self._remove_function_dir(function_name)
+
+        self._stale_functions.clear()
+
     def bind(self, udc_dev):
+        self._prune_functions()
+        if _read_udc(self.path) == udc_dev:
+            info('%s is already bound to %s' % (self.name, udc_dev))
+            self.bound = True
+            return
+
         info('Binding %s to %s' % (self.name, udc_dev))
         try:
-            self._set('UDC', udc_dev)
+            if _read_udc(self.path):
+                _write_udc(self.path, '\n')
+            _write_udc(self.path, udc_dev)
         except OSError as e:
             if e.errno == errno.ENODEV:
                 raise UsbGadget.Exception('No HID devices added to gadget')
@@ -242,10 +490,11 @@ class UsbGadget(ConfigfsDir):
     def unbind(self):
         debug('Unbinding %s' % self.name)
         # Drop any hidg nodes that depended on this binding
-        for dev in self._bound_devs:
+        for dev in self._bound_devs.values():
             dev.close()
 
-        self._set('UDC', '\n')
+        if _read_udc(self.path):
+            _write_udc(self.path, '\n')
         self.bound = False
 
         self._bound_devs.clear()
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# hidrelayd - A daemon for powering remotely controllable HID devices
+#
+# Copyright (C) 2017 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# Authors:
+#   Lyude Paul <lyude@redhat.com> (or thatslyude@gmail.com)
+
+"""
+The process serving a single gadget when hidrelayd runs with workers = true.
+Each one is a Daemon cut down to its own gadget and the passthroughs to it,
+started by the supervisor (see supervisor.py), which hands control clients
+over to it through a UNIX socket on the file descriptor given with --fd. The
+worker exits when the supervisor goes away.
+"""
+
+import argparse
+import configparser
+import logging
+import os
+import socket
+import sys
+from logging import error, info
+
+from daemon import Daemon
+
+def pin(cpus):
+    """ Pin every thread in this process to a set of CPUs """
+    for tid in os.listdir('/proc/self/task'):
+        os.sched_setaffinity(int(tid), cpus)
+
+class WorkerDaemon(Daemon):
+    """
+    Keyword arguments:
+    config_path -- Where to load the config from
+    name -- The name of the gadget to serve
+    channel -- The socket the supervisor sends control clients over
+    """
+    def __init__(self, config_path, name, channel):
+        self.name = name
+        self.config_path = config_path
+        config = self._read_config()
+        self._pin(config)
+
+        super().__init__(config, config_path=config_path)
+        self.channel = channel
+        self.channel.setblocking(False)
+        self.loop.add_reader(self.channel.fileno(), self._receive_clients)
+
+    def _read_config(self):
+        return super()._read_config().get_worker_config(self.name)
+
+    def _pin(self, config):
+        cpus = config.get_cpus('gadget:' + self.name)
+        if cpus is None:
+            return
+
+        try:
+            pin(cpus)
+        except OSError as e:
+            error('Failed to pin to CPUs %s: %s' % (
+                ','.join(str(cpu) for cpu in sorted(cpus)), e.strerror))
+            return
+        info('Pinned to CPUs %s' % ','.join(str(cpu) for cpu in sorted(cpus)))
+
+    def _receive_clients(self):
+        try:
+            data, fds, flags, address = socket.recv_fds(self.channel, 1, 16)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            data, fds = b'', []
+            error('Lost the supervisor: %s' % e.strerror)
+
+        for fd in fds:
+            self.loop.create_task(
+                self.control_server.add_client(socket.socket(fileno=fd)))
+
+        if not data:
+            info('Supervisor went away, exiting')
+            self.loop.remove_reader(self.channel.fileno())
+            self.loop.stop()
+
+    def reload(self):
+        super().reload()
+        self._pin(self.config)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a single gadget for the hidrelayd supervisor"
+    )
+    parser.add_argument('-v', '--verbose', help='Show debugging messages',
+                        action="store_true")
+    parser.add_argument('-p', '--profile-startup', action="store_true",
+                        help='Show how long each phase of startup took')
+    parser.add_argument('-c', '--config', required=True,
+                        help='The configuration file to load')
+    parser.add_argument('-g', '--gadget', required=True,
+                        help='The name of the gadget to serve')
+    parser.add_argument('--fd', type=int, required=True,
+                        help='The socket to receive control clients on')
+    args = parser.parse_args()
+
+    if args.verbose:
+        level = logging.DEBUG
+    elif args.profile_startup:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+    logging.basicConfig(
+        level=level,
+        format='%%(levelname)s:%s:%%(message)s' % args.gadget)
+
+    channel = socket.socket(fileno=args.fd)
+    try:
+        worker = WorkerDaemon(args.config, args.gadget, channel)
+    except (OSError, configparser.Error, Daemon.StartupError) as e:
+        error('Failed to start: %s' % e)
+        sys.exit(1)
+
+    worker.run()
+
+if __name__ == '__main__':
+    main()
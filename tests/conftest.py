@@ -0,0 +1,105 @@
+"""
+Shared fixtures for the tests. hidrelayd's modules import each other by their
+bare names, so the package directory goes on the path the same way running
+the daemon puts it there.
+"""
+
+import asyncio
+import builtins
+import errno
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'hidrelayd'))
+
+import usb_gadget
+from benchmark import FakeConfigfs
+from ghid import ConsumerControl, Keyboard, Mouse
+
+class FakeFunction():
+    """
+    Stands in for a HidFunction, keeping every report written to it instead
+    of sending it anywhere. Nothing is ever queued, so batch input is written
+    as soon as it arrives.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.reports = list()
+        self.on_output_report = None
+        self.recorder = None
+        self.stats = None
+        self.queue_depth = 0
+        self.poll_interval = 0.001
+
+    def write(self, report, merge=None):
+        if self.recorder is not None:
+            self.recorder(report)
+        self.reports.append(bytes(report))
+
+    def write_many(self, reports, report_length):
+        for offset in range(0, len(reports), report_length):
+            self.write(reports[offset:offset + report_length])
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeRelay():
+    """ A RelayDevice whose devices write to FakeFunctions """
+    def __init__(self, loop, keyboard_cls=Keyboard, mouse_cls=Mouse):
+        self.keyboard = keyboard_cls(None, loop, FakeFunction(loop))
+        self.mouse = mouse_cls(None, loop, FakeFunction(loop))
+        self.consumer = ConsumerControl(None, loop, FakeFunction(loop))
+
+def run_until(loop, predicate, timeout=1.0):
+    """ Run the loop until predicate() is true, failing after timeout """
+    async def wait():
+        while not predicate():
+            await asyncio.sleep(0.005)
+
+    loop.run_until_complete(asyncio.wait_for(wait(), timeout))
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def relay(loop):
+    return FakeRelay(loop)
+
+""" The function attributes f_hid won't change while they're in a config """
+LOCKED_ATTRIBUTES = ('protocol', 'report_length', 'report_desc', 'subclass')
+
+@pytest.fixture
+def configfs(tmp_path, monkeypatch):
+    """
+    A fake configfs tree that, like f_hid, refuses writes to a function's
+    attributes while it's linked into a config
+    """
+    root = str(tmp_path)
+    fake_configfs = FakeConfigfs(root)
+    monkeypatch.setattr(usb_gadget, 'os', fake_configfs)
+
+    def open_attr(path, mode='r', *args, **kwargs):
+        function_path, name = os.path.split(str(path))
+        if 'w' in mode and name in LOCKED_ATTRIBUTES:
+            config_path = os.path.dirname(os.path.dirname(function_path)) + \
+                '/configs/c.1'
+            for link in os.listdir(config_path):
+                if os.path.realpath(config_path + '/' + link) == \
+                   os.path.realpath(function_path):
+                    raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+
+        return builtins.open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(usb_gadget, 'open', open_attr, raising=False)
+    yield root
+    for fd in fake_configfs.hidg_nodes:
+        os.close(fd)
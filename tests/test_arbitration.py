@@ -0,0 +1,156 @@
+import pytest
+
+from arbitration import PRIORITY_INTERACTIVE, InputArbiter, InputArbiters
+from broadcast import BroadcastGroup
+from conftest import FakeRelay, run_until
+from ghid import NkroKeyboard
+
+@pytest.fixture
+def devices(relay):
+    return {'a': relay}
+
+@pytest.fixture
+def groups():
+    return dict()
+
+@pytest.fixture
+def arbiters(loop, devices, groups):
+    return InputArbiters(loop, devices, groups)
+
+def keyboard_report(modifier_mask=0, *keys):
+    return bytes([modifier_mask, 0] + list(keys) + [0] * (6 - len(keys)))
+
+def test_sessions_are_merged(arbiters, relay):
+    first = arbiters.session('a', 'first')
+    second = arbiters.session('a', 'second')
+
+    first.press_keys(0x04, 0xe1)
+    second.press_keys(0x05)
+    assert relay.keyboard.pressed_keys == [0x04, 0x05]
+    assert relay.keyboard.modifier_mask == 0x02
+
+    second.set_keys()
+    assert relay.keyboard.pressed_keys == [0x04]
+    first.close()
+    assert relay.keyboard.pressed_keys == []
+    assert relay.keyboard.modifier_mask == 0
+
+def test_raw_press_stays_pressed(arbiters, relay):
+    session = arbiters.session('a', 'raw')
+    reports = relay.keyboard.function.reports
+
+    session.write_reports('keyboard', keyboard_report(0x02, 0x04))
+    assert reports == [keyboard_report(0x02, 0x04)]
+    assert relay.keyboard.pressed_keys == [0x04]
+    assert relay.keyboard.modifier_mask == 0x02
+
+    # What the raw report pressed is the session's to release
+    session.set_keys()
+    assert reports[-1] == keyboard_report()
+    assert relay.keyboard.pressed_keys == []
+
+def test_raw_release_is_tracked(arbiters, relay):
+    session = arbiters.session('a', 'raw')
+    reports = relay.keyboard.function.reports
+
+    session.press_keys(0x04)
+    session.write_reports('keyboard', keyboard_report())
+    assert relay.keyboard.pressed_keys == []
+    session.press_keys(0x04)
+    assert reports == [keyboard_report(0, 0x04), keyboard_report(),
+                       keyboard_report(0, 0x04)]
+
+def test_raw_reports_keep_other_sessions_keys(arbiters, relay):
+    held = arbiters.session('a', 'held')
+    raw = arbiters.session('a', 'raw')
+    reports = relay.keyboard.function.reports
+
+    held.press_keys(0x04)
+    raw.write_reports('keyboard', keyboard_report(0, 0x05) +
+                      keyboard_report())
+    assert reports[-1] == keyboard_report(0, 0x04)
+    assert relay.keyboard.pressed_keys == [0x04]
+
+def test_raw_mouse_and_consumer(arbiters, relay):
+    session = arbiters.session('a', 'raw')
+
+    session.write_reports('mouse', bytes([0x01, 5, 0]))
+    assert relay.mouse.function.reports == [bytes([0x01, 5, 0])]
+    assert relay.mouse.btn_mask == 0x01
+    session.set_buttons()
+    assert relay.mouse.function.reports[-1] == bytes(3)
+
+    session.write_reports('consumer', bytes([0xe9, 0x00]))
+    assert relay.consumer.usage == 0xe9
+    assert len(relay.consumer.function.reports) == 1
+
+def test_raw_nkro_reports(loop, arbiters, devices):
+    devices['a'] = relay = FakeRelay(loop, keyboard_cls=NkroKeyboard)
+    session = arbiters.session('a', 'raw')
+    report = bytearray(NkroKeyboard.packet.size)
+    NkroKeyboard.pack_press(report, 0, 0, 0x70)
+
+    session.write_reports('keyboard', report)
+    assert relay.keyboard.pressed_keys == [0x70]
+    assert len(relay.keyboard.function.reports) == 1
+
+def test_priority_holds_back_batch_input(loop, arbiters, relay):
+    operator = arbiters.session('a', 'operator', PRIORITY_INTERACTIVE)
+    script = arbiters.session('a', 'script')
+
+    operator.press_keys(0x04)
+    script.press_keys(0x05)
+    assert relay.keyboard.pressed_keys == [0x04]
+
+    operator.release_keys(0x04)
+    assert relay.keyboard.pressed_keys == []
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x05],
+              timeout=InputArbiter.IDLE_TIMEOUT * 4)
+
+def test_lock(arbiters, relay):
+    holder = arbiters.session('a', 'holder')
+    other = arbiters.session('a', 'other')
+
+    holder.lock()
+    with pytest.raises(InputArbiter.Exception, match='is locked by holder'):
+        other.lock()
+    other.press_keys(0x05)
+    assert relay.keyboard.pressed_keys == []
+
+    holder.unlock()
+    assert relay.keyboard.pressed_keys == [0x05]
+
+def test_group_fans_out(loop, arbiters, devices, groups, relay):
+    devices['b'] = member = FakeRelay(loop)
+    groups['g'] = BroadcastGroup('g', dict(devices), loop)
+    session = arbiters.session('g', 'group')
+
+    session.press_keys(0x04)
+    session.write_reports('mouse', bytes([0x02, 1, 1]))
+    for device in (relay, member):
+        assert device.keyboard.pressed_keys == [0x04]
+        assert device.mouse.btn_mask == 0x02
+
+    session.close()
+    for device in (relay, member):
+        assert device.keyboard.pressed_keys == []
+        assert device.mouse.btn_mask == 0
+
+def test_group_lock_is_all_or_nothing(loop, arbiters, devices, groups):
+    devices['b'] = FakeRelay(loop)
+    groups['g'] = BroadcastGroup('g', dict(devices), loop)
+    arbiters.session('b', 'holder').lock()
+    session = arbiters.session('g', 'group')
+
+    with pytest.raises(InputArbiter.Exception):
+        session.lock()
+    assert arbiters.arbiters['a'].lock_holder is None
+
+def test_bad_input(arbiters):
+    session = arbiters.session('a', 'bad')
+    with pytest.raises(ValueError, match='Unknown mouse buttons'):
+        session.set_buttons(0xff)
+    with pytest.raises(ValueError, match='Raw reports must be 3 bytes'):
+        session.write_reports('mouse', bytes(4))
+    with pytest.raises(InputArbiter.Exception, match='absolute mouse'):
+        session.move_to(1, 1)
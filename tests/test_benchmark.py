@@ -0,0 +1,31 @@
+import os
+import sys
+
+import benchmark
+
+def test_fake_configfs(tmp_path):
+    root = str(tmp_path)
+    fake_configfs = benchmark.FakeConfigfs(root)
+    fake_configfs.mkdir(root + '/g')
+    assert os.listdir(root + '/g') == ['UDC']
+
+    fake_configfs.mkdir(root + '/g/functions/hid.usb1')
+    with open(root + '/g/functions/hid.usb1/dev') as dev:
+        assert dev.read() == '%d:0\n' % benchmark.FakeConfigfs.HIDG_MAJOR
+    assert os.path.exists(root + '/hidg0')
+
+    fake_configfs.rmdir(root + '/g')
+    assert not os.path.exists(root + '/g')
+    for fd in fake_configfs.hidg_nodes:
+        os.close(fd)
+
+def test_runs(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['benchmark.py', '-g', '2', '-n', '512',
+                                      '-s'])
+    benchmark.main()
+    names = [line[:28].strip() for line in
+             capsys.readouterr().out.splitlines()]
+    assert names == ['gadget setup', 'report throughput',
+                     'per-report write latency', 'type_text throughput',
+                     'move_by(3840, -2160)', 'allocs/report (keyboard)',
+                     'allocs/report (mouse)', 'gadget teardown']
@@ -0,0 +1,21 @@
+import configparser
+
+import pytest
+
+from config import DaemonConfig
+
+def gadget_config(**options):
+    daemon_config = DaemonConfig()
+    daemon_config.read_string('[gadget:g]\nudc_device = udc.0\n' + ''.join(
+        '%s = %s\n' % option for option in options.items()))
+    return daemon_config
+
+def test_mouse_modes():
+    spec = gadget_config(mouse_mode='absolute').get_gadget_spec('gadget:g')
+    assert spec.mouse_mode == 'absolute'
+    assert gadget_config().get_gadget_spec('gadget:g').mouse_mode == \
+        'relative'
+
+    with pytest.raises(configparser.Error,
+                       match="Invalid mouse mode 'tablet'"):
+        gadget_config(mouse_mode='tablet')
@@ -0,0 +1,242 @@
+import pytest
+
+from arbitration import InputArbiters
+from broadcast import BroadcastGroup
+from conftest import FakeRelay
+from control import ACK, ERROR, FUNCTION_CONSUMER, FUNCTION_KEYBOARD, \
+                    FUNCTION_MOUSE, HEADER, HOLD, LENGTH, MOVE, MOVE_TO, \
+                    OP_ATTACH, OP_HOLD, OP_LOCK, OP_MOVE, OP_MOVE_TO, \
+                    OP_PRESS, OP_PRIORITY, OP_RAW, OP_RECORD, OP_RELEASE, \
+                    OP_REPEAT, OP_SET, OP_TYPE, OP_UNLOCK, REPEAT, \
+                    REPLY_ERROR, USAGE, ControlProtocol, encode_message
+
+class FakeTransport():
+    def __init__(self):
+        self.data = b''
+
+    def get_extra_info(self, name):
+        return None
+
+    def write(self, data):
+        self.data += data
+
+def parse_replies(data):
+    """
+    Split up the replies the server sent, returning a list of (sequence
+    number, count) tuples for the acks and a list of (sequence number,
+    message) tuples for the errors
+    """
+    acks = list()
+    errors = list()
+    offset = 0
+    while offset < len(data):
+        length, = LENGTH.unpack_from(data, offset)
+        reply = data[offset:offset + LENGTH.size + length]
+        if reply[LENGTH.size] == REPLY_ERROR:
+            _, _, seq = ERROR.unpack_from(reply)
+            errors.append((seq, reply[ERROR.size:].decode()))
+        else:
+            _, _, seq, count = ACK.unpack(reply)
+            acks.append((seq, count))
+        offset += len(reply)
+
+    return acks, errors
+
+class Client():
+    """ A ControlProtocol, and what it's sent back to us """
+    def __init__(self, devices, groups, arbiters):
+        self.protocol = ControlProtocol(devices, groups, arbiters)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+
+    def send(self, *messages):
+        """ Send a batch of messages, and return the replies to it """
+        self.transport.data = b''
+        self.protocol.data_received(b''.join(messages))
+        return parse_replies(self.transport.data)
+
+    def close(self):
+        self.protocol.connection_lost(None)
+
+@pytest.fixture
+def devices(relay):
+    return {'a': relay}
+
+@pytest.fixture
+def groups():
+    return dict()
+
+@pytest.fixture
+def arbiters(loop, devices, groups):
+    return InputArbiters(loop, devices, groups)
+
+@pytest.fixture
+def client(devices, groups, arbiters):
+    client = Client(devices, groups, arbiters)
+    yield client
+    client.close()
+
+def test_press_and_release(client, relay):
+    assert client.send(
+        encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, bytes([0x04, 0xe1])),
+        encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, bytes([0x05])),
+    ) == ([(1, 2)], [])
+    assert relay.keyboard.pressed_keys == [0x04, 0x05]
+    assert relay.keyboard.modifier_mask == 0x02
+
+    assert client.send(
+        encode_message(OP_RELEASE, 'a', FUNCTION_KEYBOARD,
+                       bytes([0x04, 0x05, 0xe1])),
+    ) == ([(2, 1)], [])
+    assert relay.keyboard.pressed_keys == []
+    assert relay.keyboard.modifier_mask == 0
+
+def test_mouse_and_consumer(client, relay):
+    assert client.send(
+        encode_message(OP_SET, 'a', FUNCTION_MOUSE, bytes([0x01])),
+        encode_message(OP_MOVE, 'a', FUNCTION_MOUSE, MOVE.pack(5, -3)),
+        encode_message(OP_PRESS, 'a', FUNCTION_CONSUMER, USAGE.pack(0xe9)),
+    ) == ([(2, 3)], [])
+    assert relay.mouse.function.reports[-1] == bytes([0x01, 5, 0xfd])
+    assert relay.consumer.usage == 0xe9
+
+def test_type_text(client, relay):
+    assert client.send(
+        encode_message(OP_TYPE, 'a', FUNCTION_KEYBOARD, b'\x02ushi'),
+    ) == ([(0, 1)], [])
+
+    # Without any extra reports once the text has been typed
+    keys = [report[2] for report in relay.keyboard.function.reports]
+    assert keys == [0x0b, 0, 0x0c, 0]
+
+def test_partial_messages(client, relay):
+    message = encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, bytes([0x04]))
+    assert client.send(message[:3]) == ([], [])
+    assert client.send(message[3:] + message[:1]) == ([(0, 1)], [])
+    assert client.send(message[1:]) == ([(1, 1)], [])
+
+@pytest.mark.parametrize('message, error', [
+    (encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD), 'No keys to press'),
+    (encode_message(OP_PRESS, 'a', FUNCTION_MOUSE),
+     'Payload length must be 1, not 0'),
+    (encode_message(OP_RELEASE, 'a', FUNCTION_KEYBOARD),
+     'No keys to release'),
+    (encode_message(OP_SET, 'a', FUNCTION_KEYBOARD),
+     'Missing the modifier mask'),
+    (encode_message(OP_SET, 'a', FUNCTION_CONSUMER, b'\x01'),
+     'Payload length must be 2, not 1'),
+    (encode_message(OP_SET, 'a', FUNCTION_MOUSE, b'\xff'),
+     'Unknown mouse buttons in 0xff'),
+    (encode_message(OP_SET, 'a', FUNCTION_CONSUMER, USAGE.pack(0xffff)),
+     'Unknown consumer control usage 0xffff'),
+    (encode_message(OP_RAW, 'a', FUNCTION_KEYBOARD, bytes(3)),
+     'Raw reports must be 8 bytes long'),
+    (encode_message(OP_MOVE, 'a', FUNCTION_MOUSE, b'\x00'),
+     'Payload length must be 4 or 6, not 1'),
+    (encode_message(OP_MOVE, 'a', FUNCTION_KEYBOARD, MOVE.pack(1, 1)),
+     'Only mice can be moved'),
+    (encode_message(OP_MOVE_TO, 'a', FUNCTION_MOUSE, MOVE_TO.pack(1, 1)),
+     "'a' doesn't have an absolute mouse"),
+    (encode_message(OP_TYPE, 'a', FUNCTION_KEYBOARD),
+     'Missing the layout name'),
+    (encode_message(OP_TYPE, 'a', FUNCTION_KEYBOARD, b'\x09us'),
+     'Missing the layout name'),
+    (encode_message(OP_TYPE, 'a', FUNCTION_KEYBOARD, b'\x02us\xff'),
+     'Text must be utf-8'),
+    (encode_message(OP_TYPE, 'a', FUNCTION_KEYBOARD, b'\x02xxhi'),
+     "Unknown keyboard layout 'xx'"),
+    (encode_message(OP_HOLD, 'a', FUNCTION_KEYBOARD, HOLD.pack(10)),
+     'Payload length must be 5, not 4'),
+    (encode_message(OP_HOLD, 'a', FUNCTION_CONSUMER,
+                    HOLD.pack(10) + b'\x01'),
+     "Consumer controls can't be held"),
+    (encode_message(OP_REPEAT, 'a', FUNCTION_KEYBOARD,
+                    REPEAT.pack(0, 10) + b'\x04'),
+     'Repeat interval must be greater than 0'),
+    (encode_message(OP_PRIORITY, 'a', 0, b'\x05'), 'Unknown priority 5'),
+    (encode_message(OP_LOCK, 'a', 0, b'\x00'),
+     'Payload length must be 0, not 1'),
+    (encode_message(OP_PRESS, 'zz', FUNCTION_KEYBOARD, b'\x04'),
+     "Unknown target 'zz'"),
+    (encode_message(OP_PRESS, 'a', 7, b'\x04'), 'Unknown function 7'),
+    (encode_message(0x7f, 'a', 0), 'Unknown opcode 0x7f'),
+    (encode_message(OP_RECORD, 'a', 0), 'Macros are not enabled'),
+    (encode_message(OP_ATTACH, 's', 0, b'pool\0udc'),
+     'Pools are not enabled'),
+    (HEADER.pack(4, OP_PRESS, 0, 50) + b'a', 'Target runs past the end'),
+    (HEADER.pack(4, OP_PRESS, 0, 1) + b'\xff', 'Target must be utf-8'),
+    (LENGTH.pack(1) + b'\x03', 'Message too short'),
+])
+def test_errors(client, message, error):
+    """ Errors get their own reply, and don't stop later messages """
+    acks, errors = client.send(
+        message, encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x04'))
+    assert acks == [(1, 2)]
+    assert len(errors) == 1
+    assert errors[0][0] == 0
+    assert errors[0][1].startswith(error)
+
+def test_internal_error(client, relay, monkeypatch):
+    """ Bugs on our end don't cost the client its connection """
+    def broken(*args):
+        raise KeyError('broken')
+    monkeypatch.setitem(client.protocol._handlers, OP_SET, broken)
+
+    assert client.send(
+        encode_message(OP_SET, 'a', FUNCTION_KEYBOARD, b'\x00'),
+        encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x04'),
+    ) == ([(1, 2)], [(0, 'Internal error')])
+    assert relay.keyboard.pressed_keys == [0x04]
+
+def test_disconnect_releases(client, relay):
+    client.send(encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x04'),
+                encode_message(OP_PRESS, 'a', FUNCTION_MOUSE, b'\x01'))
+    client.close()
+    assert relay.keyboard.pressed_keys == []
+    assert relay.mouse.btn_mask == 0
+
+def test_clients_keep_their_own_keys(client, devices, groups, arbiters,
+                                     relay):
+    other = Client(devices, groups, arbiters)
+    client.send(encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x04'))
+    other.send(encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x05'))
+    assert relay.keyboard.pressed_keys == [0x04, 0x05]
+
+    other.send(encode_message(OP_SET, 'a', FUNCTION_KEYBOARD, b'\x00'))
+    assert relay.keyboard.pressed_keys == [0x04]
+    other.close()
+    assert relay.keyboard.pressed_keys == [0x04]
+
+def test_lock(client, devices, groups, arbiters, relay):
+    other = Client(devices, groups, arbiters)
+    assert client.send(encode_message(OP_LOCK, 'a', 0)) == ([(0, 1)], [])
+    assert other.send(encode_message(OP_LOCK, 'a', 0)) == \
+        ([(0, 1)], [(0, "'a' is locked by control client")])
+
+    other.send(encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x05'))
+    assert relay.keyboard.pressed_keys == []
+    client.send(encode_message(OP_UNLOCK, 'a', 0))
+    assert relay.keyboard.pressed_keys == [0x05]
+    other.close()
+
+def test_group_shares_member_arbiters(loop, client, devices, groups,
+                                      arbiters, relay):
+    """
+    Input to a group is merged with input to its members, so it can't release
+    keys that were pressed on a member directly
+    """
+    devices['b'] = member = FakeRelay(loop)
+    groups['g'] = BroadcastGroup('g', dict(devices), loop)
+    other = Client(devices, groups, arbiters)
+
+    client.send(encode_message(OP_PRESS, 'a', FUNCTION_KEYBOARD, b'\x04'))
+    assert other.send(
+        encode_message(OP_PRESS, 'g', FUNCTION_KEYBOARD, b'\x05'),
+    ) == ([(0, 1)], [])
+    assert relay.keyboard.pressed_keys == [0x04, 0x05]
+    assert member.keyboard.pressed_keys == [0x05]
+
+    other.send(encode_message(OP_SET, 'g', FUNCTION_KEYBOARD, b'\x00'))
+    assert relay.keyboard.pressed_keys == [0x04]
+    assert member.keyboard.pressed_keys == []
+    other.close()
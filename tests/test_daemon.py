@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import daemon
+from config import DaemonConfig
+from daemon import Daemon
+from relay_device import RelayDevice
+from usb_gadget import hidg_monitor
+
+@pytest.fixture
+def daemon_config(configfs):
+    daemon_config = DaemonConfig()
+    daemon_config.read_string('''
+[hidrelayd]
+configfs_root = %s
+
+[gadget:a]
+udc_device = udc.0
+
+[gadget:b]
+udc_device = udc.1
+
+[gadget:bad]
+udc_device = udc.2
+
+[pool:p]
+size = 2
+''' % configfs)
+    return daemon_config
+
+@pytest.fixture
+def start(daemon_config, loop, monkeypatch):
+    """
+    Start a daemon, with any gadgets named in broken failing to come up.
+    Returns the daemon and the threads each gadget was built in.
+    """
+    threads = dict()
+    broken = set()
+
+    def relay_device(spec, daemon_config, loop, profile=None):
+        threads[spec.name] = threading.current_thread()
+        if spec.name in broken:
+            raise OSError('No such UDC')
+        return RelayDevice(spec, daemon_config, loop, profile)
+
+    monkeypatch.setattr(daemon, 'RelayDevice', relay_device)
+    daemons = list()
+
+    def start(*names):
+        broken.update(names)
+        daemons.append(Daemon(daemon_config, loop))
+        return daemons[-1], threads
+
+    yield start
+    for started in daemons:
+        started.close()
+        for device in list(started.devices.values()) + \
+                started.pools.pools['p'].free:
+            device.remove()
+    hidg_monitor.stop()
+
+def test_gadgets_start_in_parallel(start):
+    started, threads = start('bad')
+    assert sorted(started.devices) == ['a', 'b']
+    assert len(started.pools.pools['p'].free) == 2
+    assert sorted(threads) == ['a', 'b', 'bad', 'pool-p-0', 'pool-p-1']
+    assert all(thread is not threading.main_thread()
+               for thread in threads.values())
+
+    # Only the gadgets that were bound get timed binding
+    assert sorted(started.profile.phases['bind']) == ['a', 'b']
+    assert sorted(started.profile.phases['hidg discovery']) == ['a', 'b']
+
+def test_nothing_starts(start):
+    with pytest.raises(Daemon.StartupError, match='No gadgets could be'):
+        start('a', 'b', 'bad', 'pool-p-0', 'pool-p-1')
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeFunction, run_until
+from ghid import AbsoluteMouse, Keyboard, Mouse, NkroKeyboard, ReportIdFunction
+
+@pytest.fixture
+def nkro(loop):
+    return NkroKeyboard(None, loop, FakeFunction(loop))
+
+def bitmap(*keys):
+    bitmap = bytearray(NkroKeyboard.BITMAP_SIZE)
+    for key in keys:
+        bitmap[key >> 3] |= 1 << (key & 7)
+    return bytes(bitmap)
+
+def test_nkro_supports_boot_protocol(nkro):
+    assert NkroKeyboard.BOOT_PROTOCOL
+    assert Keyboard.BOOT_PROTOCOL
+
+def test_nkro_boot_report(nkro):
+    """ The first 8 bytes are a boot keyboard report for BIOSes """
+    nkro.press(0xe1, 0x04, 0x70)
+    report = nkro.function.reports[-1]
+    assert report[:8] == bytes([0x02, 0, 0x04, 0x70, 0, 0, 0, 0])
+    assert report[8:] == bitmap(0x04, 0x70)
+    assert nkro.pressed_keys == [0x04, 0x70]
+
+def test_nkro_rollover(nkro):
+    keys = list(range(0x04, 0x0b))
+    nkro.set_pressed(0, keys)
+    report = nkro.function.reports[-1]
+    assert report[2:8] == bytes([0x01] * 6)
+    assert report[8:] == bitmap(*keys)
+
+    nkro.release(0x04)
+    assert nkro.function.reports[-1][2:8] == bytes(keys[1:])
+
+def test_nkro_one_report_per_change(nkro):
+    nkro.press(0x04)
+    nkro.press(0x04)
+    nkro.release(0x05)
+    nkro.release(0x04)
+    assert len(nkro.function.reports) == 2
+    assert not nkro.is_pressed(0x04)
+
+@pytest.mark.parametrize('usage', [0x80, 0xff, -1])
+def test_nkro_usage_out_of_range(nkro, usage):
+    for call in (lambda: nkro.press(usage),
+                 lambda: nkro.release(usage),
+                 lambda: nkro.set_pressed(0, [0x04, usage])):
+        with pytest.raises(ValueError, match='out of range'):
+            call()
+
+    assert nkro.function.reports == []
+    assert nkro.pressed_keys == []
+    assert not nkro.is_pressed(usage)
+
+@pytest.fixture
+def shared(loop):
+    """ A function shared by a keyboard and a mouse, like a composite one """
+    function = FakeFunction(loop)
+    function.configfs_dir = None
+    return function
+
+def test_report_ids(loop, shared):
+    keyboard = Keyboard(None, loop, ReportIdFunction(shared, 1))
+    mouse = Mouse(None, loop, ReportIdFunction(shared, 2))
+
+    keyboard.press(0x04)
+    mouse.move(5, -3)
+    keyboard.release(0x04)
+    mouse.function.write_many(bytes([1, 1, 1, 0, 2, 2]), 3)
+    assert shared.reports == [
+        bytes([1, 0, 0, 0x04, 0, 0, 0, 0, 0]),
+        bytes([2, 0, 5, 0xfd]),
+        bytes([1, 0, 0, 0, 0, 0, 0, 0, 0]),
+        bytes([2, 1, 1, 1]),
+        bytes([2, 0, 2, 2]),
+    ]
+
+def test_report_id_buffer_is_reused(loop, shared):
+    function = ReportIdFunction(shared, 1)
+    keyboard = Keyboard(None, loop, function)
+    keyboard.press(0x04)
+    buf = function._report
+    keyboard.press(0x05)
+    assert function._report is buf
+
+def moves(function):
+    return [Mouse.packet.unpack(report) for report in function.reports]
+
+def test_move_by(loop):
+    mouse = Mouse(None, loop, FakeFunction(loop))
+    mouse.set_pressed(Mouse.Button.LEFT.value)
+    del mouse.function.reports[:]
+
+    assert mouse.move_by(300, -20) is None
+    reports = moves(mouse.function)
+    assert len(reports) == 3
+    assert all(btn_mask == 1 for btn_mask, x, y in reports)
+    assert sum(x for btn_mask, x, y in reports) == 300
+    assert sum(y for btn_mask, x, y in reports) == -20
+
+    del mouse.function.reports[:]
+    mouse.move_by(0, 0)
+    assert mouse.function.reports == []
+
+def test_move_by_over_time(loop):
+    mouse = Mouse(None, loop, FakeFunction(loop))
+    function = mouse.function
+    start = loop.time()
+    done = mouse.move_by(10, 400, duration=0.01)
+    # The first batch goes out straight away
+    assert function.reports
+
+    run_until(loop, done.done)
+    assert loop.time() - start >= 0.009
+    reports = moves(function)
+    assert len(reports) == 10
+    assert sum(x for btn_mask, x, y in reports) == 10
+    assert sum(y for btn_mask, x, y in reports) == 400
+
+def test_move_by_cancelled(loop):
+    mouse = Mouse(None, loop, FakeFunction(loop))
+    done = mouse.move_by(100, 0, duration=1)
+    run_until(loop, lambda: len(mouse.function.reports) >= 2)
+    done.cancel()
+    count = len(mouse.function.reports)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert len(mouse.function.reports) == count < 100
+
+def test_absolute_mouse(loop):
+    mouse = AbsoluteMouse(None, loop, FakeFunction(loop))
+    mouse.move_to(0x7fff, 0x100)
+    mouse.set_pressed(AbsoluteMouse.Button.RIGHT.value)
+    assert mouse.position == (0x7fff, 0x100)
+    assert mouse.function.reports == [
+        bytes([0, 0xff, 0x7f, 0x00, 0x01]),
+        bytes([2, 0xff, 0x7f, 0x00, 0x01]),
+    ]
+    assert not AbsoluteMouse.BOOT_PROTOCOL
+
+def test_absolute_moves_merge():
+    merge = AbsoluteMouse._merge_moves
+    pack = AbsoluteMouse.packet.pack
+    assert merge(pack(1, 10, 10), pack(1, 20, 30)) == pack(1, 20, 30)
+    assert merge(pack(0, 10, 10), pack(1, 20, 30)) is None
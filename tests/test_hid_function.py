@@ -0,0 +1,195 @@
+import os
+
+import pytest
+
+import ghid
+from conftest import run_until
+from ghid import Keyboard, Mouse
+from metrics import FunctionStats
+from usb_gadget import UsbGadget
+
+@pytest.fixture
+def gadget(configfs):
+    gadget = UsbGadget('g', configfs_root=configfs)
+    yield gadget
+    gadget.remove()
+
+@pytest.fixture
+def mouse(gadget, loop):
+    mouse = Mouse(gadget, loop)
+    gadget.bind('udc.0')
+    mouse.connect()
+    yield mouse
+    mouse.close()
+
+@pytest.fixture
+def keyboard(gadget, loop):
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+    keyboard.connect()
+    yield keyboard
+    keyboard.close()
+
+def stall(function):
+    """
+    Fill the pipe standing in for a function's hidg node, as if the host had
+    stopped polling us. Returns how many bytes it took.
+    """
+    fd = function.char_dev.fileno()
+    filled = 0
+    for size in (4096, 1):
+        try:
+            while True:
+                filled += os.write(fd, bytes(size))
+        except BlockingIOError:
+            pass
+    return filled
+
+def poll(function, skip=0):
+    """
+    Have the host pick up everything written to a function so far, returning
+    the reports that came after the first skip bytes
+    """
+    fd = function.char_dev.fileno()
+    data = bytearray()
+    try:
+        while True:
+            data += os.read(fd, 65536)
+    except BlockingIOError:
+        pass
+    return bytes(data[skip:])
+
+def test_write(mouse):
+    mouse.move(1, -1)
+    assert mouse.function.queue_depth == 0
+    assert poll(mouse.function) == Mouse.packet.pack(0, 1, -1)
+
+def test_stalled_host_queues(loop, mouse):
+    function = mouse.function
+    filled = stall(function)
+    mouse.set_pressed(Mouse.Button.LEFT.value)
+    mouse.set_pressed()
+    assert function.queue_depth == 2
+
+    # Queued reports go out in order once the host catches up
+    assert len(poll(function)) == filled
+    run_until(loop, lambda: function.queue_depth == 0)
+    assert poll(function) == Mouse.packet.pack(1, 0, 0) + bytes(3)
+
+def test_write_many_queues_the_rest(loop, mouse):
+    function = mouse.function
+    stall(function)
+    mouse.move_by(127 * 3, 0)
+    assert function.queue_depth == 3
+
+    poll(function)
+    run_until(loop, lambda: function.queue_depth == 0)
+    assert poll(function) == Mouse.packet.pack(0, 127, 0) * 3
+
+def test_close_drops_queue(mouse):
+    function = mouse.function
+    stall(function)
+    mouse.move(1, 1)
+    mouse.close()
+    assert function.queue_depth == 0
+    assert function.char_dev.closed
+
+    # The next write opens the node again
+    mouse.move(2, 2)
+    assert not function.char_dev.closed
+
+def test_stats(loop, mouse):
+    function = mouse.function
+    function.stats = stats = FunctionStats()
+    mouse.move(1, 1)
+    assert (stats.reports, stats.bytes, stats.eagain) == (1, 3, 0)
+
+    stall(function)
+    mouse.set_pressed(Mouse.Button.LEFT.value)
+    mouse.set_pressed()
+    assert stats.eagain == 1
+    poll(function)
+    run_until(loop, lambda: function.queue_depth == 0)
+    assert (stats.reports, stats.bytes) == (3, 9)
+    assert sum(stats.latency_counts) == 3
+
+    mouse.close()
+    mouse.connect()
+    assert stats.reconnects == 1
+
+def test_moves_coalesce(loop, mouse):
+    function = mouse.function
+    function.stats = stats = FunctionStats()
+    stall(function)
+    mouse.move(1, 1)
+    mouse.move(2, 3)
+    assert function.queue_depth == 1
+    assert stats.coalesced == 1
+
+    # Moves only merge while they still fit in a report and the buttons match
+    mouse.move(127, 0)
+    mouse.move(0, 1, Mouse.Button.LEFT.value)
+    mouse.set_pressed()
+    mouse.move(1, 0)
+    assert function.queue_depth == 5
+
+    poll(function)
+    run_until(loop, lambda: function.queue_depth == 0)
+    pack = Mouse.packet.pack
+    assert poll(function) == pack(0, 3, 4) + pack(0, 127, 0) + \
+        pack(1, 0, 1) + pack(0, 0, 0) + pack(0, 1, 0)
+
+def test_poll_interval_is_learned(mouse, monkeypatch):
+    function = mouse.function
+    now = 0.0
+    monkeypatch.setattr(ghid, 'perf_counter', lambda: now)
+    stall(function)
+    mouse.set_pressed()
+    assert function.poll_interval == function.DEFAULT_POLL_INTERVAL
+
+    # Each time the writer finds the host hasn't picked up the report yet is
+    # one poll interval after the last
+    for i in range(64):
+        function._flush()
+        now += 0.001
+    assert function.poll_interval == pytest.approx(0.001, rel=0.01)
+
+    function.set_poll_interval(0.008)
+    for i in range(4):
+        function._flush()
+        now += 0.001
+    assert function.poll_interval == 0.008
+
+def set_leds(keyboard, leds):
+    """ Send an LED output report from the host """
+    os.write(keyboard.function.char_dev.fileno(), bytes([leds]))
+
+def test_leds(loop, keyboard):
+    changes = list()
+    keyboard.add_led_callback(lambda keyboard, leds: changes.append(leds))
+    set_leds(keyboard, Keyboard.Led.CAPS_LOCK.value)
+    run_until(loop, lambda: changes)
+    assert keyboard.leds == Keyboard.Led.CAPS_LOCK.value
+
+    # Only changes are passed on
+    set_leds(keyboard, Keyboard.Led.CAPS_LOCK.value)
+    set_leds(keyboard, 0)
+    run_until(loop, lambda: keyboard.leds == 0)
+    assert changes == [Keyboard.Led.CAPS_LOCK.value, 0]
+
+def test_type_text_with_caps_lock(loop, keyboard):
+    set_leds(keyboard, Keyboard.Led.CAPS_LOCK.value)
+    run_until(loop, lambda: keyboard.leds)
+    reports = list()
+    keyboard.function.recorder = lambda report: reports.append(bytes(report))
+    keyboard.type_text('aA')
+    assert [report[:3] for report in reports[::2]] == \
+        [bytes([0x02, 0, 0x04]), bytes([0, 0, 0x04])]
+
+def test_probe(loop, keyboard):
+    # The pipe hands our own reports back to us as output reports, but their
+    # last byte is 0 so they never look like an LED change
+    assert not loop.run_until_complete(keyboard.probe(timeout=0.02))
+
+    loop.call_later(0.01, set_leds, keyboard, Keyboard.Led.SCROLL_LOCK.value)
+    assert loop.run_until_complete(keyboard.probe(timeout=1))
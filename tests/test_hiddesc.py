@@ -0,0 +1,52 @@
+import pytest
+
+from ghid import AbsoluteMouse, ConsumerControl, Keyboard, Mouse, \
+                 NkroKeyboard
+from hiddesc import Collection, Descriptor, Input, LogicalMaximum, \
+                    LogicalMinimum, ReportCount, ReportSize, Usage, \
+                    UsagePage, APPLICATION, CONSTANT, VARIABLE
+
+def test_encoding():
+    assert bytes(UsagePage(0x01)) == bytes([0x05, 0x01])
+    assert bytes(LogicalMinimum(-127)) == bytes([0x15, 0x81])
+    assert bytes(LogicalMaximum(0x7fff)) == bytes([0x26, 0xff, 0x7f])
+    # Unsigned items don't need a sign bit
+    assert bytes(Usage(0xff)) == bytes([0x09, 0xff])
+    assert bytes(LogicalMinimum(0, size=2)) == bytes([0x16, 0x00, 0x00])
+    with pytest.raises(ValueError, match='too large'):
+        bytes(ReportCount(1 << 32))
+
+def test_mouse_matches_hand_written_descriptor():
+    assert Mouse.HID_DESCRIPTOR == bytes([
+        0x05, 0x01, 0x09, 0x02, 0xa1, 0x01, 0x09, 0x01, 0xa1, 0x00, 0x05,
+        0x09, 0x19, 0x01, 0x29, 0x03, 0x15, 0x00, 0x25, 0x01, 0x95, 0x03,
+        0x75, 0x01, 0x81, 0x02, 0x95, 0x01, 0x75, 0x05, 0x81, 0x03, 0x05,
+        0x01, 0x09, 0x30, 0x09, 0x31, 0x15, 0x81, 0x25, 0x7f, 0x75, 0x08,
+        0x95, 0x02, 0x81, 0x06, 0xc0, 0xc0,
+    ])
+
+@pytest.mark.parametrize('device_cls, fmt, fields', [
+    (Keyboard, '<B1x6s', ('modifiers', 'keys')),
+    (NkroKeyboard, '<B1x6s16s', ('modifiers', 'boot_keys', 'bitmap')),
+    (Mouse, '<Bbb', ('buttons', 'x', 'y')),
+    (AbsoluteMouse, '<BHH', ('buttons', 'x', 'y')),
+    (ConsumerControl, '<H', ('usage',)),
+])
+def test_packers(device_cls, fmt, fields):
+    assert device_cls.packet.format == fmt
+    assert device_cls.descriptor.fields == fields
+
+def descriptor(*items):
+    return Descriptor(UsagePage(0x01), Usage(0x00),
+                      Collection(APPLICATION, *items))
+
+def test_bad_layouts():
+    with pytest.raises(ValueError, match='2 names given for 3 values'):
+        descriptor(ReportSize(8), ReportCount(3), Input(VARIABLE, ('a', 'b')))
+    with pytest.raises(ValueError, match='needs a name for each value'):
+        descriptor(ReportSize(16), ReportCount(2), Input(VARIABLE, 'a'))
+    with pytest.raises(ValueError, match="doesn't start on a byte boundary"):
+        descriptor(ReportSize(1), ReportCount(1), Input(CONSTANT),
+                   ReportCount(7), Input(VARIABLE, 'a'))
+    with pytest.raises(ValueError, match='whole number of bytes'):
+        descriptor(ReportSize(1), ReportCount(3), Input(VARIABLE, 'a'))
@@ -0,0 +1,81 @@
+import pytest
+
+import keymap
+from ghid import Keyboard, NkroKeyboard
+from keymap import ALTGR, SHIFT, compile_text, translate
+
+def test_translate_us():
+    assert translate('aA1!', 'us') == [
+        (0, 0x04), (SHIFT, 0x04), (0, 0x1e), (SHIFT, 0x1e)]
+
+@pytest.mark.parametrize('layout', keymap.LAYOUTS)
+def test_common_keys(layout):
+    assert translate('\n\t ', layout) == [(0, 0x28), (0, 0x2b), (0, 0x2c)]
+
+@pytest.mark.parametrize('layout, char, press', [
+    ('de', 'z', (0, 0x1c)),
+    ('de', 'y', (0, 0x1d)),
+    ('fr', 'a', (0, 0x14)),
+    ('fr', '1', (SHIFT, 0x1e)),
+    ('uk', '"', (SHIFT, 0x1f)),
+    ('uk', '#', (0, 0x32)),
+    ('uk', '\\', (0, 0x64)),
+])
+def test_layout_positions(layout, char, press):
+    assert translate(char, layout) == [press]
+
+@pytest.mark.parametrize('layout, char, press', [
+    ('de', '@', (ALTGR, 0x14)),
+    ('de', '{', (ALTGR, 0x24)),
+    ('uk', '€', (ALTGR, 0x21)),
+    ('fr', '#', (ALTGR, 0x20)),
+])
+def test_altgr(layout, char, press):
+    assert translate(char, layout) == [press]
+
+def test_unknown_layout():
+    with pytest.raises(ValueError, match="Unknown keyboard layout 'xx'"):
+        translate('a', 'xx')
+
+@pytest.mark.parametrize('layout, text', [
+    ('us', 'é'),
+    # Dead keys are left out of the tables
+    ('de', '^'),
+    ('de', '\0'),
+])
+def test_untypeable(layout, text):
+    with pytest.raises(ValueError, match="Can't type"):
+        translate(text, layout)
+
+def test_caps_lock_inverts_letters():
+    assert translate('aA1!', 'us', caps_lock=True) == [
+        (SHIFT, 0x04), (0, 0x04), (0, 0x1e), (SHIFT, 0x1e)]
+    assert translate('äÄ', 'de', caps_lock=True) == [
+        (SHIFT, 0x34), (0, 0x34)]
+
+@pytest.mark.parametrize('layout, char', [
+    # These have uppercase forms, but aren't on letter keys
+    ('de', 'ß'),
+    ('de', 'µ'),
+    ('fr', 'µ'),
+    ('fr', 'ù'),
+    ('uk', 'é'),
+])
+def test_caps_lock_leaves_other_keys_alone(layout, char):
+    assert translate(char, layout, caps_lock=True) == translate(char, layout)
+
+@pytest.mark.parametrize('keyboard_cls', [Keyboard, NkroKeyboard])
+def test_compile_text(keyboard_cls):
+    size = keyboard_cls.packet.size
+    reports = compile_text('hI', 'us', keyboard_cls)
+    assert len(reports) == size * 4
+
+    for i, (modifiers, usage) in enumerate([(0, 0x0b), (SHIFT, 0x0c)]):
+        press = bytearray(size)
+        keyboard_cls.pack_press(press, 0, modifiers, usage)
+        assert reports[size * i * 2:size * (i * 2 + 1)] == press
+        assert reports[size * (i * 2 + 1):size * (i + 1) * 2] == bytes(size)
+
+def test_compile_text_is_cached():
+    assert compile_text('cached', 'us', Keyboard) is \
+        compile_text('cached', 'us', Keyboard)
@@ -0,0 +1,15 @@
+import pytest
+
+from conftest import FakeRelay
+
+# The harness needs kmod to load dummy_hcd
+loopback = pytest.importorskip('loopback')
+
+@pytest.mark.parametrize('name', ['keyboard', 'mouse'])
+def test_sent_reports_match(loop, name):
+    """ The reports we look for on the host are the ones we send """
+    device = getattr(FakeRelay(loop), name)
+    for i in range(4):
+        loopback.send(device, i)
+
+    assert device.function.reports == list(loopback.test_reports(device)) * 2
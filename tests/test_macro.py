@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from arbitration import InputArbiters
+from conftest import run_until
+from control import FUNCTION_KEYBOARD, OP_REPLAY, REPLAY, encode_message
+from macro import HEADER, MAGIC, RECORD, VERSION, Macro, MacroError, \
+                  MacroLibrary
+from test_control import Client
+
+@pytest.fixture
+def library(loop, tmp_path):
+    library = MacroLibrary(loop, str(tmp_path))
+    yield library
+    library.close()
+
+def write_macro(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def test_record_and_replay(loop, library, relay):
+    library.record('a', relay)
+    relay.keyboard.press(0x04)
+    relay.keyboard.release(0x04)
+    relay.mouse.move(1, 1)
+    library.stop_recording('a', 'm')
+    recorded = relay.keyboard.function.reports + relay.mouse.function.reports
+
+    macro = library.load('m')
+    assert [bytes(report) for _, _, report in macro.records] == recorded
+    assert library.load('m') is macro
+
+    relay.keyboard.function.reports.clear()
+    relay.mouse.function.reports.clear()
+    player = library.replay('a', relay, 'm', speed=10)
+    run_until(loop, player.done.done)
+    assert player.done.result()['reports'] == 3
+    assert relay.keyboard.function.reports + relay.mouse.function.reports == \
+        recorded
+
+def test_rerecording_replaces(library, relay):
+    for key in (0x04, 0x05):
+        library.record('a', relay)
+        relay.keyboard.set_pressed(0, [key])
+        library.stop_recording('a', 'm')
+
+    assert bytes(library.load('m').records[0][2])[2] == 0x05
+    # Without leaving the temporary file behind
+    assert os.listdir(library.path) == ['m']
+
+def test_recording_errors(library, relay):
+    library.record('a', relay)
+    with pytest.raises(MacroError, match="Already recording 'a'"):
+        library.record('a', relay)
+    with pytest.raises(MacroError, match="Not recording 'b'"):
+        library.stop_recording('b', 'm')
+    with pytest.raises(MacroError, match="Invalid macro name '.m'"):
+        library.stop_recording('a', '.m')
+    with pytest.raises(MacroError, match="No macro named 'nope'"):
+        library.load('nope')
+
+RECORDS = RECORD.pack(0, 0, 8) + bytes(8) + RECORD.pack(1000, 1, 3) + bytes(3)
+
+@pytest.mark.parametrize('data, error', [
+    (b'', 'too short'),
+    (MAGIC, 'too short'),
+    (HEADER.pack(b'XXXX', VERSION, 0), 'not a macro we understand'),
+    (HEADER.pack(MAGIC, VERSION + 1, 0), 'not a macro we understand'),
+    (HEADER.pack(MAGIC, VERSION, 2) + RECORDS[:-1],
+     'truncated at record 1'),
+    (HEADER.pack(MAGIC, VERSION, 2) + RECORDS[:RECORD.size - 1],
+     'truncated at record 0'),
+    (HEADER.pack(MAGIC, VERSION, 0xffffffff) + RECORDS,
+     'truncated at record 2'),
+])
+def test_corrupt(tmp_path, data, error):
+    path = str(tmp_path / 'm')
+    write_macro(path, data)
+    with pytest.raises(MacroError, match=error):
+        Macro(path)
+
+def test_parse(tmp_path):
+    path = str(tmp_path / 'm')
+    write_macro(path, HEADER.pack(MAGIC, VERSION, 2) + RECORDS)
+    macro = Macro(path)
+    assert [(time, function, bytes(report))
+            for time, function, report in macro.records] == [
+        (0, 0, bytes(8)), (0.001, 1, bytes(3))]
+    assert macro.duration == 0.001
+
+def test_corrupt_macro_over_control(loop, library, relay):
+    """ Clients get told what's wrong, instead of an internal error """
+    write_macro(library.path + '/m', HEADER.pack(MAGIC, VERSION, 1))
+    client = Client({'a': relay}, dict(),
+                    InputArbiters(loop, {'a': relay}, dict()))
+    client.protocol.macros = library
+    acks, errors = client.send(encode_message(
+        OP_REPLAY, 'a', FUNCTION_KEYBOARD, REPLAY.pack(100) + b'm'))
+    client.close()
+    assert errors == [(0, '%s/m is truncated at record 0' % library.path)]
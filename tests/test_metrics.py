@@ -0,0 +1,95 @@
+import asyncio
+
+from broadcast import BroadcastFunction, BroadcastGroup
+from conftest import FakeRelay
+from metrics import FunctionStats, StatsServer, format_stats
+
+def parse(text):
+    """ Get a dict of the samples in Prometheus output """
+    return dict(line.rsplit(' ', 1) for line in text.splitlines()
+                if not line.startswith('#'))
+
+class FakeRelayDevice(FakeRelay):
+    def functions(self):
+        return [('keyboard', self.keyboard.function),
+                ('mouse', self.mouse.function)]
+
+def test_function_stats(loop):
+    relay = FakeRelayDevice(loop)
+    relay.keyboard.function.stats = stats = FunctionStats()
+    stats.record_write(8, 0.0002)
+    stats.eagain = 2
+
+    samples = parse(format_stats({'a': relay}))
+    labels = 'gadget="a",function="keyboard"'
+    assert samples['hidrelayd_reports_written_total{%s}' % labels] == '1'
+    assert samples['hidrelayd_bytes_written_total{%s}' % labels] == '8'
+    assert samples['hidrelayd_eagain_total{%s}' % labels] == '2'
+    assert samples[
+        'hidrelayd_write_latency_seconds_bucket{%s,le="0.00025"}' % labels
+    ] == '1'
+    # Functions without stats are left out
+    assert not any('function="mouse"' in sample for sample in samples)
+
+def test_group_members(loop):
+    lagging = FakeRelay(loop)
+    failing = FakeRelay(loop)
+    group = BroadcastGroup('g', {'lagging': lagging, 'failing': failing},
+                           loop)
+
+    lagging.keyboard.function.queue_depth = \
+        BroadcastFunction.LAG_THRESHOLD + 1
+    def broken(report, merge=None):
+        raise OSError('Broken pipe')
+    failing.keyboard.function.write = broken
+    group.keyboard.press(0x04)
+    assert lagging.keyboard.function.reports
+
+    samples = parse(format_stats(dict(), groups={'g': group}))
+    def sample(name, member, function='keyboard'):
+        return samples['hidrelayd_group_member_%s{group="g",member="%s",'
+                       'function="%s"}' % (name, member, function)]
+
+    assert sample('queue_depth', 'lagging') == \
+        str(BroadcastFunction.LAG_THRESHOLD + 1)
+    assert sample('lagging', 'lagging') == '1'
+    assert sample('failing', 'lagging') == '0'
+    assert sample('queue_depth', 'failing') == '0'
+    assert sample('lagging', 'failing') == '0'
+    assert sample('failing', 'failing') == '1'
+    assert sample('failing', 'failing', 'mouse') == '0'
+
+    # Members recover once a write gets through again
+    del failing.keyboard.function.write
+    group.keyboard.release(0x04)
+    samples = parse(format_stats(dict(), groups={'g': group}))
+    assert sample('failing', 'failing') == '0'
+
+def test_no_groups(loop):
+    assert 'group_member' not in format_stats(dict(), groups=dict())
+
+def test_stats_server(loop, tmp_path):
+    relay = FakeRelayDevice(loop)
+    relay.keyboard.function.stats = FunctionStats()
+    server = StatsServer(str(tmp_path / 'stats'), {'a': relay})
+    loop.run_until_complete(server.start())
+
+    async def request(line):
+        reader, writer = await asyncio.open_unix_connection(server.path)
+        writer.write(line)
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    try:
+        response = loop.run_until_complete(request(b'GET / HTTP/1.0\r\n'))
+        assert response.startswith('HTTP/1.0 200 OK\r\n')
+        assert response.split('\r\n\r\n', 1)[1] == \
+            format_stats({'a': relay})
+
+        # Anything that isn't HTTP just gets the stats
+        response = loop.run_until_complete(request(b''))
+        assert response == format_stats({'a': relay})
+    finally:
+        server.close()
+    assert not (tmp_path / 'stats').exists()
@@ -0,0 +1,206 @@
+"""
+Passthrough tests, fed by virtual input devices created through uinput. They
+need write access to /dev/uinput, and are skipped without it.
+"""
+
+import fcntl
+import os
+import time
+from struct import Struct
+
+import pytest
+
+from arbitration import InputArbiter, InputArbiters
+from config import PassthroughSpec
+from conftest import run_until
+from passthrough import EVENT, EV_KEY, EV_REL, EV_SYN, REL_X, REL_Y, \
+                        SYN_REPORT, Passthrough
+
+pytestmark = pytest.mark.skipif(
+    not os.access('/dev/uinput', os.R_OK | os.W_OK),
+    reason='Needs write access to /dev/uinput')
+
+# struct uinput_setup
+SETUP = Struct('=HHHH80sI')
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_DEV_SETUP = 0x40005503 | (SETUP.size << 16)
+UI_SET_EVBIT = 0x40045564
+UI_SET_KEYBIT = 0x40045565
+UI_SET_RELBIT = 0x40045566
+SYSNAME_LENGTH = 64
+UI_GET_SYSNAME = 0x8000552c | (SYSNAME_LENGTH << 16)
+BUS_VIRTUAL = 0x06
+
+KEY_A = 30
+KEY_B = 48
+KEY_LEFTSHIFT = 42
+KEY_VOLUMEUP = 115
+BTN_LEFT = 0x110
+
+class UInput():
+    """
+    A virtual input device with the given key codes, and relative axes if rel
+    is set
+
+    Keyword arguments:
+    keys -- The key and button codes the device has
+    rel -- Whether the device has REL_X and REL_Y
+    """
+    def __init__(self, keys, rel=False):
+        self.fd = os.open('/dev/uinput', os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(self.fd, UI_SET_EVBIT, EV_KEY)
+            for code in keys:
+                fcntl.ioctl(self.fd, UI_SET_KEYBIT, code)
+            if rel:
+                fcntl.ioctl(self.fd, UI_SET_EVBIT, EV_REL)
+                fcntl.ioctl(self.fd, UI_SET_RELBIT, REL_X)
+                fcntl.ioctl(self.fd, UI_SET_RELBIT, REL_Y)
+
+            fcntl.ioctl(self.fd, UI_DEV_SETUP, SETUP.pack(
+                BUS_VIRTUAL, 0x1d6b, 0x0104, 1, b'hidrelayd test', 0))
+            fcntl.ioctl(self.fd, UI_DEV_CREATE)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+        sysname = fcntl.ioctl(self.fd, UI_GET_SYSNAME, bytes(SYSNAME_LENGTH))
+        sysfs_path = '/sys/devices/virtual/input/%s' % \
+            sysname.rstrip(b'\0').decode()
+        event = next(name for name in os.listdir(sysfs_path)
+                     if name.startswith('event'))
+        self.path = '/dev/input/%s' % event
+
+        # The node can take a moment to show up
+        deadline = time.monotonic() + 1
+        while not os.path.exists(self.path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def emit(self, *events):
+        """ Send (type, code, value) events, followed by a SYN_REPORT """
+        os.write(self.fd, b''.join(
+            EVENT.pack(0, 0, type, code, value)
+            for type, code, value in events + ((EV_SYN, SYN_REPORT, 0),)))
+
+    def close(self):
+        if self.fd is not None:
+            fcntl.ioctl(self.fd, UI_DEV_DESTROY)
+            os.close(self.fd)
+            self.fd = None
+
+@pytest.fixture
+def arbiters(loop, relay):
+    return InputArbiters(loop, {'a': relay}, dict())
+
+@pytest.fixture
+def create(loop, arbiters):
+    """ Create uinput devices and a passthrough from them to 'a' """
+    created = list()
+
+    def create(*input_devices):
+        spec = PassthroughSpec('test', [input_device.path
+                                        for input_device in input_devices],
+                               'a', True)
+        passthrough = Passthrough(loop, spec, arbiters)
+        created.append(passthrough)
+        created.extend(input_devices)
+        return passthrough
+
+    yield create
+    for thing in created:
+        thing.close()
+
+def test_keys(loop, relay, create):
+    keyboard = UInput([KEY_A, KEY_B, KEY_LEFTSHIFT])
+    create(keyboard)
+
+    keyboard.emit((EV_KEY, KEY_LEFTSHIFT, 1), (EV_KEY, KEY_A, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04])
+    assert relay.keyboard.modifier_mask == 0x02
+
+    keyboard.emit((EV_KEY, KEY_B, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04, 0x05])
+
+    keyboard.emit((EV_KEY, KEY_LEFTSHIFT, 0), (EV_KEY, KEY_A, 0),
+                  (EV_KEY, KEY_B, 0))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [])
+    assert relay.keyboard.modifier_mask == 0
+
+def test_one_report_per_sync(loop, relay, create):
+    keyboard = UInput([KEY_A, KEY_B])
+    create(keyboard)
+    reports = relay.keyboard.function.reports
+
+    keyboard.emit((EV_KEY, KEY_A, 1), (EV_KEY, KEY_B, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04, 0x05])
+    assert reports[-1] == bytes([0, 0, 0x04, 0x05, 0, 0, 0, 0])
+    assert bytes([0, 0, 0x04, 0, 0, 0, 0, 0]) not in reports
+
+def test_mouse(loop, relay, create):
+    mouse = UInput([BTN_LEFT], rel=True)
+    create(mouse)
+    reports = relay.mouse.function.reports
+
+    mouse.emit((EV_KEY, BTN_LEFT, 1), (EV_REL, REL_X, 5),
+               (EV_REL, REL_Y, -3))
+    run_until(loop, lambda: reports and reports[-1] == bytes([1, 5, 0xfd]))
+
+    mouse.emit((EV_KEY, BTN_LEFT, 0))
+    run_until(loop, lambda: relay.mouse.btn_mask == 0)
+
+def test_consumer(loop, relay, create):
+    keyboard = UInput([KEY_VOLUMEUP])
+    create(keyboard)
+
+    keyboard.emit((EV_KEY, KEY_VOLUMEUP, 1))
+    run_until(loop, lambda: relay.consumer.usage == 0xe9)
+    keyboard.emit((EV_KEY, KEY_VOLUMEUP, 0))
+    run_until(loop, lambda: relay.consumer.usage == 0)
+
+def test_devices_are_merged(loop, relay, create):
+    first = UInput([KEY_A])
+    second = UInput([KEY_B])
+    create(first, second)
+
+    first.emit((EV_KEY, KEY_A, 1))
+    second.emit((EV_KEY, KEY_B, 1))
+    run_until(loop, lambda: sorted(relay.keyboard.pressed_keys) ==
+              [0x04, 0x05])
+
+    first.emit((EV_KEY, KEY_A, 0))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x05])
+
+def test_lost_device_releases(loop, relay, create):
+    keyboard = UInput([KEY_A])
+    create(keyboard)
+
+    keyboard.emit((EV_KEY, KEY_A, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04])
+    keyboard.close()
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [])
+
+def test_close_releases(loop, relay, create):
+    keyboard = UInput([KEY_A])
+    passthrough = create(keyboard)
+
+    keyboard.emit((EV_KEY, KEY_A, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04])
+    passthrough.close()
+    assert relay.keyboard.pressed_keys == []
+
+def test_operator_comes_first(loop, relay, arbiters, create):
+    """ Scripted input waits until whoever is at the keyboard goes idle """
+    keyboard = UInput([KEY_A])
+    create(keyboard)
+    script = arbiters.session('a', 'script')
+
+    keyboard.emit((EV_KEY, KEY_A, 1))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x04])
+    script.press_keys(0x05)
+    assert relay.keyboard.pressed_keys == [0x04]
+
+    keyboard.emit((EV_KEY, KEY_A, 0))
+    run_until(loop, lambda: relay.keyboard.pressed_keys == [0x05],
+              timeout=InputArbiter.IDLE_TIMEOUT * 4)
+    script.close()
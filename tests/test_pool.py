@@ -0,0 +1,110 @@
+import pytest
+
+from config import DaemonConfig
+from control import OP_ATTACH, OP_DETACH, encode_message
+from pool import GadgetPool, GadgetPools
+from relay_device import RelayDevice
+from test_control import Client
+
+@pytest.fixture
+def daemon_config(configfs):
+    daemon_config = DaemonConfig()
+    daemon_config.read_string('''
+[hidrelayd]
+configfs_root = %s
+
+[pool:p]
+mouse_mode = absolute
+''' % configfs)
+    return daemon_config
+
+@pytest.fixture
+def pool(daemon_config, loop):
+    spec, size = daemon_config.get_pool_specs()['p']
+    pool = GadgetPool('p', spec, daemon_config, loop, stats=True)
+    pool.add(RelayDevice(pool.new_spec(), daemon_config, loop))
+    yield pool
+    for device in pool.free + list(pool.attached.values()):
+        device.close()
+        device.gadget.remove()
+
+@pytest.fixture
+def pools(pool):
+    pools = GadgetPools(dict(), dict())
+    pools.add(pool)
+    return pools
+
+def udc(device):
+    with open(device.gadget.path + '/UDC') as udc_ctl:
+        return udc_ctl.read().strip()
+
+def test_pooled_gadgets_start_unbound(pool):
+    device, = pool.free
+    assert device.gadget.name == 'pool-p-0'
+    assert udc(device) == ''
+    assert all(function.stats is not None
+               for name, function in device.functions())
+
+def test_acquire_and_release(pool):
+    device = pool.acquire('s', 'udc.0')
+    assert pool.free == []
+    assert pool.attached == {'s': device}
+    assert udc(device) == 'udc.0'
+    assert device.spec.udc_device == 'udc.0'
+    device.mouse.move_to(10, 10)
+
+    pool.release('s')
+    assert pool.free == [device]
+    assert udc(device) == ''
+    assert device.mouse.position == (0, 0)
+
+def test_empty_pool_builds_another(pool):
+    first = pool.acquire('s1', 'udc.0')
+    second = pool.acquire('s2', 'udc.1')
+    assert second is not first
+    assert second.gadget.name == 'pool-p-1'
+    assert second.functions()[0][1].stats is not None
+
+def test_failed_attach_goes_back_in_the_pool(pool, monkeypatch):
+    device, = pool.free
+
+    def bind(udc_device):
+        raise OSError('No such UDC')
+
+    monkeypatch.setattr(device.gadget, 'bind', bind)
+    with pytest.raises(OSError):
+        pool.acquire('s', 'udc.0')
+    assert pool.free == [device]
+    assert pool.attached == {}
+
+def test_sessions(pools):
+    pools.attach('s', 'p', 'udc.0')
+    assert pools.sessions() == ['s']
+    assert 's' in pools.devices
+
+    with pytest.raises(GadgetPools.Exception, match="'s' is already in use"):
+        pools.attach('s', 'p', 'udc.1')
+    pools.groups['g'] = None
+    with pytest.raises(GadgetPools.Exception, match="'g' is already in use"):
+        pools.attach('g', 'p', 'udc.1')
+    with pytest.raises(GadgetPools.Exception, match="Unknown pool 'q'"):
+        pools.attach('t', 'q', 'udc.1')
+
+    pools.detach('s')
+    assert pools.sessions() == []
+    assert 's' not in pools.devices
+    with pytest.raises(GadgetPools.Exception, match="No attached session"):
+        pools.detach('s')
+
+def test_attach_over_control(loop, pools):
+    client = Client(pools.devices, pools.groups, None)
+    client.protocol.pools = pools
+    assert client.send(
+        encode_message(OP_ATTACH, 's', 0, b'p\0udc.0'),
+        encode_message(OP_ATTACH, 't', 0, b'p'),
+    ) == ([(1, 2)], [(1, 'Attach needs a pool and a UDC')])
+    assert udc(pools.devices['s']) == 'udc.0'
+
+    assert client.send(encode_message(OP_DETACH, 's', 0)) == ([(2, 1)], [])
+    assert pools.sessions() == []
+    client.close()
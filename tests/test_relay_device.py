@@ -0,0 +1,145 @@
+import asyncio
+import os
+
+import pytest
+
+from config import DaemonConfig
+from conftest import run_until
+from ghid import AbsoluteMouse, Keyboard, Mouse, NkroKeyboard
+from relay_device import RelayDevice
+from test_hid_function import stall
+
+@pytest.fixture
+def daemon_config(configfs):
+    daemon_config = DaemonConfig()
+    daemon_config.read_string('''
+[hidrelayd]
+configfs_root = %s
+
+[gadget:g]
+udc_device = udc.0
+''' % configfs)
+    return daemon_config
+
+@pytest.fixture
+def relay(daemon_config, loop):
+    relay = RelayDevice(daemon_config.get_gadget_spec('gadget:g'),
+                        daemon_config, loop)
+    relay.connect()
+    yield relay
+    relay.remove()
+
+def udc(configfs):
+    with open(configfs + '/g/UDC') as udc_ctl:
+        return udc_ctl.read().strip()
+
+def test_unchanged(relay, configfs):
+    keyboard = relay.keyboard
+    assert relay.reconfigure(relay.spec)
+    assert relay.keyboard is keyboard
+    assert udc(configfs) == 'udc.0'
+
+def test_poll_interval_keeps_serving(relay, configfs):
+    reader_fd = relay.keyboard.function._reader_fd
+    assert relay.reconfigure(relay.spec._replace(poll_interval=8))
+    assert relay.keyboard.function.poll_interval == 0.008
+    assert relay.keyboard.function._reader_fd == reader_fd
+
+def test_mode_change(relay, configfs, monkeypatch):
+    unbind = relay.gadget.unbind
+
+    def check_unbind():
+        # Nothing can be left watching the hidg nodes unbinding closes
+        for name, function in relay.functions():
+            assert function.char_dev is None or function.char_dev.closed
+            assert function._reader_fd is None
+            assert function._writer_fd is None
+        unbind()
+
+    monkeypatch.setattr(relay.gadget, 'unbind', check_unbind)
+    assert relay.reconfigure(relay.spec._replace(keyboard_mode='nkro',
+                                                 mouse_mode='absolute'))
+    assert isinstance(relay.keyboard, NkroKeyboard)
+    assert isinstance(relay.mouse, AbsoluteMouse)
+    assert udc(configfs) == 'udc.0'
+
+    # Everything was reconnected once the gadget was bound again
+    for name, function in relay.functions():
+        assert function._reader_fd is not None or \
+            function.on_output_report is None
+        assert not function.char_dev.closed
+
+def test_rebind_forgets_host_state(relay, configfs):
+    relay.keyboard.press(0x04)
+    relay.mouse.set_pressed(Mouse.Button.LEFT.value)
+    assert relay.reconfigure(relay.spec._replace(udc_device='udc.1'))
+    assert udc(configfs) == 'udc.1'
+    assert relay.keyboard.pressed_keys == []
+    assert relay.mouse.btn_mask == 0
+
+def test_removed_function(relay, configfs):
+    assert relay.reconfigure(relay.spec._replace(mouse_mode=None))
+    assert relay.mouse is None
+    assert isinstance(relay.keyboard, Keyboard)
+    assert os.listdir(configfs + '/g/functions') == ['hid.usb1']
+
+def test_gadget_change_needs_recreating(relay):
+    assert not relay.reconfigure(relay.spec._replace(serial='other'))
+    assert not relay.reconfigure(relay.spec._replace(composite=True))
+
+@pytest.fixture
+def composite(daemon_config, loop):
+    spec = daemon_config.get_gadget_spec('gadget:g')._replace(
+        consumer=True, composite=True)
+    relay = RelayDevice(spec, daemon_config, loop)
+    relay.connect()
+    yield relay
+    relay.remove()
+
+def test_composite_shares_one_function(composite, configfs):
+    assert os.listdir(configfs + '/g/functions') == ['hid.usb1']
+    assert composite.functions() == [('composite', composite.composite)]
+    function_path = configfs + '/g/functions/hid.usb1'
+    with open(function_path + '/report_length') as attr:
+        assert int(attr.read()) == Keyboard.packet.size + 1
+    with open(function_path + '/report_desc', 'rb') as attr:
+        descriptor = attr.read()
+    for report_id in (1, 2, 3):
+        assert bytes([0x85, report_id]) in descriptor
+
+def test_composite_reports(composite):
+    function = composite.composite
+    reports = list()
+    function.recorder = lambda report: reports.append(bytes(report))
+    composite.keyboard.press(0x04)
+    composite.mouse.move(1, 2)
+    composite.consumer.tap(0xe9)
+    assert reports == [
+        bytes([1, 0, 0, 0x04, 0, 0, 0, 0, 0]),
+        bytes([2, 0, 1, 2]),
+        bytes([3, 0xe9, 0]),
+        bytes([3, 0, 0]),
+    ]
+
+def test_composite_output_reports(loop, composite):
+    changes = list()
+    composite.keyboard.add_led_callback(
+        lambda keyboard, leds: changes.append(leds))
+    fd = composite.composite.char_dev.fileno()
+    os.write(fd, bytes([1, 0x02]))
+    run_until(loop, lambda: changes)
+
+    # Output reports for other report IDs aren't the keyboard's
+    os.write(fd, bytes([2, 0x04]))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert changes == [0x02]
+
+def test_composite_moves_only_merge_with_their_own(composite):
+    function = composite.composite
+    stall(function)
+    composite.mouse.move(1, 1)
+    composite.mouse.move(1, 1)
+    assert function.queue_depth == 1
+    composite.keyboard.press(0x04)
+    composite.mouse.move(1, 1)
+    assert function.queue_depth == 3
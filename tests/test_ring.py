@@ -0,0 +1,89 @@
+import pytest
+
+from conftest import FakeRelay, run_until
+from ghid import Device, Mouse
+from ring import HEAD_OFFSET, INDEX, RingChannel, RingProducer
+
+@pytest.fixture
+def mouse(loop):
+    return FakeRelay(loop).mouse
+
+@pytest.fixture
+def channel(loop, tmp_path, mouse):
+    channel = RingChannel(loop, str(tmp_path / 'mouse.ring'), mouse,
+                          slot_count=4)
+    yield channel
+    channel.close()
+
+def connect(loop, channel):
+    """ Connect a producer, which blocks until it's handed the ring """
+    return loop.run_until_complete(
+        loop.run_in_executor(None, RingProducer, channel.path))
+
+def head(channel):
+    """ The index of the next slot the channel will read """
+    return INDEX.unpack_from(channel._mmap, HEAD_OFFSET)[0]
+
+def moves(count, start=1):
+    return [Mouse.packet.pack(0, x, 0) for x in range(start, start + count)]
+
+def test_push(loop, channel, mouse):
+    producer = connect(loop, channel)
+    assert producer.report_size == Mouse.packet.size
+    assert producer.push_many(moves(3)) == 3
+    run_until(loop, lambda: len(mouse.function.reports) == 3)
+    assert mouse.function.reports == moves(3)
+
+    # Indexes carry on around the ring
+    for batch in range(4):
+        assert producer.push_many(moves(3, 4 + batch * 3)) == 3
+        run_until(loop, lambda: len(mouse.function.reports) == 6 + batch * 3)
+    assert mouse.function.reports == moves(15)
+    producer.close()
+
+def test_full(loop, channel, mouse):
+    producer = connect(loop, channel)
+    assert producer.push_many(moves(6)) == 4
+    assert not producer.push(moves(1)[0])
+    run_until(loop, lambda: len(mouse.function.reports) == 4)
+    assert producer.push(moves(1)[0])
+    producer.close()
+
+def test_bad_report_length(loop, channel, mouse):
+    producer = connect(loop, channel)
+    with pytest.raises(ValueError, match='Reports must be 3 bytes long'):
+        producer.push_many(moves(1) + [bytes(4)])
+
+    # Nothing from the batch made it into the ring
+    assert producer.push(moves(1, 5)[0])
+    run_until(loop, lambda: mouse.function.reports)
+    assert mouse.function.reports == moves(1, 5)
+    producer.close()
+
+def test_one_producer_at_a_time(loop, channel, mouse):
+    producer = connect(loop, channel)
+    with pytest.raises(RingProducer.BusyError):
+        connect(loop, channel)
+
+    producer.close()
+    run_until(loop, lambda: channel._producer is None)
+    producer = connect(loop, channel)
+    assert producer.push(moves(1)[0])
+    run_until(loop, lambda: mouse.function.reports)
+    producer.close()
+
+def test_unbound_gadget_drops_reports(loop, channel, mouse, monkeypatch):
+    def unbound(report, merge=None):
+        raise Device.GadgetUnboundError()
+
+    producer = connect(loop, channel)
+    monkeypatch.setattr(mouse.function, 'write', unbound)
+    producer.push_many(moves(3))
+    run_until(loop, lambda: head(channel) == 3)
+
+    # Once there's a host again, only new reports are sent
+    monkeypatch.undo()
+    producer.push(moves(1, 9)[0])
+    run_until(loop, lambda: mouse.function.reports)
+    assert mouse.function.reports == moves(1, 9)
+    producer.close()
@@ -0,0 +1,32 @@
+import logging
+import threading
+
+from startup import StartupProfile
+
+def test_profile(caplog):
+    profile = StartupProfile()
+    with profile.phase('module load'):
+        pass
+
+    def bind(name):
+        with profile.phase('bind', name):
+            pass
+
+    threads = [threading.Thread(target=bind, args=(name,))
+               for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with caplog.at_level(logging.INFO):
+        profile.finish()
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith('Ready after ')
+    assert messages[1].split()[:2] == ['module', 'load']
+    assert messages[2].split()[0] == 'bind'
+    assert 'slowest' in messages[2]
+    # Phases nothing was timed in are left out
+    assert len(messages) == 3
+    assert set(profile.phases['bind']) == {'a', 'b'}
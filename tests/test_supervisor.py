@@ -0,0 +1,119 @@
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+from arbitration import InputArbiters
+from conftest import FakeRelay, run_until
+from control import FUNCTION_KEYBOARD, OP_ATTACH, OP_PRESS, OP_RECORD, \
+                    ControlProtocol, ProtocolError, encode_message
+from supervisor import RoutingProtocol
+from test_control import FakeTransport, parse_replies
+
+class FakeWorker():
+    """
+    Stands in for a worker process, with its control server running on our
+    own event loop
+    """
+    def __init__(self, loop, name):
+        self.loop = loop
+        self.name = name
+        self.relay = FakeRelay(loop)
+        self.running = True
+        self.protocols = list()
+        self._arbiters = InputArbiters(loop, {name: self.relay}, dict())
+
+    def _create_protocol(self):
+        protocol = ControlProtocol({self.name: self.relay}, dict(),
+                                   self._arbiters)
+        self.protocols.append(protocol)
+        return protocol
+
+    def connect(self):
+        if not self.running:
+            raise ProtocolError("Gadget '%s' is restarting" % self.name)
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.loop.create_task(self.loop.connect_accepted_socket(
+            self._create_protocol, theirs))
+        return ours
+
+@pytest.fixture
+def supervisor(loop):
+    return SimpleNamespace(
+        loop=loop, workers={name: FakeWorker(loop, name) for name in 'ab'},
+        groups={'g': ['a', 'b']})
+
+class Router():
+    """ A RoutingProtocol for one client, and what it's sent back to us """
+    def __init__(self, supervisor):
+        self.loop = supervisor.loop
+        self.protocol = RoutingProtocol(supervisor)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+
+    def send(self, *messages):
+        """ Send a batch of messages, and wait for the reply to it """
+        self.transport.data = b''
+        self.protocol.data_received(b''.join(messages))
+        run_until(self.loop, lambda: parse_replies(self.transport.data)[0])
+        return parse_replies(self.transport.data)
+
+    def close(self):
+        self.protocol.connection_lost(None)
+
+@pytest.fixture
+def router(supervisor):
+    router = Router(supervisor)
+    yield router
+    router.close()
+
+def press(target, key):
+    return encode_message(OP_PRESS, target, FUNCTION_KEYBOARD, bytes([key]))
+
+def keys(supervisor, name):
+    return supervisor.workers[name].relay.keyboard.pressed_keys
+
+def test_routes_to_workers(router, supervisor):
+    assert router.send(press('a', 0x04), press('b', 0x05)) == ([(1, 2)], [])
+    assert keys(supervisor, 'a') == [0x04]
+    assert keys(supervisor, 'b') == [0x05]
+
+    # Each worker only gets connected to once per client
+    assert router.send(press('a', 0x06)) == ([(2, 1)], [])
+    assert len(supervisor.workers['a'].protocols) == 1
+
+def test_groups_go_to_every_member(router, supervisor):
+    assert router.send(press('g', 0x04)) == ([(0, 1)], [])
+    assert keys(supervisor, 'a') == [0x04]
+    assert keys(supervisor, 'b') == [0x04]
+
+def test_errors_keep_their_sequence_numbers(router, supervisor):
+    acks, errors = router.send(
+        press('a', 0x04),
+        encode_message(OP_PRESS, 'b', 7, b'\x04'),
+        press('zz', 0x04),
+        encode_message(OP_ATTACH, 'a', 0, b'p\0udc'),
+        encode_message(OP_RECORD, 'g', 0, b'm'),
+        press('b', 0x05))
+    assert acks == [(5, 6)]
+    assert [(seq, message.split(' ', 1)[0]) for seq, message in errors] == [
+        (1, 'Unknown'), (2, 'Unknown'), (3, 'Pools'), (4, "Can't")]
+    assert errors[1] == (2, "Unknown target 'zz'")
+    assert keys(supervisor, 'b') == [0x05]
+
+def test_restarting_worker(router, supervisor):
+    supervisor.workers['b'].running = False
+    assert router.send(press('a', 0x04), press('b', 0x05)) == \
+        ([(1, 2)], [(1, "Gadget 'b' is restarting")])
+    assert keys(supervisor, 'a') == [0x04]
+
+def test_worker_going_away(loop, router, supervisor):
+    router.send(press('a', 0x04))
+    worker = supervisor.workers['a']
+    worker.protocols[0].transport.abort()
+    run_until(loop, lambda: 'a' not in router.protocol._links)
+
+    # The next message reconnects
+    assert router.send(press('a', 0x05)) == ([(1, 1)], [])
+    assert len(worker.protocols) == 2
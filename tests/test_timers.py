@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import timers
+from conftest import FakeRelay, run_until
+from ghid import Mouse
+from timers import TimerWheel
+
+@pytest.fixture
+def wheel(loop):
+    return TimerWheel(loop)
+
+def test_order(loop, wheel):
+    fired = list()
+    now = loop.time()
+    for delay in (0.02, 0.005, 0.01):
+        wheel.call_at(now + delay, fired.append, delay)
+
+    run_until(loop, lambda: len(fired) == 3)
+    assert fired == [0.005, 0.01, 0.02]
+    assert wheel.pending == 0
+
+def test_cancel(loop, wheel):
+    fired = list()
+    timer = wheel.call_later(0.005, fired.append, 'cancelled')
+    wheel.call_later(0.01, fired.append, 'kept')
+    timer.cancel()
+    assert timer.cancelled
+    assert wheel.pending == 1
+
+    run_until(loop, lambda: fired)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert fired == ['kept']
+
+def test_cancelling_everything_stops_waking_up(wheel):
+    wheel.call_later(1, print).cancel()
+    assert wheel.pending == 0
+    assert wheel._handle is None
+
+def test_past_revolution(loop):
+    """ Timers further off than one turn of the wheel wait their turn """
+    wheel = TimerWheel(loop, resolution=0.001, slot_count=4)
+    fired = list()
+    start = loop.time()
+    wheel.call_at(start + 0.002, fired.append, 'soon')
+    wheel.call_at(start + 0.010, fired.append, 'later')
+
+    run_until(loop, lambda: fired == ['soon'])
+    assert loop.time() - start < 0.010
+    run_until(loop, lambda: len(fired) == 2)
+    assert loop.time() - start >= 0.010
+
+def test_callback_errors_dont_stop_the_wheel(loop, wheel):
+    errors = list()
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+    fired = list()
+    def broken():
+        raise KeyError('broken')
+
+    wheel.call_later(0.001, broken)
+    wheel.call_later(0.002, fired.append, 'after')
+    run_until(loop, lambda: fired)
+    assert isinstance(errors[0]['exception'], KeyError)
+
+def test_hold(loop):
+    events = list()
+    done = timers.hold(loop, lambda: events.append('press'),
+                       lambda: events.append('release'), 0.01)
+    assert events == ['press']
+    run_until(loop, done.done)
+    assert events == ['press', 'release']
+
+def test_hold_cancelled(loop):
+    events = list()
+    done = timers.hold(loop, lambda: events.append('press'),
+                       lambda: events.append('release'), 10)
+    done.cancel()
+    run_until(loop, lambda: len(events) == 2)
+    assert events == ['press', 'release']
+
+def test_repeat(loop):
+    count = 0
+    def tap():
+        nonlocal count
+        count += 1
+
+    done = timers.repeat(loop, tap, 0.002, lambda: count == 5)
+    run_until(loop, done.done)
+    assert done.result() == 5
+
+    done = timers.repeat(loop, tap, 0.002)
+    run_until(loop, lambda: count >= 7)
+    done.cancel()
+    taps = count
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert count == taps
+
+def test_keyboard_hold_and_repeat(loop):
+    relay = FakeRelay(loop)
+    keyboard = relay.keyboard
+
+    done = keyboard.hold(0x04, 0.005)
+    assert keyboard.pressed_keys == [0x04]
+    run_until(loop, done.done)
+    assert keyboard.pressed_keys == []
+
+    done = keyboard.repeat(0x05, 0.001, lambda: False)
+    run_until(loop, lambda: len(keyboard.function.reports) >= 8)
+    done.cancel()
+    keys = [report[2] for report in keyboard.function.reports[2:8]]
+    assert keys == [0x05, 0, 0x05, 0, 0x05, 0]
+
+def test_mouse_hold(loop):
+    mouse = FakeRelay(loop).mouse
+    done = mouse.hold(Mouse.Button.LEFT, 0.005)
+    assert mouse.btn_mask == Mouse.Button.LEFT.value
+    run_until(loop, done.done)
+    assert mouse.btn_mask == 0
+
+    with pytest.raises(ValueError, match='Unknown mouse buttons'):
+        mouse.hold(0x80, 0.005)
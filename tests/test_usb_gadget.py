@@ -0,0 +1,154 @@
+import os
+from types import SimpleNamespace
+
+import pyudev
+
+from ghid import Keyboard, Mouse, NkroKeyboard
+from usb_gadget import HidgMonitor, UsbGadget, hidg_monitor
+
+def detach(finalizer):
+    info = finalizer.detach()
+    if info is not None and len(info[2]) == 4:
+        _, child_dirs, child_links, _ = info[2]
+        for child in child_dirs + child_links:
+            detach(child)
+
+def restart(gadget):
+    """
+    Leave a gadget's tree in place, as if the daemon had exited. Until then
+    the tests hold on to their devices, since dropping one removes its
+    function.
+    """
+    detach(gadget._cleanup_handler)
+
+def read(path, mode='r'):
+    with open(path, mode) as attr:
+        return attr.read()
+
+def test_adopt_unchanged(configfs, loop):
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+    dev = read(configfs + '/g/functions/hid.usb1/dev')
+    restart(gadget)
+
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    assert gadget.adopted
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+
+    # The function was left alone, and the host never saw us go away
+    assert read(configfs + '/g/functions/hid.usb1/dev') == dev
+    assert read(configfs + '/g/UDC').strip() == 'udc.0'
+    restart(gadget)
+
+def test_adopt_changed_descriptor(configfs, loop):
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+    restart(gadget)
+
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    keyboard = NkroKeyboard(gadget, loop)
+    function_path = configfs + '/g/functions/hid.usb1'
+    assert keyboard.function.configfs_dir.path == function_path
+    assert read(function_path + '/report_desc', 'rb') == \
+        NkroKeyboard.HID_DESCRIPTOR
+    assert read(function_path + '/report_length').strip() == \
+        str(NkroKeyboard.packet.size)
+    assert read(function_path + '/subclass').strip() == \
+        str(int(NkroKeyboard.BOOT_PROTOCOL))
+    assert os.path.realpath(configfs + '/g/configs/c.1/hid.usb1') == \
+        os.path.realpath(function_path)
+
+    # Changing the function meant unbinding it
+    assert read(configfs + '/g/UDC').strip() == ''
+    gadget.bind('udc.0')
+    assert read(configfs + '/g/UDC').strip() == 'udc.0'
+    restart(gadget)
+
+def test_adopt_prunes_stale_functions(configfs, loop):
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    keyboard = Keyboard(gadget, loop)
+    mouse = Mouse(gadget, loop)
+    gadget.bind('udc.0')
+    restart(gadget)
+
+    gadget = UsbGadget('g', configfs_root=configfs, persistent=True)
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+    assert os.listdir(configfs + '/g/functions') == ['hid.usb1']
+    assert not os.path.lexists(configfs + '/g/configs/c.1/hid.usb2')
+    restart(gadget)
+
+def test_not_persistent_is_removed(configfs, loop):
+    gadget = UsbGadget('g', configfs_root=configfs)
+    keyboard = Keyboard(gadget, loop)
+    gadget.bind('udc.0')
+    gadget.remove()
+    assert not os.path.exists(configfs + '/g')
+
+class FakeUdevMonitor():
+    """ Hands out a list of udev events the way pyudev.Monitor.poll() does """
+    def __init__(self, *events):
+        self.events = list(events)
+
+    def poll(self, timeout):
+        return self.events.pop(0) if self.events else None
+
+def udev_event(action, device_number, device_node):
+    return SimpleNamespace(action=action, device_number=device_number,
+                           device_node=device_node)
+
+def test_hidg_monitor_caches_nodes(monkeypatch):
+    monitor = HidgMonitor()
+    lookups = list()
+
+    def from_device_number(context, kind, device_number):
+        lookups.append(device_number)
+        return SimpleNamespace(device_node='/dev/hidg%d' % device_number)
+
+    monkeypatch.setattr(pyudev.Devices, 'from_device_number',
+                        from_device_number)
+    assert monitor.find_node(3) == '/dev/hidg3'
+    assert monitor.find_node(3) == '/dev/hidg3'
+    assert lookups == [3]
+
+def test_hidg_monitor_events():
+    monitor = HidgMonitor()
+    removed = list()
+    monitor.watch(1, lambda: removed.append(1))
+    monitor.watch(2, lambda: removed.append(2))
+    monitor.unwatch(2, removed.clear)
+
+    monitor._monitor = FakeUdevMonitor(udev_event('add', 1, '/dev/hidg1'),
+                                       udev_event('add', 2, '/dev/hidg2'),
+                                       udev_event('remove', 1, '/dev/hidg1'))
+    monitor._handle_events()
+    assert monitor.nodes == {2: '/dev/hidg2'}
+    assert removed == [1]
+
+    # Callbacks only fire once
+    monitor._monitor = FakeUdevMonitor(udev_event('remove', 1, '/dev/hidg1'))
+    monitor._handle_events()
+    assert removed == [1]
+
+def test_function_follows_its_node(configfs, loop, monkeypatch):
+    gadget = UsbGadget('g', configfs_root=configfs)
+    mouse = Mouse(gadget, loop)
+    gadget.bind('udc.0')
+    mouse.connect()
+    function = mouse.function
+    char_dev = function.char_dev
+
+    # Unbinding removes the node, and we let go of it straight away
+    monkeypatch.setattr(hidg_monitor, '_monitor', FakeUdevMonitor(
+        udev_event('remove', function._device_number, None)))
+    hidg_monitor._handle_events()
+    assert char_dev.closed
+
+    # The next write opens whatever node the function has now
+    mouse.move(1, 1)
+    assert function.char_dev is not char_dev
+    assert not function.char_dev.closed
+    gadget.remove()